@@ -15,7 +15,8 @@ setup(
     packages=['soapypower'],
     entry_points={
         'console_scripts': [
-            'soapy_power=soapypower.__main__:main'
+            'soapy_power=soapypower.__main__:main',
+            'soapy_power_bench=soapypower.bench:main'
         ],
     },
     install_requires=[
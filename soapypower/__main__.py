@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
-import os, sys, logging, argparse, re, shutil, textwrap
+import os, sys, socket, logging, argparse, re, shutil, textwrap
 
-import simplesoapy
-from soapypower import writer
+from soapypower import writer, broadcast, stitch, detector, metrics
 from soapypower.version import __version__
 
+try:
+    import simplesoapy
+except ImportError:
+    simplesoapy = None
+
 logger = logging.getLogger(__name__)
 re_float_with_multiplier = re.compile(r'(?P<num>[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?)(?P<multi>[kMGT])?')
 re_float_with_multiplier_negative = re.compile(r'^(?P<num>-(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?)(?P<multi>[kMGT])?$')
@@ -33,6 +37,16 @@ def freq_or_freq_range(string):
     return [float_with_multiplier(f) for f in string.split(':')]
 
 
+def int_list(string):
+    """Convert string with comma-separated integers to list of integers"""
+    return [int(x) for x in string.split(',')]
+
+
+def float_list(string):
+    """Convert string with comma-separated floats to list of floats"""
+    return [float(x) for x in string.split(',')]
+
+
 def specific_gains(string):
     """Convert string with gains of individual amplification elements to dict"""
     if not string:
@@ -57,6 +71,18 @@ def device_settings(string):
     return settings
 
 
+def tones(string):
+    """Convert string with tones (freq:power,...) to list of (float, float) tuples"""
+    if not string:
+        return []
+
+    tone_list = []
+    for tone in string.split(','):
+        freq, _, power = tone.partition(':')
+        tone_list.append((float_with_multiplier(freq.strip()), float(power.strip()) if power.strip() else -30))
+    return tone_list
+
+
 def wrap(text, indent='    '):
     """Wrap text to terminal width with default indentation"""
     wrapper = textwrap.TextWrapper(
@@ -153,13 +179,27 @@ def setup_argument_parser():
                             'can be followed by a k, M or G multiplier (default: %(default)s)')
 
     output_group = main_title.add_mutually_exclusive_group()
-    output_group.add_argument('-O', '--output', metavar='FILE', type=argparse.FileType('w'), default=sys.stdout,
-                              help='output to file (incompatible with --output-fd, default is stdout)')
+    output_group.add_argument('-O', '--output', metavar='FILE', default='-',
+                              help='output to file, directory (waterfall format) or to all clients connected '
+                              'to tcp://HOST:PORT or unix://PATH server, - is stdout '
+                              '(incompatible with --output-fd, default: %(default)s)')
     output_group.add_argument('--output-fd', metavar='NUM', type=int, default=None,
                               help='output to existing file descriptor (incompatible with -O)')
 
     main_title.add_argument('-F', '--format', choices=sorted(writer.formats.keys()), default='rtl_power',
                             help='output format (default: %(default)s)')
+    main_title.add_argument('--precision', metavar='NUM', type=int, default=None,
+                            help='number of decimal places of power values in text output formats '
+                            '(default: shortest exact representation)')
+    main_title.add_argument('--bin-encoding', choices=writer.SoapyPowerBinFormat.encodings, default='float32',
+                            help='encoding of power values in soapy_power_bin format, float32 is written as '
+                            'version 2 format, other encodings as version 3 format (default: %(default)s)')
+    main_title.add_argument('--bin-compression', choices=writer.SoapyPowerBinFormat.compressions, default='none',
+                            help='per-frame compression of power values in soapy_power_bin format '
+                            '(default: %(default)s)')
+    main_title.add_argument('--bin-quantization', metavar='dB', type=float, default=0.01,
+                            help='quantization step of int16 and delta encodings (it is increased automatically '
+                            'for frames with too large range of values, default: %(default)s)')
     main_title.add_argument('-q', '--quiet', action='store_true',
                             help='limit verbosity')
     main_title.add_argument('--debug', action='store_true',
@@ -196,23 +236,65 @@ def setup_argument_parser():
     runs_group.add_argument('-e', '--elapsed', metavar='SECONDS', type=float,
                             help='scan session duration (time limit in seconds, incompatible with -c and -u)')
 
+    detector_title = parser.add_argument_group('Detector')
+    detector_title.add_argument('--detector', choices=detector.modes, default=None,
+                                help='combine PSD of every hop across runs (max-hold, min-hold, exponential '
+                                'or linear average) instead of writing every run (default: disabled)')
+    detector_title.add_argument('--detector-alpha', metavar='FLOAT', type=float, default=0.1,
+                                help='smoothing factor of exponential average (default: %(default)s)')
+    detector_title.add_argument('--detector-runs', metavar='NUM', type=int, default=0,
+                                help='write output of detector every NUM runs (0 = disabled, default: %(default)s)')
+    detector_title.add_argument('--detector-interval', metavar='SECONDS', type=float, default=0,
+                                help='write output of detector every SECONDS (0 = disabled, default: %(default)s)')
+
+    adaptive_title = parser.add_argument_group('Adaptive scheduling')
+    adaptive_title.add_argument('--adaptive', action='store_true',
+                                help='revisit active hops in every run and quiet hops less often '
+                                '(every run visits only selected hops)')
+    adaptive_title.add_argument('--max-revisit', metavar='SECONDS', type=float, default=60,
+                                help='maximal interval between visits of quiet hop (default: %(default)s)')
+    adaptive_title.add_argument('--activity-threshold', metavar='dB', type=float, default=10,
+                                help='hop is active if its max. power exceeds its noise floor or changes '
+                                'between visits by more than dB (default: %(default)s)')
+
+    files_title = parser.add_argument_group('Output files and network streaming')
+    files_title.add_argument('--flush-hops', metavar='NUM', type=int, default=1,
+                             help='flush output after every NUM hops (0 = only at end of run, default: %(default)s)')
+    files_title.add_argument('--flush-interval', metavar='SECONDS', type=float, default=0,
+                             help='flush output at least every SECONDS (0 = disabled, default: %(default)s)')
+    files_title.add_argument('--rotate-size', metavar='BYTES', type=float_with_multiplier, default=0,
+                             help='start new output file when current file reaches BYTES, number can be followed '
+                             'by a k, M or G multiplier (requires -O, 0 = disabled, default: %(default)s)')
+    files_title.add_argument('--rotate-interval', metavar='SECONDS', type=float, default=0,
+                             help='start new output file every SECONDS (requires -O, 0 = disabled, default: %(default)s)')
+    files_title.add_argument('--client-queue-size', metavar='NUM', type=int, default=100,
+                             help='max. number of hops queued for every network client (default: %(default)s)')
+    files_title.add_argument('--client-overflow', choices=broadcast.overflow_policies, default='drop-oldest',
+                             help='what to do when queue of slow network client is full (default: %(default)s)')
+
     device_title = parser.add_argument_group('Device settings')
-    device_title.add_argument('-d', '--device', default='',
-                              help='SoapySDR device to use')
-    device_title.add_argument('-C', '--channel', type=int, default=0,
-                              help='SoapySDR RX channel (default: %(default)s)')
+    device_title.add_argument('-d', '--device', action='append', default=None,
+                              help='SoapySDR device to use (repeat to sweep with multiple devices in parallel, '
+                              'with --simulate or --replay one sample source is created for every device)')
+    device_title.add_argument('-C', '--channel', type=int_list, default='0',
+                              help='SoapySDR RX channel (comma-separated list to receive multiple channels '
+                              'of one MIMO device simultaneously, default: %(default)s)')
+    device_title.add_argument('--channel-mode', choices=('split', 'paired'), default='split',
+                              help='how to use multiple RX channels: split frequency hops between channels '
+                              'or measure every hop by all channels (default: %(default)s)')
     device_title.add_argument('-A', '--antenna', default='',
                               help='SoapySDR selected antenna')
     device_title.add_argument('-r', '--rate', metavar='Hz', type=float_with_multiplier, default=2e6,
                               help='sample rate (default: %(default)s)')
     device_title.add_argument('-w', '--bandwidth', metavar='Hz', type=float_with_multiplier, default=0,
                               help='filter bandwidth (default: %(default)s)')
-    device_title.add_argument('-p', '--ppm', type=int, default=0,
-                              help='frequency correction in ppm')
+    device_title.add_argument('-p', '--ppm', type=int_list, default='0',
+                              help='frequency correction in ppm (comma-separated list for multiple devices)')
 
     gain_group = device_title.add_mutually_exclusive_group()
-    gain_group.add_argument('-g', '--gain', metavar='dB', type=float, default=37.2,
-                            help='total gain (incompatible with -G and -a, default: %(default)s)')
+    gain_group.add_argument('-g', '--gain', metavar='dB', type=float_list, default='37.2',
+                            help='total gain (comma-separated list for multiple devices, '
+                                 'incompatible with -G and -a, default: %(default)s)')
     gain_group.add_argument('-G', '--specific-gains', metavar='STRING', type=specific_gains, default='',
                             help='specific gains of individual amplification elements '
                                  '(incompatible with -g and -a, example: LNA=28,VGA=12,AMP=0')
@@ -227,8 +309,9 @@ def setup_argument_parser():
                               help='ignore list of sample rates provided by device and allow any value')
     device_title.add_argument('--force-bandwidth', action='store_true',
                               help='ignore list of filter bandwidths provided by device and allow any value')
-    device_title.add_argument('--tune-delay', metavar='SECONDS', type=float, default=0,
-                              help='time to delay measurement after changing frequency (to avoid artifacts)')
+    device_title.add_argument('--tune-delay', metavar='SECONDS', type=float_list, default='0',
+                              help='time to delay measurement after changing frequency (to avoid artifacts, '
+                              'comma-separated list for multiple devices)')
     device_title.add_argument('--reset-stream', action='store_true',
                               help='reset streaming after changing frequency (to avoid artifacts)')
 
@@ -238,6 +321,22 @@ def setup_argument_parser():
                             help='percent of overlap when frequency hopping (incompatible with -k)')
     crop_group.add_argument('-k', '--crop', metavar='PERCENT', type=float, default=0,
                             help='percent of crop when frequency hopping (incompatible with -o)')
+    crop_title.add_argument('--stitch', metavar='MODE', choices=stitch.modes, default=None,
+                            help='write all hops of run as one full-band record, overlapping bins are '
+                            'averaged, taken from hop with nearest center or maximum of them is used '
+                            '({}, default: disabled)'.format(', '.join(stitch.modes)))
+
+    decimation_title = parser.add_argument_group('Output decimation')
+    decimation_group = decimation_title.add_mutually_exclusive_group()
+    decimation_group.add_argument('--decimate', metavar='FACTOR', type=int, default=1,
+                                  help='pool every FACTOR neighbouring bins to one output bin '
+                                  '(incompatible with --decimate-bins, default: %(default)s)')
+    decimation_group.add_argument('--decimate-bins', metavar='NUM', type=int, default=0,
+                                  help='pool bins to at least NUM output bins per hop (incompatible with --decimate)')
+    decimation_title.add_argument('--decimate-mode', choices=('mean', 'max', 'percentile'), default='mean',
+                                  help='pooling function (default: %(default)s)')
+    decimation_title.add_argument('--decimate-percentile', metavar='PERCENT', type=float, default=50,
+                                  help='percentile of pooled bins when using percentile pooling (default: %(default)s)')
 
     perf_title = parser.add_argument_group('Performance options')
     perf_title.add_argument('-s', '--buffer-size', type=int, default=0,
@@ -253,11 +352,71 @@ def setup_argument_parser():
 
     perf_title.add_argument('--max-threads', metavar='NUM', type=int, default=0,
                             help='maximum number of PSD threads (0 = auto, default: %(default)s)')
+    perf_title.add_argument('--psd-backend', choices=['threads', 'processes'], default='threads',
+                            help='compute PSD in threads or in worker processes with samples in shared memory '
+                                 '(--max-threads sets number of processes, default: %(default)s)')
     perf_title.add_argument('--max-queue-size', metavar='NUM', type=int, default=0,
                             help='maximum size of PSD work queue (-1 = unlimited, 0 = auto, default: %(default)s)')
+    perf_title.add_argument('--chunk-size', metavar='NUM', type=int, default=0,
+                            help='stream exact number of samples to PSD threads in chunks of NUM base buffers '
+                                 '(replaces -S, 0 = disabled, default: %(default)s)')
+    buffers_group = perf_title.add_mutually_exclusive_group()
+    buffers_group.add_argument('--max-buffers', metavar='NUM', type=int, default=0,
+                               help='number of preallocated sample buffers (min. 2, 0 = auto, '
+                               'incompatible with --memory-budget, default: %(default)s)')
+    buffers_group.add_argument('--memory-budget', metavar='BYTES', type=float_with_multiplier, default=0,
+                               help='max. size of all sample buffers in flight, number can be followed by a k, M '
+                               'or G multiplier (incompatible with --max-buffers, 0 = disabled, default: %(default)s)')
+    perf_title.add_argument('--overload', choices=('block', 'drop-newest', 'reduce-repeats'), default='block',
+                            help='what to do when PSD threads can\'t keep up and there is no free sample buffer: '
+                            'wait for it, read samples and drop them or end current hop early (first buffer '
+                            'of every hop is always processed, number of processed samples is written to output, '
+                            'default: %(default)s)')
     perf_title.add_argument('--no-pyfftw', action='store_true',
                             help='don\'t use pyfftw library even if it is available (use scipy.fftpack or numpy.fft)')
 
+    metrics_title = parser.add_argument_group('Metrics')
+    metrics_title.add_argument('--metrics', metavar='FILE', default=None,
+                               help='periodically export timing histograms and counters of all stages of sweep '
+                               'to file (default: disabled)')
+    metrics_title.add_argument('--metrics-format', choices=metrics.formats, default='prometheus',
+                               help='Prometheus text file (for textfile collector, replaced on every export) '
+                               'or JSON lines (appended, default: %(default)s)')
+    metrics_title.add_argument('--metrics-interval', metavar='SECONDS', type=float, default=10,
+                               help='interval between exports of metrics (default: %(default)s)')
+
+    profile_title = parser.add_argument_group('Profiling')
+    profile_title.add_argument('--profile', metavar='DIR', default=None,
+                               help='sample call stacks of main thread, PSD threads and writer thread and save '
+                               'per-thread reports and merged summary to directory (default: disabled)')
+    profile_title.add_argument('--profile-interval', metavar='SECONDS', type=float, default=0.005,
+                               help='sampling interval of profiler (default: %(default)s)')
+
+    daemon_title = parser.add_argument_group('Daemon')
+    daemon_title.add_argument('--daemon', metavar='SOCKET', default=None,
+                              help='keep device open and run sweep jobs received over Unix socket, other options '
+                              'are defaults of jobs (default: disabled)')
+    daemon_title.add_argument('--max-jobs', metavar='NUM', type=int, default=16,
+                              help='max. number of queued jobs (default: %(default)s)')
+
+    sim_title = parser.add_argument_group('Simulation (run without SDR hardware)')
+    sim_group = sim_title.add_mutually_exclusive_group()
+    sim_group.add_argument('--simulate', action='store_true',
+                           help='use synthetic sample source instead of SoapySDR device (incompatible with --replay)')
+    sim_group.add_argument('--replay', metavar='FILE', default=None,
+                           help='replay raw IQ samples (complex64) from file instead of SoapySDR device '
+                                '(incompatible with --simulate)')
+    sim_title.add_argument('--sim-tones', metavar='Hz:dB,...', type=tones, default='',
+                           help='frequencies and powers of simulated tones (example: 100M:-30,101.5M:-50)')
+    sim_title.add_argument('--sim-noise', metavar='dB', type=float, default=-90,
+                           help='power of simulated noise (default: %(default)s)')
+    sim_title.add_argument('--sim-overflow', metavar='PROB', type=float, default=0,
+                           help='probability of simulated buffer overflow per read (default: %(default)s)')
+    sim_title.add_argument('--sim-tuning-latency', metavar='SECONDS', type=float, default=0,
+                           help='simulated time spent by changing frequency (default: %(default)s)')
+    sim_title.add_argument('--realtime', action='store_true',
+                           help='deliver simulated or replayed samples at real sample rate')
+
     other_title = parser.add_argument_group('Other options')
     other_title.add_argument('-l', '--linear', action='store_true',
                              help='linear power values instead of logarithmic')
@@ -294,35 +453,144 @@ def main():
     )
 
     # Import soapypower.power module only after setting log level
-    from soapypower import power
+    from soapypower import power, source, daemon
 
     # Detect SoapySDR devices
+    if (args.detect or args.info) and simplesoapy is None:
+        parser.error('simplesoapy module (or SoapySDR Python bindings) not found!')
+
     if args.detect:
-        devices, devices_text = detect_devices(args.device)
+        devices, devices_text = detect_devices(args.device[0] if args.device else '')
         print(devices_text)
         sys.exit(0 if devices else 1)
 
     # Show info about selected SoapySDR device
     if args.info:
-        device, device_text = device_info(args.device)
+        device, device_text = device_info(args.device[0] if args.device else '')
         print(device_text)
         sys.exit(0 if device else 1)
 
     # Prepare arguments for SoapyPower
+    if args.output_fd is not None:
+        output = args.output_fd
+    elif args.output == '-':
+        output = sys.stdout
+    else:
+        output = args.output
+
+    if args.format == 'waterfall' and (not isinstance(output, str) or broadcast.is_address(output)):
+        parser.error('argument -F/--format: waterfall format requires path to output directory (-O)')
+
+    if (args.rotate_size or args.rotate_interval) and (
+            not isinstance(output, str) or broadcast.is_address(output) or args.format == 'waterfall'):
+        parser.error('argument --rotate-size/--rotate-interval: output rotation requires path to output file (-O) '
+                     'and can\'t be used with waterfall format')
+
+    if (args.bin_encoding != 'float32' or args.bin_compression != 'none') and args.format != 'soapy_power_bin':
+        parser.error('argument --bin-encoding/--bin-compression: can be used only with soapy_power_bin format')
+
+    if args.bin_quantization <= 0:
+        parser.error('argument --bin-quantization: quantization step must be positive')
+
+    if args.daemon and not hasattr(socket, 'AF_UNIX'):
+        parser.error('argument --daemon: Unix sockets are not supported on this platform')
+
+    if args.max_jobs < 1:
+        parser.error('argument --max-jobs: must be at least 1')
+
     if args.no_pyfftw:
         power.psd.simplespectral.use_pyfftw = False
 
-    # Create SoapyPower instance
+    # Multiple RX channels of one MIMO device are used same as multiple devices
+    mimo = len(args.channel) > 1
+    if mimo and args.device and len(args.device) > 1:
+        parser.error('argument -C/--channel: multiple RX channels can be used only with one device')
+    if len(set(args.channel)) != len(args.channel):
+        parser.error('argument -C/--channel: RX channels must be unique')
+    if mimo and args.channel_mode == 'paired':
+        if args.format in ('rtl_power', 'waterfall'):
+            parser.error('argument --channel-mode: paired mode requires output format which can tag records '
+                         'by channel (soapy_power_bin or rtl_power_fftw)')
+        if args.stitch:
+            parser.error('argument --stitch: can\'t be used with paired mode of RX channels')
+
+    # Device specific settings (one value for all devices or one value for every device)
+    devices = args.device or ['']
+    if mimo:
+        devices = devices * len(args.channel)
+    for name, values in (('-p/--ppm', args.ppm), ('-g/--gain', args.gain), ('--tune-delay', args.tune_delay)):
+        if len(values) not in (1, len(devices)):
+            parser.error('argument {}: expected 1 or {} comma-separated values (one for every device)'.format(
+                name, len(devices)
+            ))
+    ppms = args.ppm * len(devices) if len(args.ppm) == 1 else args.ppm
+    gains = args.gain * len(devices) if len(args.gain) == 1 else args.gain
+    tune_delays = args.tune_delay * len(devices) if len(args.tune_delay) == 1 else args.tune_delay
+
+    # Create simulated or real MIMO device (gain and frequency correction are same for all channels)
+    mimo_channels = [None] * len(devices)
+    if mimo:
+        if len(args.ppm) > 1 or len(args.gain) > 1:
+            parser.error('argument -p/--ppm, -g/--gain: RX channels of one device share single value')
+        if args.simulate:
+            mimo_device = source.SimulatedMimoSource(
+                channels=len(args.channel), sample_rate=args.rate, realtime=args.realtime, tones=args.sim_tones,
+                noise=args.sim_noise, overflow=args.sim_overflow, tuning_latency=args.sim_tuning_latency
+            )
+        elif args.replay:
+            parser.error('argument -C/--channel: multiple RX channels can\'t be used with --replay')
+        else:
+            try:
+                mimo_device = source.SoapyMimoSource(
+                    soapy_args=devices[0], channel_numbers=args.channel, sample_rate=args.rate,
+                    bandwidth=args.bandwidth, corr=ppms[0], gain=args.specific_gains or gains[0],
+                    auto_gain=args.agc, antenna=args.antenna, settings=args.device_settings,
+                    force_sample_rate=args.force_rate, force_bandwidth=args.force_bandwidth
+                )
+            except RuntimeError:
+                parser.error('No devices found!')
+        mimo_channels = mimo_device.channels
+
+    device_args = []
+    channel = args.channel[0]
+    for soapy_args, ppm, gain, mimo_channel in zip(devices, ppms, gains, mimo_channels):
+        # Use channel of MIMO device or create simulated or replayed sample source
+        device = mimo_channel
+        if device is not None:
+            channel = device.channel
+        elif args.simulate:
+            device = source.SimulatedSource(
+                sample_rate=args.rate, realtime=args.realtime, tones=args.sim_tones, noise=args.sim_noise,
+                overflow=args.sim_overflow, tuning_latency=args.sim_tuning_latency
+            )
+        elif args.replay:
+            device = source.FileSource(args.replay, sample_rate=args.rate, realtime=args.realtime)
+
+        device_args.append({
+            'soapy_args': soapy_args, 'corr': ppm, 'gain': args.specific_gains if args.specific_gains else gain,
+            'device': device, 'channel': channel,
+        })
+
+    # Create SoapyPower instance (or MultiSoapyPower instance for multiple devices)
     try:
-        sdr = power.SoapyPower(
-            soapy_args=args.device, sample_rate=args.rate, bandwidth=args.bandwidth, corr=args.ppm,
-            gain=args.specific_gains if args.specific_gains else args.gain, auto_gain=args.agc,
-            channel=args.channel, antenna=args.antenna, settings=args.device_settings,
+        sdr_args = dict(
+            sample_rate=args.rate, bandwidth=args.bandwidth, auto_gain=args.agc,
+            antenna=args.antenna, settings=args.device_settings,
             force_sample_rate=args.force_rate, force_bandwidth=args.force_bandwidth,
-            output=args.output_fd if args.output_fd is not None else args.output,
-            output_format=args.format
+            output=output, output_format=args.format, output_precision=args.precision,
+            output_flush_hops=args.flush_hops, output_flush_interval=args.flush_interval,
+            output_rotate_size=int(args.rotate_size), output_rotate_interval=args.rotate_interval,
+            output_client_queue_size=args.client_queue_size, output_client_overflow=args.client_overflow,
+            output_bin_encoding=args.bin_encoding, output_bin_compression=args.bin_compression,
+            output_bin_quantization=args.bin_quantization
         )
-        logger.info('Using device: {}'.format(sdr.device.hardware))
+        if len(device_args) > 1:
+            sdr = power.MultiSoapyPower(device_args, tune_delays=tune_delays, tag_channels=mimo,
+                                        paired=mimo and args.channel_mode == 'paired', **sdr_args)
+            logger.info('Using devices: {}'.format(', '.join(s.device.hardware for s in sdr.sdrs)))
+        else:
+            sdr = power.SoapyPower(**dict(sdr_args, **device_args[0]))
+            logger.info('Using device: {}'.format(sdr.device.hardware))
     except RuntimeError:
         parser.error('No devices found!')
 
@@ -362,16 +630,39 @@ def main():
             parser.error('argument --fft-window: --fft-window-param is required when using kaiser or tukey windows')
         args.fft_window = (args.fft_window, args.fft_window_param)
 
-    # Start frequency sweep
-    sdr.sweep(
-        args.freq[0], args.freq[1], args.bins, args.repeats,
-        runs=args.runs, time_limit=args.elapsed, overlap=args.overlap, crop=args.crop,
-        fft_window=args.fft_window, fft_overlap=args.fft_overlap / 100, log_scale=not args.linear,
-        remove_dc=args.remove_dc, detrend=args.detrend if args.detrend != 'none' else None,
-        lnb_lo=args.lnb_lo, tune_delay=args.tune_delay, reset_stream=args.reset_stream,
-        base_buffer_size=args.buffer_size, max_buffer_size=args.max_buffer_size,
-        max_threads=args.max_threads, max_queue_size=args.max_queue_size
-    )
+    # Export metrics periodically during frequency sweep
+    metrics_exporter = None
+    if args.metrics:
+        metrics_exporter = metrics.MetricsExporter(sdr.metrics, args.metrics, format=args.metrics_format,
+                                                   interval=args.metrics_interval)
+        metrics_exporter.start()
+
+    # Start frequency sweep (or run sweep jobs received by daemon)
+    try:
+        sweep_args = dict(
+            min_freq=args.freq[0], max_freq=args.freq[1], bins=args.bins, repeats=args.repeats,
+            runs=args.runs, time_limit=args.elapsed, overlap=args.overlap, crop=args.crop,
+            fft_window=args.fft_window, fft_overlap=args.fft_overlap / 100, log_scale=not args.linear,
+            remove_dc=args.remove_dc, detrend=args.detrend if args.detrend != 'none' else None,
+            lnb_lo=args.lnb_lo, tune_delay=tune_delays[0], reset_stream=args.reset_stream,
+            base_buffer_size=args.buffer_size, max_buffer_size=args.max_buffer_size,
+            max_threads=args.max_threads, max_queue_size=args.max_queue_size, max_buffers=args.max_buffers,
+            psd_backend=args.psd_backend, chunk_size=args.chunk_size, adaptive=args.adaptive,
+            max_revisit=args.max_revisit, activity_threshold=args.activity_threshold, stitch_mode=args.stitch,
+            detector=args.detector, detector_alpha=args.detector_alpha, detector_runs=args.detector_runs,
+            detector_interval=args.detector_interval, decimation=args.decimate, decimation_bins=args.decimate_bins,
+            decimation_mode=args.decimate_mode, decimation_percentile=args.decimate_percentile,
+            profile_dir=args.profile, profile_interval=args.profile_interval,
+            memory_budget=args.memory_budget, overload_policy=args.overload
+        )
+        if args.daemon:
+            daemon.SweepDaemon(sdr, args.daemon, sweep_args, max_jobs=args.max_jobs,
+                               even=args.even, pow2=args.pow2).serve()
+        else:
+            sdr.sweep(**sweep_args)
+    finally:
+        if metrics_exporter:
+            metrics_exporter.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import os, sys, io, time, json, logging, argparse, tempfile, platform, datetime, subprocess, contextlib
+
+import numpy
+import simplespectral
+
+from soapypower import psd, writer, source
+from soapypower.__main__ import freq_or_freq_range, float_with_multiplier
+from soapypower.version import __version__
+
+logger = logging.getLogger(__name__)
+
+fft_backends = ('pyfftw', 'scipy', 'numpy')
+
+
+@contextlib.contextmanager
+def fft_backend(backend):
+    """Temporarily select FFT backend used by simplespectral"""
+    if backend == 'pyfftw' and not simplespectral.fft_pyfftw:
+        raise RuntimeError('pyfftw module not found!')
+    if backend == 'scipy' and not simplespectral.fft_scipy:
+        raise RuntimeError('scipy module not found!')
+
+    use_pyfftw, fft_scipy = simplespectral.use_pyfftw, simplespectral.fft_scipy
+    simplespectral.use_pyfftw = backend == 'pyfftw'
+    simplespectral.fft_scipy = backend == 'scipy'
+    try:
+        yield
+    finally:
+        simplespectral.use_pyfftw, simplespectral.fft_scipy = use_pyfftw, fft_scipy
+
+
+def measure(fn, min_time=1, min_iterations=3):
+    """Call fn repeatedly for at least min_time seconds, return list of durations of individual calls"""
+    durations = []
+    t_start = time.perf_counter()
+    while len(durations) < min_iterations or time.perf_counter() - t_start < min_time:
+        t = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - t)
+    return durations
+
+
+def make_result(benchmark, params, durations, items, unit):
+    """Create benchmark result record (items are processed per one call)"""
+    mean = sum(durations) / len(durations)
+    best = min(durations)
+    return {
+        'benchmark': benchmark,
+        'params': params,
+        'iterations': len(durations),
+        'time_mean': mean,
+        'time_best': best,
+        'throughput': items / mean,
+        'throughput_best': items / best,
+        'unit': unit,
+    }
+
+
+def random_samples(size, seed=0):
+    """Return array of complex64 gaussian noise samples"""
+    rng = numpy.random.RandomState(seed)
+    return (rng.standard_normal(size) + 1j * rng.standard_normal(size)).astype(numpy.complex64)
+
+
+def bench_welch(bins, fft_window='hann', fft_overlap=0.5, backend='numpy', buffer_size=2**20,
+                sample_rate=2.00e6, min_time=1):
+    """Benchmark PSD computation (psd.PSD.update and psd.PSD.result) of one buffer of samples"""
+    samples = random_samples(buffer_size)
+    psd_obj = psd.PSD(bins, sample_rate, fft_window=fft_window, fft_overlap=fft_overlap, max_threads=1)
+
+    def run():
+        psd_state = psd_obj.set_center_freq(100e6)
+        psd_obj.update(psd_state, samples)
+        freq_array, pwr_array = psd_obj.result(psd_state)
+        psd_obj.release_result(pwr_array)
+
+    try:
+        with fft_backend(backend):
+            run()
+            durations = measure(run, min_time=min_time)
+    finally:
+        psd_obj.shutdown()
+
+    params = {'bins': bins, 'fft_window': fft_window, 'fft_overlap': fft_overlap, 'backend': backend,
+              'buffer_size': buffer_size}
+    return make_result('welch', params, durations, buffer_size, 'samples/s')
+
+
+def bench_writer(output_format, bins, hops=100, min_time=1):
+    """Benchmark writing of PSD data in given output format"""
+    rng = numpy.random.RandomState(0)
+    f_arrays = [numpy.fft.fftshift(numpy.fft.fftfreq(bins, 1 / 2.00e6)) + 100e6 + i * 2.00e6 for i in range(hops)]
+    pwr_array = (rng.standard_normal(bins) - 100).astype(numpy.float32)
+    time_start = datetime.datetime.utcnow()
+    time_stop = datetime.datetime.utcnow()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Waterfall store is written to directory, other formats to memory
+        if output_format == 'waterfall':
+            output = os.path.join(tmpdir, 'waterfall')
+            bytes_per_hop = bins * pwr_array.itemsize
+        else:
+            output = io.BytesIO()
+
+        psd_writer = writer.formats[output_format](output)
+
+        def run():
+            if output_format != 'waterfall':
+                output.seek(0)
+                output.truncate()
+            for f_array in f_arrays:
+                psd_writer.write((f_array, pwr_array), time_start, time_stop, bins)
+            psd_writer.write_next()
+
+        run()
+        durations = measure(run, min_time=min_time)
+        psd_writer._executor.shutdown()
+        psd_writer.close()
+
+        if output_format != 'waterfall':
+            bytes_per_hop = output.tell() / hops
+
+    params = {'format': output_format, 'bins': bins, 'hops': hops, 'bytes_per_hop': bytes_per_hop}
+    return make_result('writer', params, durations, hops * bins, 'bins/s')
+
+
+def bench_sweep(min_freq, max_freq, bins, repeats, runs=1, sample_rate=2.00e6, output_format='soapy_power_bin',
+                realtime=False, max_threads=0, fft_overlap=0.5):
+    """Benchmark end-to-end frequency sweep (SoapyPower.sweep) with simulated sample source
+
+    Samples per second are samples of all FFT segments computed by Welch's method (overlapping
+    samples are counted in every segment which contains them).
+    """
+    from soapypower import power
+
+    device = source.SimulatedSource(sample_rate=sample_rate, realtime=realtime, tones=[((min_freq + max_freq) / 2, -40)])
+    with open(os.devnull, 'w') as output:
+        sdr = power.SoapyPower(output=output, output_format=output_format, device=device)
+        hops = len(sdr.freq_plan(min_freq, max_freq, bins, quiet=True))
+
+        t_start = time.perf_counter()
+        sdr.sweep(min_freq, max_freq, bins, repeats, runs=runs, max_threads=max_threads, fft_overlap=fft_overlap,
+                  keep_open=True)
+        duration = time.perf_counter() - t_start
+
+        # Number of samples read per hop is rounded up to whole buffers
+        segments = sdr._psd._welch.segments(sdr._hop_samples)
+        sdr.stop()
+
+    params = {'min_freq': min_freq, 'max_freq': max_freq, 'bins': bins, 'repeats': repeats, 'runs': runs,
+              'hops': hops, 'sample_rate': sample_rate, 'format': output_format, 'realtime': realtime,
+              'fft_overlap': fft_overlap, 'segments_per_hop': segments, 'overflows': device.buffer_overflow_count}
+    result = make_result('sweep', params, [duration], hops * runs, 'hops/s')
+    result['samples_per_second'] = (hops * runs * segments * bins) / duration
+    return result
+
+
+def host_info():
+    """Return info about host and software versions"""
+    info = {
+        'soapy_power': __version__,
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'simplespectral': simplespectral.__version__,
+        'pyfftw': simplespectral.fft_pyfftw,
+        'scipy': simplespectral.fft_scipy,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'hostname': platform.node(),
+        'time': datetime.datetime.utcnow().isoformat(),
+    }
+
+    try:
+        info['git_commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['git_commit'] = None
+
+    return info
+
+
+def int_list(string):
+    """Convert comma separated string to list of integers"""
+    return [int(x) for x in string.split(',') if x.strip()]
+
+
+def float_list(string):
+    """Convert comma separated string to list of floats"""
+    return [float(x) for x in string.split(',') if x.strip()]
+
+
+def str_list(string):
+    """Convert comma separated string to list of strings"""
+    return [x.strip() for x in string.split(',') if x.strip()]
+
+
+def setup_argument_parser():
+    """Setup command line parser"""
+    parser = argparse.ArgumentParser(
+        prog='soapy_power_bench',
+        description='Benchmark soapy_power PSD computation, writers and frequency sweep'
+    )
+    parser.add_argument('-O', '--output', metavar='FILE', type=argparse.FileType('w'), default=sys.stdout,
+                        help='write JSON results to file (default is stdout)')
+    parser.add_argument('--suites', type=str_list, default='welch,writer,sweep',
+                        help='comma separated list of benchmark suites to run (default: %(default)s)')
+    parser.add_argument('--min-time', metavar='SECONDS', type=float, default=1,
+                        help='minimal duration of every benchmark case (default: %(default)s)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='limit verbosity')
+
+    welch_title = parser.add_argument_group('Welch\'s method benchmark')
+    welch_title.add_argument('--bins', type=int_list, default='512,4096,65536',
+                             help='comma separated list of numbers of FFT bins (default: %(default)s)')
+    welch_title.add_argument('--fft-windows', type=str_list, default='hann,boxcar',
+                             help='comma separated list of window functions (default: %(default)s)')
+    welch_title.add_argument('--fft-overlaps', metavar='PERCENTS', type=float_list, default='0,50',
+                             help='comma separated list of overlaps between segments (default: %(default)s)')
+    welch_title.add_argument('--fft-backends', type=str_list, default=','.join(fft_backends),
+                             help='comma separated list of FFT backends, unavailable backends are skipped '
+                                  '(default: %(default)s)')
+    welch_title.add_argument('--buffer-size', type=int, default=2**20,
+                             help='number of samples in one buffer (default: %(default)s)')
+
+    writer_title = parser.add_argument_group('Writer benchmark')
+    writer_title.add_argument('--formats', type=str_list, default=','.join(sorted(writer.formats.keys())),
+                              help='comma separated list of output formats (default: %(default)s)')
+    writer_title.add_argument('--writer-bins', type=int_list, default='512,16384',
+                              help='comma separated list of numbers of bins per hop (default: %(default)s)')
+
+    sweep_title = parser.add_argument_group('Sweep benchmark (simulated sample source)')
+    sweep_title.add_argument('-f', '--freq', metavar='Hz:Hz', type=freq_or_freq_range, default='88M:108M',
+                             help='frequency range to scan (default: %(default)s)')
+    sweep_title.add_argument('-r', '--rate', metavar='Hz', type=float_with_multiplier, default=2e6,
+                             help='sample rate (default: %(default)s)')
+    sweep_title.add_argument('-b', '--sweep-bins', type=int, default=512,
+                             help='number of FFT bins (default: %(default)s)')
+    sweep_title.add_argument('-n', '--repeats', type=int, default=1600,
+                             help='number of spectra to average (default: %(default)s)')
+    sweep_title.add_argument('-u', '--runs', type=int, default=3,
+                             help='number of measurements (default: %(default)s)')
+    sweep_title.add_argument('-F', '--format', choices=sorted(writer.formats.keys()), default='soapy_power_bin',
+                             help='output format (default: %(default)s)')
+    sweep_title.add_argument('--realtime', action='store_true',
+                             help='deliver simulated samples at real sample rate')
+    sweep_title.add_argument('--max-threads', metavar='NUM', type=int, default=0,
+                             help='maximum number of PSD threads (0 = auto, default: %(default)s)')
+
+    return parser
+
+
+def main():
+    # Parse command line arguments
+    parser = setup_argument_parser()
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.WARNING if args.quiet else logging.INFO,
+        format='%(levelname)s: %(message)s'
+    )
+    # Don't flood output with debug and info messages from measured code
+    logging.getLogger('soapypower').setLevel(logging.WARNING)
+
+    results = []
+
+    def run(fn, *fn_args, **fn_kwargs):
+        try:
+            result = fn(*fn_args, **fn_kwargs)
+        except RuntimeError as e:
+            logger.warning('Skipping benchmark {} {}: {}'.format(fn.__name__, fn_kwargs, e))
+            return
+        logger.info('{}: {} ... {:.1f} {}'.format(result['benchmark'], result['params'],
+                                                   result['throughput'], result['unit']))
+        results.append(result)
+
+    if 'welch' in args.suites:
+        for backend in args.fft_backends:
+            for fft_window in args.fft_windows:
+                for fft_overlap in args.fft_overlaps:
+                    for bins in args.bins:
+                        run(bench_welch, bins=bins, fft_window=fft_window, fft_overlap=fft_overlap / 100,
+                            backend=backend, buffer_size=args.buffer_size, min_time=args.min_time)
+
+    if 'writer' in args.suites:
+        for output_format in args.formats:
+            for bins in args.writer_bins:
+                run(bench_writer, output_format, bins, min_time=args.min_time)
+
+    if 'sweep' in args.suites:
+        if len(args.freq) < 2:
+            args.freq = [args.freq[0], args.freq[0]]
+        run(bench_sweep, args.freq[0], args.freq[1], args.sweep_bins, args.repeats, runs=args.runs,
+            sample_rate=args.rate, output_format=args.format, realtime=args.realtime,
+            max_threads=args.max_threads)
+
+    json.dump({'host': host_info(), 'results': results}, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
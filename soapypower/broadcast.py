@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import os, socket, logging, threading, collections, urllib.parse
+
+logger = logging.getLogger(__name__)
+
+overflow_policies = ('drop-oldest', 'disconnect')
+
+
+def is_address(output):
+    """Is output network address (tcp://HOST:PORT or unix://PATH)?"""
+    return isinstance(output, str) and output.startswith(('tcp://', 'unix://'))
+
+
+def parse_address(address):
+    """Parse tcp://HOST:PORT or unix://PATH address, return (socket family, socket address)"""
+    url = urllib.parse.urlsplit(address)
+    if url.scheme == 'tcp':
+        if url.port is None:
+            raise ValueError('Port number is missing in address: {}'.format(address))
+        host = url.hostname or ''
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        return (family, (host, url.port))
+    if url.scheme == 'unix':
+        return (socket.AF_UNIX, url.netloc + url.path)
+    raise ValueError('Unsupported address: {}'.format(address))
+
+
+class Client:
+    """Connected client with its own bounded queue of messages"""
+    def __init__(self, server, sock, address, max_queue_size, overflow):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+
+        # deque with maxlen silently drops oldest message when new one is appended to full queue
+        self._queue = collections.deque(maxlen=max_queue_size)
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='Broadcast_client_{}'.format(address), daemon=True)
+        self._thread.start()
+
+    def put(self, message):
+        """Add message to queue (never blocks, returns False if client has been disconnected)"""
+        with self._condition:
+            if self.closed:
+                return False
+            if len(self._queue) == self._queue.maxlen:
+                if self.overflow == 'disconnect':
+                    logger.warning('Client {} is too slow, disconnecting it'.format(self.address))
+                    self.closed = True
+                    self._queue.clear()
+                    self._condition.notify()
+                    return False
+                self.dropped += 1
+            self._queue.append(message)
+            self._condition.notify()
+        return True
+
+    def close(self):
+        """Close connection after all queued messages are sent"""
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+    def join(self, timeout=None):
+        """Wait for client thread to finish"""
+        self._thread.join(timeout)
+
+    def _run(self):
+        """Send queued messages to client (runs in separate thread)"""
+        try:
+            while True:
+                with self._condition:
+                    while not self._queue and not self.closed:
+                        self._condition.wait()
+                    if not self._queue:
+                        break
+                    message = self._queue.popleft()
+                self.sock.sendall(message)
+        except OSError as e:
+            logger.info('Client {} disconnected: {}'.format(self.address, e))
+        finally:
+            with self._condition:
+                self.closed = True
+                self._queue.clear()
+            self.sock.close()
+            if self.dropped:
+                logger.warning('Dropped {} messages for client {}'.format(self.dropped, self.address))
+            self.server.remove_client(self)
+
+
+class BroadcastServer:
+    """TCP or Unix socket server sending every written message to all connected clients
+
+    Every call of write() is one message (it is either sent whole or dropped whole). Slow clients
+    never block writer, every client has its own bounded queue and when it is full, oldest message
+    is dropped (drop-oldest policy) or client is disconnected (disconnect policy).
+    """
+    def __init__(self, address, max_queue_size=100, overflow='drop-oldest'):
+        if overflow not in overflow_policies:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+
+        self.address = address
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.clients = []
+
+        self._lock = threading.Lock()
+        self._closed = False
+
+        family, sock_address = parse_address(address)
+        self._unix_path = sock_address if family == socket.AF_UNIX else None
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(sock_address)
+        self._sock.listen()
+        logger.info('Listening on {}'.format(self.name))
+
+        self._thread = threading.Thread(target=self._accept, name='Broadcast_server', daemon=True)
+        self._thread.start()
+
+    @property
+    def name(self):
+        """Address of listening socket (with real port number if port 0 was requested, read-only)"""
+        if self._unix_path:
+            return 'unix://{}'.format(self._unix_path)
+        host, port = self._sock.getsockname()[:2]
+        return 'tcp://{}:{}'.format('[{}]'.format(host) if ':' in host else host, port)
+
+    def _accept(self):
+        """Accept new clients (runs in separate thread)"""
+        while True:
+            try:
+                sock, address = self._sock.accept()
+            except OSError:
+                # Listening socket has been closed
+                break
+
+            address = address or self._unix_path
+            logger.info('Client {} connected'.format(address))
+            with self._lock:
+                if self._closed:
+                    sock.close()
+                    break
+                self.clients.append(Client(self, sock, address, self.max_queue_size, self.overflow))
+
+    def remove_client(self, client):
+        """Remove disconnected client"""
+        with self._lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def write(self, data):
+        """Send message to all connected clients (never blocks)"""
+        data = bytes(data)
+        with self._lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.put(data)
+        return len(data)
+
+    def flush(self):
+        """Messages are sent as soon as possible by client threads"""
+        pass
+
+    def close(self, timeout=5):
+        """Stop listening, send remaining queued messages and disconnect all clients"""
+        with self._lock:
+            self._closed = True
+            clients = list(self.clients)
+
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._thread.join(timeout)
+        if self._unix_path:
+            os.unlink(self._unix_path)
+
+        for client in clients:
+            client.close()
+        for client in clients:
+            client.join(timeout)
+
+
+def read_frames(address, timeout=None):
+    """Connect to BroadcastServer and yield received soapy_power_bin frames as (header, pwr_array) tuples"""
+    from soapypower.writer import SoapyPowerBinFormat
+
+    family, sock_address = parse_address(address)
+    formatter = SoapyPowerBinFormat()
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(sock_address)
+        with sock.makefile('rb') as f:
+            while True:
+                frame = formatter.read(f)
+                if frame is None:
+                    break
+                yield frame
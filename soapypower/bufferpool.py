@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import queue, logging
+from multiprocessing import shared_memory
+
+import numpy
+from simplespectral import zeros
+
+logger = logging.getLogger(__name__)
+
+
+class SharedArray(numpy.ndarray):
+    """Numpy array backed by shared memory segment (can be passed to other processes by name)"""
+    def __array_finalize__(self, obj):
+        self.shm_name = getattr(obj, 'shm_name', None)
+        self.shm_address = getattr(obj, 'shm_address', None)
+
+    @property
+    def shm_offset(self):
+        """Offset of array data in shared memory segment [B] (read-only)"""
+        return self.ctypes.data - self.shm_address
+
+
+def attach_shared_memory(name):
+    """Attach existing shared memory segment (segment is unlinked by process which created it)"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 doesn't support track argument, but worker processes share resource
+        # tracker with main process, so segment is unregistered by unlink() in main process
+        return shared_memory.SharedMemory(name=name)
+
+
+class BufferPool:
+    """Bounded pool of preallocated (recycled) sample buffers"""
+    def __init__(self, buffer_size, buffer_count, dtype=numpy.complex64, shared=False, grow=False):
+        """Create pool of buffers
+
+        grow ... allocate new buffer instead of waiting when there is no free buffer in pool
+        """
+        self.buffer_size = buffer_size
+        self.buffer_count = buffer_count
+        self.dtype = numpy.dtype(dtype)
+        self.shared = shared
+        self.grow = grow
+        self.wait_count = 0
+
+        self._shared_memory = []
+        self._free = queue.LifoQueue()
+        for i in range(buffer_count):
+            self._free.put(self._create_buffer())
+
+    def _create_buffer(self):
+        """Allocate new buffer (in shared memory if requested)"""
+        if not self.shared:
+            return zeros(self.buffer_size, self.dtype)
+
+        shm = shared_memory.SharedMemory(create=True, size=self.buffer_size * self.dtype.itemsize)
+        self._shared_memory.append(shm)
+        buffer = numpy.ndarray(self.buffer_size, self.dtype, buffer=shm.buf).view(SharedArray)
+        buffer.shm_name = shm.name
+        buffer.shm_address = buffer.ctypes.data
+        buffer.fill(0)
+        return buffer
+
+    @property
+    def nbytes(self):
+        """Total size of all buffers in pool [B] (read-only)"""
+        return self.buffer_size * self.buffer_count * self.dtype.itemsize
+
+    @property
+    def free_count(self):
+        """Number of buffers available in pool (read-only)"""
+        return self._free.qsize()
+
+    def acquire(self, block=True, timeout=None):
+        """Get free buffer from pool (waits for buffer to be released if there is none available)"""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            if self.grow:
+                self.buffer_count += 1
+                return self._create_buffer()
+            if not block:
+                raise
+            self.wait_count += 1
+        return self._free.get(timeout=timeout)
+
+    def release(self, buffer):
+        """Return buffer back to pool"""
+        self._free.put(buffer)
+
+    def release_when_done(self, future, buffer):
+        """Return buffer back to pool after future is done"""
+        future.add_done_callback(lambda f: self.release(buffer))
+
+    def close(self):
+        """Release all buffers (and unlink shared memory segments)"""
+        while True:
+            try:
+                self._free.get_nowait()
+            except queue.Empty:
+                break
+
+        for shm in self._shared_memory:
+            try:
+                shm.close()
+            except BufferError:
+                # Buffer is still referenced somewhere, memory will be released by garbage collector
+                pass
+            shm.unlink()
+        self._shared_memory = []
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import os, time, json, queue, socket, logging, threading, socketserver
+
+from soapypower import power, writer
+
+logger = logging.getLogger(__name__)
+
+# Parameters of sweep which can be set by job (other parameters are given when daemon is started)
+job_params = ('min_freq', 'max_freq', 'bins', 'repeats', 'runs', 'time_limit')
+
+
+class SweepJob:
+    """Sweep job received from client"""
+    def __init__(self, job_id, params, output, output_format, reply):
+        self.id = job_id
+        self.params = params
+        self.output = output
+        self.output_format = output_format
+        self.reply = reply
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """Read jobs (one JSON object per line) from client and send back JSON status messages"""
+    def handle(self):
+        lock = threading.Lock()
+
+        def reply(message):
+            """Send status message to client (client may have already disconnected)"""
+            try:
+                with lock:
+                    self.wfile.write((json.dumps(message) + '\n').encode())
+                    self.wfile.flush()
+            except (OSError, ValueError):
+                pass
+
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode())
+                if not isinstance(request, dict):
+                    raise ValueError('Request must be JSON object')
+            except ValueError as e:
+                reply({'status': 'error', 'error': 'Invalid request: {}'.format(e)})
+                continue
+            self.server.daemon.handle_request(request, reply)
+
+
+class UnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server handling every client in separate thread"""
+    daemon_threads = True
+
+
+class SweepDaemon:
+    """Persistent sweep daemon accepting sweep jobs over local Unix socket
+
+    Device is opened only once and jobs are run one after another in main thread. Stream, sample
+    buffers and PSD calculator (with its threads and FFT plans) are kept between jobs and reused
+    whenever parameters of next job need the same setup (see SoapyPower.setup()).
+
+    Every job is one JSON object per line, e.g. {"min_freq": 88e6, "max_freq": 108e6, "bins": 512,
+    "repeats": 1000, "runs": 1, "output": "/tmp/output.csv", "format": "rtl_power"}. Keys which
+    are not given are taken from default sweep arguments. Daemon replies with JSON status messages
+    (queued, running, done or error) tagged by job id. Requests {"command": "status"} and
+    {"command": "shutdown"} return state of queue and stop daemon. Number of bins of job is rounded
+    same as number of bins given on command line (even or power of two).
+    """
+    def __init__(self, sdr, path, sweep_args, max_jobs=16, even=False, pow2=False):
+        self.sdr = sdr
+        self.path = path
+        self.sweep_args = sweep_args
+        self.even = even
+        self.pow2 = pow2
+        self.output_format = sdr._output_format
+
+        self._jobs = queue.Queue(max_jobs)
+        self._job_id = 0
+        self._job_id_lock = threading.Lock()
+        self._current_job = None
+        self._stop = threading.Event()
+        self._server = None
+        self._server_thread = None
+
+    def start(self):
+        """Start listening on Unix socket (in separate thread)"""
+        if os.path.exists(self.path) and not os.path.isdir(self.path):
+            # Remove stale socket left by previous daemon (only if nobody is listening on it)
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(self.path)
+                except OSError:
+                    os.remove(self.path)
+                else:
+                    raise RuntimeError('Another daemon is already listening on {}'.format(self.path))
+
+        self._server = UnixStreamServer(self.path, JobRequestHandler)
+        self._server.daemon = self
+        self._server_thread = threading.Thread(target=self._server.serve_forever, name='Daemon_server', daemon=True)
+        self._server_thread.start()
+        logger.info('Listening for sweep jobs on {}'.format(self.path))
+
+    def close(self):
+        """Stop listening, reject queued jobs and stop device"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            os.remove(self.path)
+
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            job.reply({'id': job.id, 'status': 'error', 'error': 'Daemon is shutting down'})
+
+        self.sdr.stop()
+
+    def handle_request(self, request, reply):
+        """Handle request of client (runs in thread of client)"""
+        command = request.pop('command', 'sweep')
+        if command == 'status':
+            current_job = self._current_job
+            reply({'status': 'ok', 'running': current_job.id if current_job else None, 'queued': self._jobs.qsize()})
+        elif command == 'shutdown':
+            self._stop.set()
+            reply({'status': 'ok'})
+        elif command == 'sweep':
+            try:
+                job = self.create_job(request, reply)
+            except (TypeError, ValueError) as e:
+                reply({'status': 'error', 'error': str(e)})
+                return
+            try:
+                self._jobs.put_nowait(job)
+            except queue.Full:
+                reply({'id': job.id, 'status': 'error', 'error': 'Job queue is full'})
+                return
+            reply({'id': job.id, 'status': 'queued', 'position': self._jobs.qsize()})
+        else:
+            reply({'status': 'error', 'error': 'Unknown command: {}'.format(command)})
+
+    def create_job(self, request, reply):
+        """Validate parameters of job and create it"""
+        output = request.pop('output', None)
+        if not output or not isinstance(output, str):
+            raise ValueError('Output (path or address) is required')
+        output_format = request.pop('format', self.output_format)
+        if output_format not in writer.formats:
+            raise ValueError('Unknown output format: {}'.format(output_format))
+
+        unknown = set(request) - set(job_params)
+        if unknown:
+            raise ValueError('Unknown parameters: {}'.format(', '.join(sorted(unknown))))
+        params = {}
+        for name, value in request.items():
+            params[name] = int(value) if name in ('bins', 'repeats', 'runs') else float(value)
+            if params[name] < 0 or (name in ('bins', 'repeats') and params[name] == 0):
+                raise ValueError('Invalid value of {}: {}'.format(name, value))
+        if (params.get('runs', self.sweep_args.get('runs')) == 0 and
+                not params.get('time_limit', self.sweep_args.get('time_limit'))):
+            raise ValueError('Endless jobs are not allowed (set runs or time_limit)')
+
+        if 'bins' in params:
+            params['bins'] = self.sdr.nearest_bins(params['bins'], even=self.even, pow2=self.pow2)
+            if self.sweep_args.get('overlap'):
+                params['overlap'] = self.sdr.nearest_overlap(self.sweep_args['overlap'], params['bins'])
+
+        with self._job_id_lock:
+            self._job_id += 1
+            return SweepJob(self._job_id, params, output, output_format, reply)
+
+    def serve(self):
+        """Run queued jobs until daemon is stopped (by shutdown command, SIGTERM or SIGINT)"""
+        self.start()
+        try:
+            while not self._stop.is_set() and not power._shutdown:
+                try:
+                    job = self._jobs.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                self.run_job(job)
+        finally:
+            self.close()
+
+    def run_job(self, job):
+        """Run sweep job (device stream, sample buffers and PSD calculator are kept for next job)"""
+        self._current_job = job
+        job.reply({'id': job.id, 'status': 'running'})
+        logger.info('Running job {} (output: {})'.format(job.id, job.output))
+        t_start = time.time()
+        try:
+            self.sdr.set_output(job.output, job.output_format)
+            self.sdr.sweep(**dict(self.sweep_args, keep_open=True, **job.params))
+        except Exception as e:
+            logger.exception('Job {} failed: {}'.format(job.id, e))
+            self._current_job = None
+            job.reply({'id': job.id, 'status': 'error', 'error': str(e)})
+        else:
+            # Job must not be reported as running anymore when client receives final reply
+            self._current_job = None
+            job.reply({'id': job.id, 'status': 'done', 'time': time.time() - t_start})
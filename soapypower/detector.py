@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import numpy
+
+modes = ('max', 'min', 'ema', 'average')
+
+
+class Detector:
+    """Combine PSD of one frequency hop across runs (in linear scale, updated in place)
+
+    max / min ... max-hold / min-hold since last output
+    ema ... exponential moving average with given alpha (never reset)
+    average ... linear average since last output
+    """
+    def __init__(self, mode, bins, alpha=0.1):
+        if mode not in modes:
+            raise ValueError('Unknown detector mode: {}'.format(mode))
+        self.mode = mode
+        self.alpha = alpha
+        self.count = 0
+
+        dtype = numpy.float32 if mode in ('max', 'min') else numpy.float64
+        self.pwr_array = numpy.zeros(bins, dtype)
+        self._scratch = numpy.zeros(bins, dtype) if mode == 'ema' else None
+
+    def update(self, pwr_array):
+        """Add PSD of new run"""
+        if not self.count:
+            self.pwr_array[:] = pwr_array
+        elif self.mode == 'max':
+            numpy.maximum(self.pwr_array, pwr_array, out=self.pwr_array)
+        elif self.mode == 'min':
+            numpy.minimum(self.pwr_array, pwr_array, out=self.pwr_array)
+        elif self.mode == 'average':
+            self.pwr_array += pwr_array
+        else:
+            numpy.multiply(pwr_array, self.alpha, out=self._scratch)
+            self.pwr_array *= 1 - self.alpha
+            self.pwr_array += self._scratch
+        self.count += 1
+
+    def output(self, out):
+        """Write detected PSD to out array (and reset detector, except of EMA)"""
+        if self.mode == 'average':
+            numpy.divide(self.pwr_array, self.count, out=out)
+        else:
+            out[:] = self.pwr_array
+
+        if self.mode != 'ema':
+            self.count = 0
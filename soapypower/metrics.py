@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import os, time, json, bisect, logging, threading
+
+logger = logging.getLogger(__name__)
+
+formats = ('prometheus', 'json')
+
+# Default histogram buckets [s]
+default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    """Monotonically increasing counter (thread-safe)"""
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, value=1):
+        """Increase counter by value"""
+        with self._lock:
+            self.value += value
+
+    def snapshot(self):
+        """Return current value of counter"""
+        with self._lock:
+            return self.value
+
+
+class Histogram:
+    """Histogram of observed values with fixed buckets (thread-safe)"""
+    def __init__(self, name, help='', buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all observed values"""
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """Add observed value to histogram"""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        """Return dict with count, sum, min, max, mean and cumulative bucket counts"""
+        with self._lock:
+            counts = list(self.counts)
+            snapshot = {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+        snapshot['mean'] = snapshot['sum'] / snapshot['count'] if snapshot['count'] else None
+
+        cumulative = 0
+        snapshot['buckets'] = []
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            snapshot['buckets'].append((bound, cumulative))
+        return snapshot
+
+
+class Metrics:
+    """Counters and histograms of timing of all stages of frequency sweep"""
+    prefix = 'soapy_power_'
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        for name, help in (
+            ('tune_seconds', 'Time of tuning to new frequency (including tune delay)'),
+            ('tune_delay_seconds', 'Time of reading and discarding samples after tuning'),
+            ('buffer_wait_seconds', 'Time of waiting for free sample buffer'),
+            ('acquisition_seconds', 'Time of reading samples into one buffer'),
+            ('psd_queue_wait_seconds', 'Time spent by PSD task in work queue'),
+            ('fft_seconds', 'Time of PSD computation of one buffer'),
+            ('writer_queue_wait_seconds', 'Time spent by writer task in work queue'),
+            ('write_seconds', 'Time of writing PSD of one hop'),
+            ('hop_seconds', 'Total time of one frequency hop'),
+        ):
+            self.histograms[name] = Histogram(name, help)
+        for name, help in (
+            ('samples_total', 'Number of acquired samples'),
+            ('hops_total', 'Number of measured frequency hops'),
+            ('runs_total', 'Number of finished runs'),
+            ('buffer_overflows_total', 'Number of buffer overflow errors of device'),
+            ('dropped_buffers_total', 'Number of sample buffers dropped or skipped due to overload'),
+            ('dropped_samples_total', 'Number of samples dropped or skipped due to overload'),
+        ):
+            self.counters[name] = Counter(name, help)
+
+    def observe(self, name, value):
+        """Add observed value to histogram"""
+        self.histograms[name].observe(value)
+
+    def inc(self, name, value=1):
+        """Increase counter by value"""
+        self.counters[name].inc(value)
+
+    def snapshot(self):
+        """Return dict with current values of all counters and histograms"""
+        return {
+            'counters': {name: counter.snapshot() for name, counter in self.counters.items()},
+            'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        }
+
+
+class MetricsExporter:
+    """Periodically export metrics to Prometheus text file (for textfile collector) or to JSON lines file
+
+    Prometheus text file is replaced atomically on every export, JSON lines are appended
+    (one JSON object per export). Samples rate is computed from samples counted since previous export.
+    """
+    def __init__(self, metrics, path, format='prometheus', interval=10):
+        if format not in formats:
+            raise ValueError('Unknown metrics format: {}'.format(format))
+
+        self.metrics = metrics
+        self.path = path
+        self.format = format
+        self.interval = interval
+
+        self._last_time = time.time()
+        self._last_samples = metrics.counters['samples_total'].snapshot()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start exporting metrics in separate thread"""
+        self._thread = threading.Thread(target=self._run, name='Metrics_exporter', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """Export metrics every interval seconds (runs in separate thread)"""
+        while not self._stop.wait(self.interval):
+            self.export()
+
+    def close(self):
+        """Stop exporting thread and export final values of metrics"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def export(self):
+        """Export current values of metrics"""
+        t = time.time()
+        snapshot = self.metrics.snapshot()
+        samples = snapshot['counters']['samples_total']
+        snapshot['samples_per_second'] = (samples - self._last_samples) / (t - self._last_time) if t > self._last_time else 0
+        self._last_time, self._last_samples = t, samples
+
+        try:
+            if self.format == 'prometheus':
+                tmp_path = '{}.tmp'.format(self.path)
+                with open(tmp_path, 'w') as f:
+                    f.write(self.format_prometheus(snapshot))
+                os.replace(tmp_path, self.path)
+            else:
+                snapshot['timestamp'] = t
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(snapshot) + '\n')
+        except OSError as e:
+            logger.error('Error exporting metrics: {}'.format(e))
+
+    def format_prometheus(self, snapshot):
+        """Return metrics in Prometheus text exposition format"""
+        prefix = self.metrics.prefix
+        lines = []
+        for name, value in snapshot['counters'].items():
+            lines.append('# HELP {}{} {}'.format(prefix, name, self.metrics.counters[name].help))
+            lines.append('# TYPE {}{} counter'.format(prefix, name))
+            lines.append('{}{} {}'.format(prefix, name, value))
+
+        lines.append('# HELP {}samples_per_second Samples rate since previous export'.format(prefix))
+        lines.append('# TYPE {}samples_per_second gauge'.format(prefix))
+        lines.append('{}samples_per_second {}'.format(prefix, snapshot['samples_per_second']))
+
+        for name, histogram in snapshot['histograms'].items():
+            lines.append('# HELP {}{} {}'.format(prefix, name, self.metrics.histograms[name].help))
+            lines.append('# TYPE {}{} histogram'.format(prefix, name))
+            for bound, count in histogram['buckets']:
+                lines.append('{}{}_bucket{{le="{}"}} {}'.format(prefix, name, bound, count))
+            lines.append('{}{}_sum {}'.format(prefix, name, histogram['sum']))
+            lines.append('{}{}_count {}'.format(prefix, name, histogram['count']))
+        return '\n'.join(lines) + '\n'
@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 
-import sys, time, datetime, math, logging, signal
+import sys, time, datetime, math, logging, signal, queue, asyncio, threading, collections, concurrent.futures
 
 import numpy
-import simplesoapy
-from simplespectral import zeros
 
-from soapypower import psd, writer
+try:
+    import simplesoapy
+except ImportError:
+    simplesoapy = None
+
+from soapypower import psd, writer, bufferpool, threadpool, scheduler, stitch, metrics, profiler
 
 logger = logging.getLogger(__name__)
 _shutdown = False
 
+overload_policies = ('block', 'drop-newest', 'reduce-repeats')
+
 
 def _shutdown_handler(sig, frame):
     """Set global _shutdown flag when receiving SIGTERM or SIGINT signals"""
@@ -31,26 +36,76 @@ class SoapyPower:
     def __init__(self, soapy_args='', sample_rate=2.00e6, bandwidth=0, corr=0, gain=20.7,
                  auto_gain=False, channel=0, antenna='', settings=None,
                  force_sample_rate=False, force_bandwidth=False,
-                 output=sys.stdout, output_format='rtl_power'):
-        self.device = simplesoapy.SoapyDevice(
-            soapy_args=soapy_args, sample_rate=sample_rate, bandwidth=bandwidth, corr=corr,
-            gain=gain, auto_gain=auto_gain, channel=channel, antenna=antenna, settings=settings,
-            force_sample_rate=force_sample_rate, force_bandwidth=force_bandwidth
-        )
+                 output=sys.stdout, output_format='rtl_power', output_precision=None,
+                 output_flush_hops=1, output_flush_interval=0, output_rotate_size=0, output_rotate_interval=0,
+                 output_client_queue_size=100, output_client_overflow='drop-oldest',
+                 output_bin_encoding='float32', output_bin_compression='none', output_bin_quantization=0.01,
+                 device=None):
+        if device is not None:
+            # Use supplied sample source (e.g. soapypower.source.SimulatedSource)
+            self.device = device
+        elif simplesoapy is None:
+            raise RuntimeError('simplesoapy module (or SoapySDR Python bindings) not found!')
+        else:
+            self.device = simplesoapy.SoapyDevice(
+                soapy_args=soapy_args, sample_rate=sample_rate, bandwidth=bandwidth, corr=corr,
+                gain=gain, auto_gain=auto_gain, channel=channel, antenna=antenna, settings=settings,
+                force_sample_rate=force_sample_rate, force_bandwidth=force_bandwidth
+            )
 
+        self.metrics = metrics.Metrics()
+
+        self.channel = channel
         self._output = output
         self._output_format = output_format
+        self._writer_options = {
+            'precision': output_precision,
+            'flush_hops': output_flush_hops,
+            'flush_interval': output_flush_interval,
+            'rotate_size': output_rotate_size,
+            'rotate_interval': output_rotate_interval,
+            'client_queue_size': output_client_queue_size,
+            'client_overflow': output_client_overflow,
+            'metrics': self.metrics,
+        }
+        self._bin_writer_options = {
+            'encoding': output_bin_encoding,
+            'compression': output_bin_compression,
+            'quantization': output_bin_quantization,
+        }
 
-        self._buffer = None
+        self._buffer_pool = None
         self._buffer_repeats = None
         self._base_buffer_size = None
         self._max_buffer_size = None
+        self._chunk_size = None
+        self._hop_samples = None
         self._bins = None
         self._repeats = None
         self._tune_delay = None
         self._reset_stream = None
+        self._overload_policy = 'block'
+        self._drop_buffer = None
         self._psd = None
         self._writer = None
+        self._setup_params = None
+
+        # Number of samples processed in last hop (less than requested if some samples were dropped)
+        self.processed_samples = None
+        self.dropped_buffer_count = 0
+
+    def set_output(self, output, output_format=None):
+        """Set output (and format) of writer created by next setup()"""
+        self._output = output
+        if output_format:
+            self._output_format = output_format
+
+    def create_writer(self):
+        """Create writer for selected output and format"""
+        writer_options = dict(self._writer_options)
+        if self._output_format == 'soapy_power_bin':
+            writer_options.update(self._bin_writer_options)
+        return writer.formats[self._output_format](self._output, **writer_options)
 
     def nearest_freq(self, freq, bin_size):
         """Return nearest frequency based on bin size"""
@@ -138,15 +193,20 @@ class SoapyPower:
 
         return freq_list
 
-    def create_buffer(self, bins, repeats, base_buffer_size, max_buffer_size=0):
-        """Create buffer for reading samples"""
+    def create_buffer(self, bins, repeats, base_buffer_size, max_buffer_size=0, max_buffers=0, shared=False,
+                      memory_budget=0):
+        """Create pool of buffers for reading samples"""
         samples = bins * repeats
         buffer_repeats = 1
         buffer_size = math.ceil(samples / base_buffer_size) * base_buffer_size
 
         if not max_buffer_size:
-            # Max buffer size about 100 MB
+            # Max buffer size about 100 MB (or half of memory budget rounded down to multiple of base buffer size,
+            # so that at least two buffers fit in it)
             max_buffer_size = (100 * 1024**2) / 8
+            if memory_budget:
+                budget_buffer_size = math.floor(memory_budget / 2 / 8 / base_buffer_size) * base_buffer_size
+                max_buffer_size = min(max_buffer_size, max(budget_buffer_size, base_buffer_size))
 
         if max_buffer_size > 0:
             max_buffer_size = math.ceil(max_buffer_size / base_buffer_size) * base_buffer_size
@@ -170,12 +230,85 @@ class SoapyPower:
         ))
         logger.info('buffer_repeats: {}'.format(buffer_repeats))
 
-        return (buffer_repeats, zeros(buffer_size, numpy.complex64))
+        # Samples are read directly into free buffer from pool and buffer is returned back
+        # to pool by PSD thread, so we need at least two buffers to not block acquisition
+        buffer_count = max(self.budget_to_buffers(memory_budget, buffer_size) if memory_budget else max_buffers, 2)
+        buffer_pool = bufferpool.BufferPool(buffer_size, buffer_count, numpy.complex64, shared=shared)
+        logger.info('buffer_pool: {} buffers ({:.2f} MB{})'.format(
+            buffer_count, buffer_pool.nbytes / 1024**2, ', shared memory' if shared else ''
+        ))
+
+        return (buffer_repeats, buffer_pool)
+
+    def create_chunk_buffer(self, bins, repeats, base_buffer_size, chunk_size, max_buffers=0, shared=False,
+                            memory_budget=0):
+        """Create pool of small buffers for streaming samples in chunks"""
+        samples = bins * repeats
+        chunk_samples = chunk_size * base_buffer_size
+
+        # Every buffer must hold one chunk of samples and unprocessed samples carried over
+        # from previous chunk (less than one FFT segment)
+        buffer_size = chunk_samples + bins - 1
+        buffer_count = max(self.budget_to_buffers(memory_budget, buffer_size) if memory_budget else max_buffers, 2)
+        buffer_pool = bufferpool.BufferPool(buffer_size, buffer_count, numpy.complex64, shared=shared)
+
+        logger.info('repeats: {}'.format(repeats))
+        logger.info('samples: {} (time: {:.5f} s)'.format(samples, samples / self.device.sample_rate))
+        logger.info('chunk_size (samples): {} (chunks: {}, time: {:.5f} s)'.format(
+            chunk_samples, math.ceil(samples / chunk_samples), chunk_samples / self.device.sample_rate
+        ))
+        logger.info('buffer_pool: {} buffers ({:.2f} MB{})'.format(
+            buffer_count, buffer_pool.nbytes / 1024**2, ', shared memory' if shared else ''
+        ))
+
+        return buffer_pool
+
+    def budget_to_buffers(self, memory_budget, buffer_size):
+        """Return number of sample buffers fitting in memory budget [B] (budget is never exceeded)"""
+        buffer_count = int(memory_budget // (buffer_size * numpy.dtype(numpy.complex64).itemsize))
+        if buffer_count < 2:
+            raise ValueError('Memory budget ({:.2f} MB) is too small for two sample buffers ({:.2f} MB)!'.format(
+                memory_budget / 1024**2, 2 * buffer_size * numpy.dtype(numpy.complex64).itemsize / 1024**2
+            ))
+        return buffer_count
 
     def setup(self, bins, repeats, base_buffer_size=0, max_buffer_size=0, fft_window='hann',
               fft_overlap=0.5, crop_factor=0, log_scale=True, remove_dc=False, detrend=None,
-              lnb_lo=0, tune_delay=0, reset_stream=False, max_threads=0, max_queue_size=0):
-        """Prepare samples buffer and start streaming samples from device"""
+              lnb_lo=0, tune_delay=0, reset_stream=False, max_threads=0, max_queue_size=0, max_buffers=0,
+              psd_backend='threads', chunk_size=0, detector=None, detector_alpha=0.1, decimation=1,
+              decimation_bins=0, decimation_mode='mean', decimation_percentile=50, memory_budget=0,
+              overload_policy='block', shared_psd=None, shared_writer=None, create_writer=True):
+        """Prepare samples buffers and start streaming samples from device
+
+        memory_budget ... max. size of all sample buffers in bytes (overrides max_buffers, 0 = disabled)
+        overload_policy ... what to do when there is no free sample buffer (all buffers are processed
+                            by PSD threads): block (wait for free buffer), drop-newest (read samples and drop
+                            them) or reduce-repeats (end current hop early), first buffer of every hop is
+                            always processed
+        shared_psd, shared_writer ... use existing PSD calculator and writer (shared with other devices)
+                                      instead of creating new ones, they are not closed by stop()
+        create_writer ... create writer (disabled when PSD results are consumed directly, e.g. by sweep_iter())
+
+        If device is still streaming after close_output() and parameters are same as in previous setup(),
+        stream, sample buffers and PSD calculator are reused and only new writer is created.
+        """
+        if overload_policy not in overload_policies:
+            raise ValueError('Unknown overload policy: {}'.format(overload_policy))
+
+        params = (bins, repeats, base_buffer_size, max_buffer_size, fft_window, fft_overlap, crop_factor, log_scale,
+                  remove_dc, detrend, lnb_lo, tune_delay, reset_stream, max_threads, max_queue_size, max_buffers,
+                  psd_backend, chunk_size, detector, detector_alpha, decimation, decimation_bins, decimation_mode,
+                  decimation_percentile, memory_budget, overload_policy, shared_psd)
+        if self.device.is_streaming and self._setup_params is not None:
+            if params == self._setup_params:
+                logger.debug('Reusing stream, sample buffers and PSD calculator of previous sweep')
+                self.device.device.activateStream(self.device.stream)
+                if not self._shared:
+                    self._psd.reset()
+                self._writer = shared_writer if shared_writer is not None or not create_writer else self.create_writer()
+                return
+            self.stop()
+
         if self.device.is_streaming:
             self.device.stop_stream()
 
@@ -184,15 +317,56 @@ class SoapyPower:
         self._repeats = repeats
         self._base_buffer_size = len(base_buffer)
         self._max_buffer_size = max_buffer_size
-        self._buffer_repeats, self._buffer = self.create_buffer(
-            bins, repeats, self._base_buffer_size, self._max_buffer_size
-        )
+        self._chunk_size = chunk_size
         self._tune_delay = tune_delay
         self._reset_stream = reset_stream
-        self._psd = psd.PSD(bins, self.device.sample_rate, fft_window=fft_window, fft_overlap=fft_overlap,
-                            crop_factor=crop_factor, log_scale=log_scale, remove_dc=remove_dc, detrend=detrend,
-                            lnb_lo=lnb_lo, max_threads=max_threads, max_queue_size=max_queue_size)
-        self._writer = writer.formats[self._output_format](self._output)
+        self._overload_policy = overload_policy
+        self._drop_buffer = None
+        self.dropped_buffer_count = 0
+        self._buffer_overflow_count = 0
+        self._shared = shared_psd is not None
+        if shared_psd is not None:
+            self._psd = shared_psd
+        else:
+            self._psd = psd.PSD(bins, self.device.sample_rate, fft_window=fft_window, fft_overlap=fft_overlap,
+                                crop_factor=crop_factor, log_scale=log_scale, remove_dc=remove_dc, detrend=detrend,
+                                lnb_lo=lnb_lo, max_threads=max_threads, max_queue_size=max_queue_size,
+                                backend=psd_backend, detector=detector, detector_alpha=detector_alpha,
+                                decimation=decimation, decimation_bins=decimation_bins,
+                                decimation_mode=decimation_mode, decimation_percentile=decimation_percentile,
+                                metrics=self.metrics)
+        if decimation > 1 or decimation_bins:
+            logger.info('bins (after decimation): {}'.format(self._psd.output_bins))
+        if self._chunk_size:
+            self._buffer_repeats = None
+            self._buffer_pool = self.create_chunk_buffer(
+                bins, repeats, self._base_buffer_size, self._chunk_size,
+                max_buffers=max_buffers or self._psd._executor._max_workers + 1,
+                shared=psd_backend == 'processes', memory_budget=memory_budget
+            )
+            self._hop_samples = bins * repeats
+        else:
+            self._buffer_repeats, self._buffer_pool = self.create_buffer(
+                bins, repeats, self._base_buffer_size, self._max_buffer_size,
+                max_buffers=max_buffers or self._psd._executor._max_workers + 1,
+                shared=psd_backend == 'processes', memory_budget=memory_budget
+            )
+            self._hop_samples = self._buffer_pool.buffer_size * self._buffer_repeats
+        self._writer = shared_writer if shared_writer is not None or not create_writer else self.create_writer()
+        self._setup_params = params
+
+    def close_output(self):
+        """Close writer, but keep device streaming, sample buffers and PSD calculator for next setup()
+
+        Streaming is deactivated until next setup() (so samples are not buffered by device meanwhile).
+        """
+        if not self.device.is_streaming:
+            return
+
+        self.device.device.deactivateStream(self.device.stream)
+        if not self._shared and self._writer:
+            self._writer.close()
+        self._writer = None
 
     def stop(self):
         """Stop streaming samples from device and delete samples buffer"""
@@ -200,21 +374,166 @@ class SoapyPower:
             return
 
         self.device.stop_stream()
-        self._writer.close()
+        if not self._shared:
+            if self._writer:
+                self._writer.close()
+            self._psd.shutdown()
+        self._buffer_pool.close()
 
         self._bins = None
         self._repeats = None
         self._base_buffer_size = None
         self._max_buffer_size = None
+        self._chunk_size = None
+        self._hop_samples = None
         self._buffer_repeats = None
-        self._buffer = None
+        self._buffer_pool = None
+        self._drop_buffer = None
         self._tune_delay = None
         self._reset_stream = None
         self._psd = None
         self._writer = None
+        self._setup_params = None
+
+    def _acquire_buffer(self, block=True):
+        """Get free buffer from pool (blocks if all buffers are still processed by PSD threads,
+           returns None if block is False and there is no free buffer)"""
+        t_wait = time.time()
+        try:
+            buffer = self._buffer_pool.acquire(block=block)
+        except queue.Empty:
+            return None
+        t_wait_end = time.time()
+        self.metrics.observe('buffer_wait_seconds', t_wait_end - t_wait)
+        if t_wait_end - t_wait >= 0.001:
+            logger.debug('      Waited for free buffer: {:.3f} s'.format(t_wait_end - t_wait))
+        return buffer
+
+    def _drop_samples(self, samples, read=True):
+        """Read samples into scratch buffer and drop them (or only count them as dropped if read is False)"""
+        if read:
+            if self._drop_buffer is None or len(self._drop_buffer) < samples:
+                self._drop_buffer = numpy.empty(samples, numpy.complex64)
+            self.device.read_stream_into_buffer(self._drop_buffer[:samples])
+            self.metrics.inc('samples_total', samples)
+
+        self.dropped_buffer_count += 1
+        self.metrics.inc('dropped_buffers_total')
+        self.metrics.inc('dropped_samples_total', samples)
+        logger.debug('      No free buffer, {} samples {}'.format(samples, 'dropped' if read else 'skipped'))
+        return samples
+
+    def _read_buffers(self, psd_state):
+        """Read samples into whole buffers and compute PSD of every buffer in another thread"""
+        dropped = 0
+        processed = False
+        for repeat in range(self._buffer_repeats):
+            logger.debug('    Repeat: {}'.format(repeat + 1))
+
+            # First buffer of hop is always processed, so wait for it if needed
+            buffer = self._acquire_buffer(block=self._overload_policy == 'block' or not processed)
+            if buffer is None:
+                if self._overload_policy == 'reduce-repeats':
+                    dropped += self._drop_samples((self._buffer_repeats - repeat) * self._buffer_pool.buffer_size,
+                                                  read=False)
+                    break
+                dropped += self._drop_samples(self._buffer_pool.buffer_size)
+                acq_time_stop = datetime.datetime.utcnow()
+                continue
+            processed = True
+
+            # Read samples from SDR in main thread
+            t_acq = time.time()
+            acq_time_start = datetime.datetime.utcnow()
+            self.device.read_stream_into_buffer(buffer)
+            acq_time_stop = datetime.datetime.utcnow()
+            t_acq_end = time.time()
+            logger.debug('      Acquisition time: {:.3f} s'.format(t_acq_end - t_acq))
+            self.metrics.observe('acquisition_seconds', t_acq_end - t_acq)
+            self.metrics.inc('samples_total', len(buffer))
+
+            # Start FFT computation in another thread (buffer is returned back to pool when done)
+            psd_future = self._psd.update_async(psd_state, buffer)
+            self._buffer_pool.release_when_done(psd_future, buffer)
+
+            if _shutdown:
+                break
+
+        return (acq_time_start, acq_time_stop, dropped)
+
+    def _read_chunks(self, psd_state):
+        """Read exact number of samples in small chunks and compute PSD of every chunk in another thread
+
+        Samples which are not part of any complete FFT segment (overlap) are carried over
+        to beginning of next chunk.
+        """
+        chunk_samples = self._chunk_size * self._base_buffer_size
+        samples_left = self._bins * self._repeats
+        dropped = 0
+        buffer = self._acquire_buffer()
+        buffer_fill = 0
+        chunk = 0
+
+        acq_time_start = datetime.datetime.utcnow()
+        while samples_left > 0:
+            chunk += 1
+            read_size = min(chunk_samples, samples_left)
+
+            # Read samples from SDR in main thread
+            t_acq = time.time()
+            self.device.read_stream_into_buffer(buffer[buffer_fill:buffer_fill + read_size])
+            t_acq_end = time.time()
+            logger.debug('    Chunk {}: acquisition time: {:.3f} s'.format(chunk, t_acq_end - t_acq))
+            self.metrics.observe('acquisition_seconds', t_acq_end - t_acq)
+            self.metrics.inc('samples_total', read_size)
+            buffer_fill += read_size
+            samples_left -= read_size
+
+            # Keep reading into same buffer until there is at least one complete segment
+            consumed = self._psd.consumed_samples(buffer_fill)
+            if not consumed and samples_left > 0 and not _shutdown:
+                continue
+
+            # Start FFT computation in another thread (buffer is returned back to pool when done)
+            psd_future = self._psd.update_async(psd_state, buffer[:buffer_fill])
+            self._buffer_pool.release_when_done(psd_future, buffer)
+
+            if samples_left <= 0 or _shutdown:
+                break
+
+            # Carry unprocessed samples over to next buffer (previous buffer could be already returned
+            # back to pool, but only this thread writes to buffers, so its content is still unchanged)
+            next_buffer = self._acquire_buffer(block=self._overload_policy == 'block')
+            if next_buffer is None:
+                if self._overload_policy == 'reduce-repeats':
+                    dropped += self._drop_samples(samples_left, read=False)
+                    break
+
+                # Drop chunks until there is free buffer (stream is not continuous anymore, so carried
+                # over samples are dropped too)
+                while next_buffer is None and samples_left > 0 and not _shutdown:
+                    read_size = min(chunk_samples, samples_left)
+                    dropped += self._drop_samples(read_size)
+                    samples_left -= read_size
+                    next_buffer = self._acquire_buffer(block=False)
+                if next_buffer is None or samples_left <= 0:
+                    if next_buffer is not None:
+                        self._buffer_pool.release(next_buffer)
+                    break
+                consumed = buffer_fill
+            carry = buffer_fill - consumed
+            next_buffer[:carry] = buffer[consumed:buffer_fill]
+            buffer, buffer_fill = next_buffer, carry
+        acq_time_stop = datetime.datetime.utcnow()
+
+        return (acq_time_start, acq_time_stop, dropped)
+
+    def psd(self, freq, emit=True):
+        """Tune to specified center frequency and compute Power Spectral Density
 
-    def psd(self, freq):
-        """Tune to specified center frequency and compute Power Spectral Density"""
+        If detector is enabled, emit selects if result contains output of detector or current PSD.
+        Number of actually processed samples (without dropped samples) is stored in processed_samples.
+        """
         if not self.device.is_streaming:
             raise RuntimeError('Streaming is not initialized, you must run setup() first!')
 
@@ -242,89 +561,464 @@ class SoapyPower:
                     if t_delay_end - t_delay >= self._tune_delay:
                         break
                 logger.debug('    Tune delay: {:.3f} s'.format(t_delay_end - t_delay))
+                self.metrics.observe('tune_delay_seconds', t_delay_end - t_delay)
         else:
             logger.debug('    Same frequency as before, tuning skipped')
-        psd_state = self._psd.set_center_freq(freq)
+        psd_state = self._psd.set_center_freq(freq, emit=emit, channel=self.channel)
         t_freq_end = time.time()
         logger.debug('    Tune time: {:.3f} s'.format(t_freq_end - t_freq))
+        self.metrics.observe('tune_seconds', t_freq_end - t_freq)
 
-        for repeat in range(self._buffer_repeats):
-            logger.debug('    Repeat: {}'.format(repeat + 1))
-            # Read samples from SDR in main thread
-            t_acq = time.time()
-            acq_time_start = datetime.datetime.utcnow()
-            self.device.read_stream_into_buffer(self._buffer)
-            acq_time_stop = datetime.datetime.utcnow()
-            t_acq_end = time.time()
-            logger.debug('      Acquisition time: {:.3f} s'.format(t_acq_end - t_acq))
-
-            # Start FFT computation in another thread
-            self._psd.update_async(psd_state, numpy.copy(self._buffer))
-
-            t_final = time.time()
-
-            if _shutdown:
-                break
+        if self._chunk_size:
+            acq_time_start, acq_time_stop, dropped = self._read_chunks(psd_state)
+        else:
+            acq_time_start, acq_time_stop, dropped = self._read_buffers(psd_state)
+        self.processed_samples = self._hop_samples - dropped
+        t_final = time.time()
 
         psd_future = self._psd.result_async(psd_state)
         logger.debug('    Total hop time: {:.3f} s'.format(t_final - t_freq))
+        self.metrics.observe('hop_seconds', t_final - t_freq)
+        self.metrics.inc('hops_total')
+        buffer_overflow_count = self.device.buffer_overflow_count
+        self.metrics.inc('buffer_overflows_total', buffer_overflow_count - self._buffer_overflow_count)
+        self._buffer_overflow_count = buffer_overflow_count
 
         return (psd_future, acq_time_start, acq_time_stop)
 
+    def measure(self, freq_list, emit=True):
+        """Measure PSD of all frequency hops in list
+
+        Yields (freq, psd_future, acq_time_start, acq_time_stop, samples, channel) of every hop in order
+        of freq_list (channel is None if records shouldn't be tagged by channel).
+        """
+        for freq in freq_list:
+            # Tune to new frequency, acquire samples and compute Power Spectral Density
+            psd_future, acq_time_start, acq_time_stop = self.psd(freq, emit=emit)
+            yield (freq, psd_future, acq_time_start, acq_time_stop, self.processed_samples, None)
+
+            if _shutdown:
+                break
+
     def sweep(self, min_freq, max_freq, bins, repeats, runs=0, time_limit=0, overlap=0,
               fft_window='hann', fft_overlap=0.5, crop=False, log_scale=True, remove_dc=False, detrend=None, lnb_lo=0,
-              tune_delay=0, reset_stream=False, base_buffer_size=0, max_buffer_size=0, max_threads=0, max_queue_size=0):
-        """Sweep spectrum using frequency hopping"""
-        self.setup(
-            bins, repeats, base_buffer_size, max_buffer_size,
-            fft_window=fft_window, fft_overlap=fft_overlap, crop_factor=overlap if crop else 0,
-            log_scale=log_scale, remove_dc=remove_dc, detrend=detrend, lnb_lo=lnb_lo, tune_delay=tune_delay,
-            reset_stream=reset_stream, max_threads=max_threads, max_queue_size=max_queue_size
-        )
+              tune_delay=0, reset_stream=False, base_buffer_size=0, max_buffer_size=0, max_threads=0, max_queue_size=0,
+              max_buffers=0, psd_backend='threads', chunk_size=0, adaptive=False, max_revisit=60,
+              activity_threshold=10, stitch_mode=None, detector=None, detector_alpha=0.1, detector_runs=0,
+              detector_interval=0, decimation=1, decimation_bins=0, decimation_mode='mean', decimation_percentile=50,
+              profile_dir=None, profile_interval=0.005, memory_budget=0, overload_policy='block', keep_open=False):
+        """Sweep spectrum using frequency hopping
+
+        If adaptive is True, active hops are revisited in every run and quiet hops only once
+        per max_revisit seconds (see scheduler.AdaptiveScheduler).
+
+        If stitch_mode is set (average, center or max), all hops of every run are written
+        as one full-band record (see stitch.Stitcher).
+
+        If detector is set (max, min, ema or average), PSD of every hop is combined across runs
+        (see psd.Detector) and output is written only every detector_runs runs and / or every
+        detector_interval seconds (and in last run).
+
+        If profile_dir is set, call stacks of main thread, PSD threads and writer thread are sampled
+        every profile_interval seconds and per-thread reports with merged summary are saved
+        to profile_dir at the end of sweep (see profiler.SamplingProfiler).
+
+        If keep_open is True, only writer is closed at the end of sweep, device stream, sample buffers
+        and PSD calculator are kept for next sweep with same parameters (see setup() and close_output()).
+        """
+        sweep_profiler = None
+        if profile_dir:
+            sweep_profiler = profiler.SamplingProfiler(interval=profile_interval)
+            sweep_profiler.start()
+
+        try:
+            self.setup(
+                bins, repeats, base_buffer_size, max_buffer_size,
+                fft_window=fft_window, fft_overlap=fft_overlap, crop_factor=overlap if crop else 0,
+                log_scale=log_scale, remove_dc=remove_dc, detrend=detrend, lnb_lo=lnb_lo, tune_delay=tune_delay,
+                reset_stream=reset_stream, max_threads=max_threads, max_queue_size=max_queue_size,
+                max_buffers=max_buffers, psd_backend=psd_backend, chunk_size=chunk_size, detector=detector,
+                detector_alpha=detector_alpha, decimation=decimation, decimation_bins=decimation_bins,
+                decimation_mode=decimation_mode, decimation_percentile=decimation_percentile,
+                memory_budget=memory_budget, overload_policy=overload_policy
+            )
+        except Exception:
+            # Save profile even if device couldn't be set up
+            if sweep_profiler:
+                sweep_profiler.stop()
+                sweep_profiler.save(profile_dir)
+            raise
 
         try:
             freq_list = self.freq_plan(min_freq - lnb_lo, max_freq - lnb_lo, bins, overlap)
+            self._psd.plan(freq_list)
+            if stitch_mode:
+                self._writer.stitcher = stitch.Stitcher(
+                    [self._psd.hop_plan(freq).freq_array for freq in freq_list], mode=stitch_mode, log_scale=log_scale
+                )
+            if adaptive:
+                hop_scheduler = scheduler.AdaptiveScheduler(freq_list, max_revisit=max_revisit,
+                                                            threshold=activity_threshold, log_scale=log_scale)
             t_start = time.time()
+            t_emit = t_start
+            dropped_start = self.metrics.counters['dropped_buffers_total'].snapshot()
+            write_next_future = None
+            # Hops whose detectors have been updated since their last output
+            pending_hops = {}
             run = 0
             while not _shutdown and (runs == 0 or run < runs):
                 run += 1
                 t_run_start = time.time()
                 logger.debug('Run: {}'.format(run))
 
-                for freq in freq_list:
-                    # Tune to new frequency, acquire samples and compute Power Spectral Density
-                    psd_future, acq_time_start, acq_time_stop = self.psd(freq)
+                # Write output of detectors only every N runs or T seconds
+                emit = True
+                if detector and (detector_runs or detector_interval):
+                    emit = (run == runs or (detector_runs and run % detector_runs == 0) or
+                            (detector_interval and t_run_start - t_emit >= detector_interval))
+                    if emit:
+                        t_emit = t_run_start
 
+                cycle = hop_scheduler.next_cycle() if adaptive else freq_list
+                for freq, psd_future, acq_time_start, acq_time_stop, samples, channel in self.measure(cycle, emit=emit):
                     # Write PSD to stdout (in another thread)
-                    self._writer.write_async(psd_future, acq_time_start, acq_time_stop,
-                                             len(self._buffer) * self._buffer_repeats)
+                    if emit:
+                        write_future = self._writer.write_async(psd_future, acq_time_start, acq_time_stop, samples,
+                                                                channel)
+                        pending_hops.pop(freq, None)
+                    else:
+                        write_future = psd_future
+                        pending_hops[freq] = (acq_time_start, acq_time_stop, samples, channel)
+                    if adaptive:
+                        hop_scheduler.watch(freq, psd_future, write_future)
+
+                    # Recycle buffer with PSD result after it has been written
+                    self._psd.release_result_when_done(write_future, psd_future)
 
                     if _shutdown:
                         break
 
                 # Write end of measurement marker (in another thread)
-                write_next_future = self._writer.write_next_async()
+                if emit:
+                    write_next_future = self._writer.write_next_async()
                 t_run = time.time()
                 logger.debug('  Total run time: {:.3f} s'.format(t_run - t_run_start))
+                self.metrics.inc('runs_total')
 
                 # End measurement if time limit is exceeded
                 if time_limit and (time.time() - t_start) >= time_limit:
                     logger.info('Time limit of {} s exceeded, completed {} runs'.format(time_limit, run))
                     break
 
+            # Write output of detectors which haven't been written since their last update
+            # (e.g. when sweep is ended by time limit or by signal before next output)
+            if pending_hops:
+                for freq in sorted(pending_hops):
+                    acq_time_start, acq_time_stop, samples, channel = pending_hops[freq]
+                    for detector_channel, psd_future in self._psd.detector_results_async(freq):
+                        write_future = self._writer.write_async(psd_future, acq_time_start, acq_time_stop, samples,
+                                                                None if channel is None else detector_channel)
+                        self._psd.release_result_when_done(write_future, psd_future)
+                write_next_future = self._writer.write_next_async()
+
             # Wait for last write to be finished
-            write_next_future.result()
+            if write_next_future:
+                write_next_future.result()
+
+            dropped = self.metrics.counters['dropped_buffers_total'].snapshot() - dropped_start
+            if dropped:
+                logger.warning('Dropped or skipped {} sample buffers because PSD threads couldn\'t keep up '
+                               '({} policy)'.format(dropped, self._overload_policy))
 
             # Debug thread pool queues
             logging.debug('Number of USB buffer overflow errors: {}'.format(self.device.buffer_overflow_count))
             logging.debug('PSD worker threads: {}'.format(self._psd._executor._max_workers))
             logging.debug('Max. PSD queue size: {} / {}'.format(self._psd._executor.max_queue_size_reached,
                                                                 self._psd._executor.max_queue_size))
+            logging.debug('Sample buffers: {} (waited for free buffer {} times)'.format(
+                self._buffer_pool.buffer_count, self._buffer_pool.wait_count
+            ))
+            logging.debug('PSD result buffers: {}'.format(self._psd._result_pool.buffer_count))
             logging.debug('Writer worker threads: {}'.format(self._writer._executor._max_workers))
             logging.debug('Max. Writer queue size: {} / {}'.format(self._writer._executor.max_queue_size_reached,
                                                                    self._writer._executor.max_queue_size))
         finally:
-            # Shutdown SDR
-            self.stop()
+            # Shutdown SDR (or only close output if it should be reused by next sweep)
+            if keep_open:
+                self.close_output()
+            else:
+                self.stop()
             t_stop = time.time()
             logger.info('Total time: {:.3f} s'.format(t_stop - t_start))
+
+            if sweep_profiler:
+                sweep_profiler.stop()
+                sweep_profiler.save(profile_dir)
+
+    def _setup_iter(self, min_freq, max_freq, bins, repeats, overlap=0, crop=False, log_scale=True, lnb_lo=0,
+                    stitch_mode=None, **kwargs):
+        """Prepare sweep without writer, return frequency hops and stitcher (or None)"""
+        self.setup(bins, repeats, crop_factor=overlap if crop else 0, log_scale=log_scale, lnb_lo=lnb_lo,
+                   create_writer=False, **kwargs)
+        try:
+            freq_list = self.freq_plan(min_freq - lnb_lo, max_freq - lnb_lo, bins, overlap)
+            self._psd.plan(freq_list)
+            stitcher = None
+            if stitch_mode:
+                stitcher = stitch.Stitcher(
+                    [self._psd.hop_plan(freq).freq_array for freq in freq_list], mode=stitch_mode, log_scale=log_scale
+                )
+        except Exception:
+            self.stop()
+            raise
+        return (freq_list, stitcher)
+
+    def _iter_hops(self, freq_list, runs=0, time_limit=0, should_stop=None):
+        """Measure all frequency hops in every run
+
+        Yields (psd_future, acq_time_start, acq_time_stop, samples) of every hop and None at the end of every run.
+        """
+        t_start = time.time()
+        run = 0
+        while not _shutdown and (runs == 0 or run < runs):
+            run += 1
+            for freq, psd_future, acq_time_start, acq_time_stop, samples, channel in self.measure(freq_list):
+                yield (psd_future, acq_time_start, acq_time_stop, samples)
+                if _shutdown or (should_stop and should_stop()):
+                    return
+            yield None
+            self.metrics.inc('runs_total')
+
+            if time_limit and (time.time() - t_start) >= time_limit:
+                logger.info('Time limit of {} s exceeded, completed {} runs'.format(time_limit, run))
+                break
+
+    def _iter_records(self, stitcher, item, psd_result):
+        """Yield record of one hop (or stitched record of whole run at the end of run), release PSD result after it"""
+        if item is None:
+            if stitcher and stitcher.hops:
+                freq_array, pwr_array = stitcher.result()
+                yield (freq_array, pwr_array, stitcher.time_start, stitcher.time_stop, stitcher.samples)
+                stitcher.reset()
+            return
+
+        psd_future, acq_time_start, acq_time_stop, samples = item
+        freq_array, pwr_array = psd_result
+        try:
+            if stitcher:
+                stitcher.add(freq_array, pwr_array, acq_time_start, acq_time_stop, samples)
+            else:
+                yield (freq_array, pwr_array, acq_time_start, acq_time_stop, samples)
+        finally:
+            self._psd.release_result(pwr_array)
+
+    def sweep_iter(self, min_freq, max_freq, bins, repeats, runs=0, time_limit=0, overlap=0, crop=False,
+                   log_scale=True, lnb_lo=0, stitch_mode=None, prefetch=1, **kwargs):
+        """Sweep spectrum using frequency hopping, yield PSD of every hop (or of every run if stitch_mode is set)
+
+        Yields (freq_array, pwr_array, time_start, time_stop, samples) tuples. Arrays are not copied,
+        they are valid only until next record is requested (copy them if you need to keep them longer).
+        Up to prefetch next hops are acquired in advance, so PSD of next hop is computed while current
+        record is processed. Other arguments are same as in sweep() (kwargs are passed to setup()).
+        """
+        freq_list, stitcher = self._setup_iter(min_freq, max_freq, bins, repeats, overlap=overlap, crop=crop,
+                                               log_scale=log_scale, lnb_lo=lnb_lo, stitch_mode=stitch_mode, **kwargs)
+        hops = self._iter_hops(freq_list, runs=runs, time_limit=time_limit)
+        try:
+            pending = collections.deque()
+            for item in hops:
+                pending.append(item)
+                while len(pending) > prefetch:
+                    item = pending.popleft()
+                    yield from self._iter_records(stitcher, item, item and item[0].result())
+            while pending:
+                item = pending.popleft()
+                yield from self._iter_records(stitcher, item, item and item[0].result())
+        finally:
+            hops.close()
+            self.stop()
+
+    async def sweep_async(self, min_freq, max_freq, bins, repeats, runs=0, time_limit=0, overlap=0, crop=False,
+                          log_scale=True, lnb_lo=0, stitch_mode=None, max_queue_size=4, **kwargs):
+        """Sweep spectrum using frequency hopping, asynchronous version of sweep_iter() (for asyncio)
+
+        Samples are acquired in separate thread, which is paused when max_queue_size hops are waiting
+        for consumer, so event loop is never blocked by device. Arrays are valid only until next record
+        is requested (same as in sweep_iter()).
+        """
+        loop = asyncio.get_running_loop()
+        freq_list, stitcher = await loop.run_in_executor(None, lambda: self._setup_iter(
+            min_freq, max_freq, bins, repeats, overlap=overlap, crop=crop, log_scale=log_scale, lnb_lo=lnb_lo,
+            stitch_mode=stitch_mode, **kwargs
+        ))
+
+        items = asyncio.Queue()
+        free_slots = threading.Semaphore(max_queue_size)
+        stopping = threading.Event()
+        end = object()
+
+        def produce():
+            """Put measured hops to queue (runs in acquisition thread)"""
+            try:
+                for item in self._iter_hops(freq_list, runs=runs, time_limit=time_limit, should_stop=stopping.is_set):
+                    while not free_slots.acquire(timeout=0.1):
+                        if stopping.is_set():
+                            return
+                    loop.call_soon_threadsafe(items.put_nowait, item)
+            except Exception as e:
+                loop.call_soon_threadsafe(items.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(items.put_nowait, end)
+
+        producer = threading.Thread(target=produce, name='Acquisition_producer', daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = await items.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                free_slots.release()
+
+                psd_result = item and await asyncio.wrap_future(item[0])
+                records = self._iter_records(stitcher, item, psd_result)
+                try:
+                    for record in records:
+                        yield record
+                finally:
+                    records.close()
+        finally:
+            stopping.set()
+            await loop.run_in_executor(None, producer.join)
+            await loop.run_in_executor(None, self.stop)
+
+
+class MultiSoapyPower(SoapyPower):
+    """SoapySDR spectrum analyzer using multiple devices at once
+
+    Frequency hops of every run are split between devices (every device measures contiguous block
+    of hops in its own acquisition thread), all devices share PSD threads and writer and PSD
+    of all hops is written in order of frequency.
+
+    Devices can be also channels of one MIMO device (see source.MimoSource), which can measure
+    different hops (same as multiple devices) or all of them can measure every hop (paired measurement).
+    """
+    def __init__(self, devices, tune_delays=None, paired=False, tag_channels=False, **kwargs):
+        """Create spectrum analyzer
+
+        devices ... list of dicts with device specific arguments of SoapyPower (e.g. soapy_args, corr,
+                    gain or device), other arguments are common for all devices
+        tune_delays ... list of tune delays of all devices (overrides tune_delay argument of sweep())
+        paired ... every device measures all hops (instead of splitting hops between devices),
+                   hops are written in order of frequency and device
+        tag_channels ... tag output records by channel of device
+        """
+        if not devices:
+            raise ValueError('At least one device is required!')
+        if tune_delays is not None and len(tune_delays) != len(devices):
+            raise ValueError('Number of tune delays must be same as number of devices!')
+
+        super().__init__(**dict(kwargs, **devices[0]))
+        self.sdrs = [self] + [SoapyPower(**dict(kwargs, **device)) for device in devices[1:]]
+        for sdr in self.sdrs[1:]:
+            sdr.metrics = self.metrics
+        self.tune_delays = tune_delays
+        self.paired = paired
+        self.tag_channels = tag_channels
+        self._acquisition_executor = None
+
+    def setup(self, bins, repeats, base_buffer_size=0, max_buffer_size=0, tune_delay=0, **kwargs):
+        """Prepare samples buffers and start streaming samples from all devices"""
+        tune_delays = self.tune_delays or [tune_delay] * len(self.sdrs)
+        super().setup(bins, repeats, base_buffer_size, max_buffer_size, tune_delay=tune_delays[0], **kwargs)
+        for i, sdr in enumerate(self.sdrs[1:], 1):
+            if sdr.device.sample_rate != self.device.sample_rate:
+                raise ValueError('All devices must use same sample rate ({} != {})!'.format(
+                    sdr.device.sample_rate, self.device.sample_rate
+                ))
+            logger.info('Device {}: {}'.format(i, sdr.device.hardware))
+            sdr.setup(bins, repeats, base_buffer_size, max_buffer_size, tune_delay=tune_delays[i],
+                      shared_psd=self._psd, shared_writer=self._writer, **kwargs)
+
+        if not self._acquisition_executor:
+            self._acquisition_executor = threadpool.ThreadPoolExecutor(
+                max_workers=len(self.sdrs),
+                thread_name_prefix='Acquisition_thread'
+            )
+
+    def close_output(self):
+        """Close writer, but keep all devices streaming (see SoapyPower.close_output())"""
+        for sdr in self.sdrs[1:]:
+            sdr.close_output()
+        super().close_output()
+
+    def stop(self):
+        """Stop streaming samples from all devices and delete samples buffers"""
+        for sdr in self.sdrs[1:]:
+            sdr.stop()
+        if self._acquisition_executor:
+            self._acquisition_executor.shutdown()
+            self._acquisition_executor = None
+        super().stop()
+
+    def split(self, freq_list):
+        """Split frequency hops to contiguous blocks of nearly same size (one block for every device)"""
+        count, extra = divmod(len(freq_list), len(self.sdrs))
+        blocks = []
+        start = 0
+        for i in range(len(self.sdrs)):
+            stop = start + count + (1 if i < extra else 0)
+            blocks.append(freq_list[start:stop])
+            start = stop
+        return blocks
+
+    def _measure_block(self, index, freq_list, hop_futures, emit):
+        """Measure PSD of block of frequency hops by one device (runs in acquisition thread)"""
+        sdr = self.sdrs[index]
+        channel = sdr.channel if self.tag_channels else None
+        for i, freq in enumerate(freq_list):
+            if _shutdown:
+                for freq in freq_list[i:]:
+                    hop_futures[freq, index].cancel()
+                break
+            try:
+                psd_future, acq_time_start, acq_time_stop = sdr.psd(freq, emit=emit)
+            except Exception as e:
+                for freq in freq_list[i:]:
+                    hop_futures[freq, index].set_exception(e)
+                raise
+            hop_futures[freq, index].set_result(
+                (freq, psd_future, acq_time_start, acq_time_stop, sdr.processed_samples, channel)
+            )
+
+    def measure(self, freq_list, emit=True):
+        """Measure PSD of all frequency hops in list (hops are measured by all devices in parallel)
+
+        Yields (freq, psd_future, acq_time_start, acq_time_stop, samples, channel) of every hop in order
+        of freq_list (and in order of devices if measurement is paired).
+        """
+        if self.paired:
+            blocks = [freq_list] * len(self.sdrs)
+        else:
+            blocks = self.split(freq_list)
+        hop_futures = {(freq, i): concurrent.futures.Future() for i, block in enumerate(blocks) for freq in block}
+        block_futures = [
+            self._acquisition_executor.submit(self._measure_block, i, block, hop_futures, emit)
+            for i, block in enumerate(blocks) if block
+        ]
+
+        # Position of every frequency in freq_list (list.index() would be O(n^2) for large plans)
+        freq_index = {}
+        for i, freq in enumerate(freq_list):
+            freq_index.setdefault(freq, i)
+
+        try:
+            for key in sorted(hop_futures, key=lambda key: (freq_index[key[0]], key[1])):
+                try:
+                    yield hop_futures[key].result()
+                except concurrent.futures.CancelledError:
+                    break
+        finally:
+            # Wait for all devices to finish current run
+            concurrent.futures.wait(block_futures)
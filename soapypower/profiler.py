@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import os, re, sys, logging, threading, collections
+
+logger = logging.getLogger(__name__)
+
+# Python functions in which threads are blocked (waiting for lock, condition, queue or other thread)
+wait_functions = (('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'))
+
+
+def thread_group(name):
+    """Return name of group of threads (thread name without number of thread in pool)"""
+    return re.sub(r'_\d+$', '', name)
+
+
+def format_function(function):
+    """Return function as human-readable string"""
+    filename, lineno, name = function
+    return '{} ({}:{})'.format(name, os.path.basename(filename), lineno)
+
+
+class SamplingProfiler:
+    """Low-overhead sampling profiler of all threads (main thread, PSD threads and writer thread)
+
+    Call stacks of all threads are sampled in separate thread every interval seconds, so profiled
+    threads are not slowed down by tracing of every function call.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.defaultdict(collections.Counter)
+        self.sample_count = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling of call stacks in separate thread"""
+        self._thread = threading.Thread(target=self._run, name='Profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling of call stacks"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """Sample call stacks of all threads (runs in separate thread)"""
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[names.get(ident, str(ident))][tuple(stack)] += 1
+            self.sample_count += 1
+
+    @staticmethod
+    def is_waiting(stack):
+        """Is thread blocked in given call stack?"""
+        return bool(stack) and (os.path.basename(stack[-1][0]), stack[-1][2]) in wait_functions
+
+    @staticmethod
+    def function_stats(stacks):
+        """Return number of samples in which function was on top of stack (self) and anywhere in stack (cumulative)"""
+        self_samples = collections.Counter()
+        cumulative_samples = collections.Counter()
+        for stack, count in stacks.items():
+            if stack:
+                self_samples[stack[-1]] += count
+            for function in set(stack):
+                cumulative_samples[function] += count
+        return (self_samples, cumulative_samples)
+
+    def thread_report(self, name, stacks, limit=30):
+        """Return report with most frequently sampled functions of thread"""
+        samples = sum(stacks.values())
+        waiting = sum(count for stack, count in stacks.items() if self.is_waiting(stack))
+        self_samples, cumulative_samples = self.function_stats(stacks)
+
+        lines = [
+            'Thread: {}'.format(name),
+            'Samples: {} (~{:.3f} s), waiting: {:.1f} %'.format(
+                samples, samples * self.interval, 100 * waiting / samples if samples else 0
+            ),
+            '',
+            '{:>8s} {:>8s}  {}'.format('self %', 'cum. %', 'function'),
+        ]
+        for function, count in cumulative_samples.most_common(limit):
+            lines.append('{:8.1f} {:8.1f}  {}'.format(
+                100 * self_samples[function] / samples, 100 * count / samples, format_function(function)
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, limit=5):
+        """Return merged summary of all groups of threads (busy time and functions where busy time is spent)"""
+        groups = collections.OrderedDict()
+        for name in sorted(self.stacks, key=lambda name: (name != 'MainThread', name)):
+            group = groups.setdefault(thread_group(name), {'threads': 0, 'stacks': collections.Counter()})
+            group['threads'] += 1
+            group['stacks'].update(self.stacks[name])
+
+        lines = [
+            'Sampling interval: {} s, samples: {} (~{:.3f} s)'.format(
+                self.interval, self.sample_count, self.sample_count * self.interval
+            ),
+            '',
+            '{:24s} {:>8s} {:>10s} {:>8s}'.format('Threads:', 'Count:', 'Samples:', 'Busy %:'),
+        ]
+        busy_stacks = {}
+        for name, group in groups.items():
+            samples = sum(group['stacks'].values())
+            busy_stacks[name] = {stack: count for stack, count in group['stacks'].items() if not self.is_waiting(stack)}
+            busy = sum(busy_stacks[name].values())
+            # Busy time relative to time of all threads in group (100 % = all threads busy all the time)
+            lines.append('{:24s} {:8d} {:10d} {:8.1f}'.format(
+                name, group['threads'], samples, 100 * busy / samples if samples else 0
+            ))
+
+        for name in groups:
+            self_samples = self.function_stats(busy_stacks[name])[0]
+            busy = sum(self_samples.values())
+            if not busy:
+                continue
+            lines.append('')
+            lines.append('{} - top functions of busy time:'.format(name))
+            for function, count in self_samples.most_common(limit):
+                lines.append('  {:6.1f} %  {}'.format(100 * count / busy, format_function(function)))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, directory):
+        """Save report and collapsed call stacks (for flame graph tools) of every thread and merged summary"""
+        os.makedirs(directory, exist_ok=True)
+        for name, stacks in self.stacks.items():
+            filename = re.sub(r'[^\w.-]', '_', name)
+            with open(os.path.join(directory, '{}.txt'.format(filename)), 'w') as f:
+                f.write(self.thread_report(name, stacks))
+            with open(os.path.join(directory, '{}.folded'.format(filename)), 'w') as f:
+                for stack, count in stacks.items():
+                    f.write('{} {}\n'.format(';'.join(function[2] for function in stack), count))
+
+        summary = self.summary()
+        with open(os.path.join(directory, 'summary.txt'), 'w') as f:
+            f.write(summary)
+        logger.info('Profile saved to {}'.format(directory))
+        for line in summary.splitlines():
+            logger.debug('  {}'.format(line))
@@ -1,20 +1,189 @@
 #!/usr/bin/env python3
 
-import math, logging, threading, concurrent.futures
+import math, time, logging, threading, collections, concurrent.futures
 
 import numpy
 import simplespectral
 
-from soapypower import threadpool
+from soapypower import threadpool, bufferpool
+from soapypower.detector import Detector, modes as detector_modes
 
 logger = logging.getLogger(__name__)
 
+# Maximal number of samples processed by one batched FFT (limits size of per-thread work arrays)
+max_batch_size = 2**20
+
+
+class Welch:
+    """Batched Welch's method engine (sum of squared magnitudes of FFT of windowed segments)"""
+    def __init__(self, bins, sample_rate, fft_window='hann', fft_overlap_bins=0, detrend=None):
+        self._bins = bins
+        self._fft_overlap_bins = fft_overlap_bins
+        self._fft_step = self._bins - self._fft_overlap_bins
+        self._batch_rows = max(1, max_batch_size // self._bins)
+        self._detrend = detrend
+        if self._detrend and self._detrend != 'constant':
+            self._detrend_func = self._detrend if callable(self._detrend) else simplespectral.get_detrend(self._detrend)
+
+        # Window and its normalisation (PSD scaling) are computed only once
+        window = simplespectral.get_window(fft_window, self._bins)
+        self._window = window.astype(numpy.float32)
+        self.scale = 1.0 / (sample_rate * (window * window).sum())
+
+        self._local = threading.local()
+
+    def _fft_backend(self):
+        """Return name of FFT backend selected by simplespectral"""
+        if simplespectral.fft_pyfftw and simplespectral.use_pyfftw:
+            return 'pyfftw'
+        elif simplespectral.fft_scipy:
+            return 'scipy'
+        else:
+            return 'numpy'
+
+    def _fft_plan(self, rows):
+        """Return preallocated work array and in-place FFT function for given number of segments
+
+        Plans are cached per thread, so PSD threads never share work arrays.
+        """
+        try:
+            plans = self._local.plans
+        except AttributeError:
+            plans = self._local.plans = {}
+
+        backend = self._fft_backend()
+        try:
+            return plans[(rows, backend)]
+        except KeyError:
+            pass
+
+        # Buffers have constant size, so there are only plans for full batch and for the rest of buffer
+        if len(plans) >= 4:
+            plans.clear()
+
+        work = simplespectral.empty((rows, self._bins), numpy.complex64)
+        if backend == 'pyfftw':
+            fft_object = simplespectral.pyfftw.FFTW(work, work, axes=(-1,), threads=simplespectral.fft_threads,
+                                                    flags=('FFTW_ESTIMATE',))
+
+            def fft(x):
+                return fft_object()
+        elif backend == 'scipy':
+            def fft(x):
+                return simplespectral.scipy.fftpack.fft(x, axis=-1, overwrite_x=True)
+        else:
+            def fft(x):
+                try:
+                    return numpy.fft.fft(x, axis=-1, out=x)
+                except TypeError:
+                    # NumPy < 2.0 doesn't support out argument
+                    return numpy.fft.fft(x, axis=-1)
+
+        plans[(rows, backend)] = (work, fft)
+        return (work, fft)
+
+    def _sum_array(self):
+        """Return per-thread temporary array for summing of segments"""
+        try:
+            return self._local.sum_array
+        except AttributeError:
+            self._local.sum_array = numpy.empty(2 * self._bins, numpy.float32)
+            return self._local.sum_array
+
+    def segments(self, size):
+        """Return number of complete segments in given number of samples"""
+        return max(0, (size - self._fft_overlap_bins) // self._fft_step)
+
+    def welch(self, samples_array, pwr_sum):
+        """Add |FFT|^2 of all windowed segments of samples to pwr_sum, return number of segments
+           (pwr_sum has squared real and imaginary parts of every bin interleaved)
+
+        Samples are viewed as 2-D matrix of (overlapping) segments without copying
+        and FFT of whole batch of segments is computed at once.
+        """
+        segments = self.segments(len(samples_array))
+        if not segments:
+            return 0
+
+        frames = numpy.lib.stride_tricks.as_strided(
+            samples_array, shape=(segments, self._bins),
+            strides=(self._fft_step * samples_array.strides[-1], samples_array.strides[-1]),
+            writeable=False
+        )
+
+        sum_array = self._sum_array()
+        for start in range(0, segments, self._batch_rows):
+            batch = frames[start:start + self._batch_rows]
+            work, fft = self._fft_plan(len(batch))
+
+            if self._detrend == 'constant':
+                numpy.subtract(batch, batch.mean(axis=-1, keepdims=True), out=work)
+                work *= self._window
+            elif self._detrend:
+                work[:] = self._detrend_func(batch)
+                work *= self._window
+            else:
+                numpy.multiply(batch, self._window, out=work)
+
+            spectrum = fft(work)
+            spectrum = spectrum.view(spectrum.real.dtype).reshape(len(batch), 2 * self._bins)
+            numpy.square(spectrum, out=spectrum)
+            numpy.sum(spectrum, axis=0, out=sum_array)
+            pwr_sum += sum_array
+
+        return segments
+
+    def compute(self, samples_array):
+        """Return sum of |FFT|^2 of all windowed segments of samples and number of segments"""
+        pwr_sum = numpy.zeros(2 * self._bins, numpy.float64)
+        segments = self.welch(samples_array, pwr_sum)
+        return (pwr_sum[0::2] + pwr_sum[1::2], segments)
+
+
+# Shared memory segments and Welch engines cached in PSD worker processes
+_process_shared_memory = {}
+_process_welch = {}
+
+
+def _process_compute(welch_args, shm_name, offset, size):
+    """Compute Welch's method sums from samples in shared memory (runs in PSD worker process)"""
+    try:
+        shm = _process_shared_memory[shm_name]
+    except KeyError:
+        shm = _process_shared_memory[shm_name] = bufferpool.attach_shared_memory(shm_name)
+
+    try:
+        welch = _process_welch[welch_args]
+    except KeyError:
+        _process_welch.clear()
+        welch = _process_welch[welch_args] = Welch(*welch_args)
+
+    samples_array = numpy.ndarray(size, numpy.complex64, buffer=shm.buf, offset=offset)
+    try:
+        return welch.compute(samples_array)
+    finally:
+        del samples_array
+
+
+# Precomputed frequency axis of one frequency hop (fftshifted and cropped)
+HopPlan = collections.namedtuple('HopPlan', 'center_freq freq_array')
+
+decimation_modes = ('mean', 'max', 'percentile')
+
 
 class PSD:
     """Compute averaged power spectral density using Welch's method"""
     def __init__(self, bins, sample_rate, fft_window='hann', fft_overlap=0.5,
                  crop_factor=0, log_scale=True, remove_dc=False, detrend=None,
-                 lnb_lo=0, max_threads=0, max_queue_size=0):
+                 lnb_lo=0, max_threads=0, max_queue_size=0, backend='threads', detector=None, detector_alpha=0.1,
+                 decimation=1, decimation_bins=0, decimation_mode='mean', decimation_percentile=50, metrics=None):
+        """Create PSD calculator
+
+        decimation ... pool every N neighbouring output bins to one bin (trailing bins are dropped)
+        decimation_bins ... pool output bins to given number of bins (overrides decimation)
+        decimation_mode ... mean, max or percentile of pooled bins
+        metrics ... metrics.Metrics instance for recording of PSD queue wait and FFT time
+        """
         self._bins = bins
         self._sample_rate = sample_rate
         self._fft_window = fft_window
@@ -25,44 +194,233 @@ class PSD:
         self._remove_dc = remove_dc
         self._detrend = detrend
         self._lnb_lo = lnb_lo
+        self._welch_args = (self._bins, self._sample_rate, self._fft_window, self._fft_overlap_bins, self._detrend)
+        self._welch = Welch(*self._welch_args)
+        self._metrics = metrics
+
         self._executor = threadpool.ThreadPoolExecutor(
             max_workers=max_threads,
             max_queue_size=max_queue_size,
-            thread_name_prefix='PSD_thread'
+            thread_name_prefix='PSD_thread',
+            queue_wait_callback=self._queue_wait if metrics else None
         )
-        self._base_freq_array = numpy.fft.fftfreq(self._bins, 1 / self._sample_rate)
 
-    def set_center_freq(self, center_freq):
-        """Set center frequency and clear averaged PSD data"""
+        # PSD threads only pass samples in shared memory to worker processes and wait for results
+        self._process_executor = None
+        if backend == 'processes':
+            self._process_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self._executor._max_workers)
+        elif backend != 'threads':
+            raise ValueError('Unknown PSD backend: {}'.format(backend))
+
+        # Frequency axis and fftshift + crop of PSD are same for all hops, so they are computed only once
+        # (shifted and cropped PSD is copied by contiguous slices, result index of every bin is in _result_index)
+        crop_bins_half = round((self._crop_factor * self._bins) / 2) if self._crop_factor else 0
+        self._result_index = numpy.fft.fftshift(numpy.arange(self._bins))[crop_bins_half:self._bins - crop_bins_half]
+        self._result_slices = self._index_to_slices(self._result_index)
+        self._result_dc = int(numpy.flatnonzero(self._result_index == 0)[0])
+        self._base_freq_array = numpy.fft.fftfreq(self._bins, 1 / self._sample_rate)[self._result_index]
+
+        # Output bins are pooled by decimation factor (frequency of pooled bin is frequency of its first bin,
+        # so step of frequency axis is multiplied by decimation factor)
+        if decimation_mode not in decimation_modes:
+            raise ValueError('Unknown decimation mode: {}'.format(decimation_mode))
+        if decimation_bins:
+            decimation = max(len(self._result_index) // decimation_bins, 1)
+        self._decimation = decimation
+        self._decimation_mode = decimation_mode
+        self._decimation_percentile = decimation_percentile
+        self._output_bins = len(self._result_index) // self._decimation
+        self._base_freq_array = self._base_freq_array[:self._output_bins * self._decimation:self._decimation]
+
+        # Hop plans (cached frequency axes of hops) and recycled buffers for PSD results
+        self._plans = {}
+        self._result_pool = bufferpool.BufferPool(self._output_bins, 0, dtype=numpy.float32, grow=True)
+        if self._decimation > 1:
+            self._full_result_pool = bufferpool.BufferPool(len(self._result_index), 0, dtype=numpy.float32,
+                                                           grow=True)
+
+        # Detectors of all hops and last result futures of all hops (results of hop are processed in order)
+        if detector is not None and detector not in detector_modes:
+            raise ValueError('Unknown detector mode: {}'.format(detector))
+        self._detector = detector
+        self._detector_alpha = detector_alpha
+        self._detectors = {}
+        self._last_results = {}
+
+    @property
+    def output_bins(self):
+        """Number of output bins (after crop and decimation, read-only)"""
+        return self._output_bins
+
+    @staticmethod
+    def _index_to_slices(index):
+        """Convert index array to list of (source slice, destination slice) tuples of contiguous runs"""
+        breaks = numpy.flatnonzero(numpy.diff(index) != 1) + 1
+        bounds = [0] + breaks.tolist() + [len(index)]
+        return [
+            (slice(int(index[start]), int(index[stop - 1]) + 1), slice(start, stop))
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def plan(self, freq_list):
+        """Precompute hop plans (shifted and cropped frequency axes) of all frequency hops"""
+        for center_freq in freq_list:
+            self.hop_plan(center_freq)
+
+    def hop_plan(self, center_freq):
+        """Return hop plan for given center frequency (it is created if it doesn't exist yet)"""
+        try:
+            return self._plans[center_freq]
+        except KeyError:
+            freq_array = self._base_freq_array + self._lnb_lo + center_freq
+            freq_array.flags.writeable = False
+            plan = self._plans[center_freq] = HopPlan(center_freq, freq_array)
+            return plan
+
+    def set_center_freq(self, center_freq, emit=True, channel=0):
+        """Set center frequency and clear averaged PSD data
+
+        If detector is enabled and emit is True, result contains detected PSD of all runs
+        since last output (otherwise it contains PSD of current run only). Detectors of different
+        channels measuring same frequency are independent.
+        """
         psd_state = {
             'repeats': 0,
-            'freq_array': self._base_freq_array + self._lnb_lo + center_freq,
+            'segments': 0,
+            'plan': self.hop_plan(center_freq),
             'pwr_array': None,
-            'update_lock': threading.Lock(),
+            'partials': {},
             'futures': [],
+            'emit': emit,
+            'previous': None,
+            'detector_key': (center_freq, channel),
         }
         return psd_state
 
+    def consumed_samples(self, size):
+        """Return number of samples after which next segment would start
+           (samples after this position are needed for computing of next segments)"""
+        return self._welch.segments(size) * (self._bins - self._fft_overlap_bins)
+
+    def reduce(self, psd_state):
+        """Sum partial PSD data of all PSD threads (call only after all updates are finished)"""
+        for partial in psd_state['partials'].values():
+            psd_state['repeats'] += partial['repeats']
+            psd_state['segments'] += partial['segments']
+            pwr_sum = partial['pwr_sum']
+            if psd_state['pwr_array'] is None:
+                # Sum real and imaginary parts in place (result is strided view into partial sum)
+                psd_state['pwr_array'] = numpy.add(pwr_sum[0::2], pwr_sum[1::2], out=pwr_sum[0::2])
+            else:
+                psd_state['pwr_array'] += pwr_sum[0::2]
+                psd_state['pwr_array'] += pwr_sum[1::2]
+        psd_state['partials'] = {}
+
     def result(self, psd_state):
-        """Return freqs and averaged PSD for given center frequency"""
-        freq_array = numpy.fft.fftshift(psd_state['freq_array'])
-        pwr_array = numpy.fft.fftshift(psd_state['pwr_array'])
+        """Return freqs and averaged PSD for given center frequency
+
+        PSD is written to recycled buffer, return it back by release_result() when it is not needed anymore.
+        If hop has no complete segment (e.g. acquisition was interrupted), PSD is filled with NaN.
+        """
+        self.reduce(psd_state)
+        if not psd_state['segments']:
+            logger.warning('No complete segment of samples in hop {:.2f} Hz, writing NaN instead of PSD'.format(
+                psd_state['plan'].center_freq
+            ))
+            pwr_array = self._result_pool.acquire()
+            pwr_array.fill(numpy.nan)
+            return (psd_state['plan'].freq_array, pwr_array)
+
+        pwr_array = self._result_pool.acquire() if self._decimation == 1 else self._full_result_pool.acquire()
+
+        # Normalize, fftshift and crop PSD at once
+        factor = self._welch.scale / psd_state['segments']
+        for src, dst in self._result_slices:
+            numpy.multiply(psd_state['pwr_array'][src], factor, out=pwr_array[dst])
 
-        if self._crop_factor:
-            crop_bins_half = round((self._crop_factor * self._bins) / 2)
-            freq_array = freq_array[crop_bins_half:-crop_bins_half]
-            pwr_array = pwr_array[crop_bins_half:-crop_bins_half]
+        if self._remove_dc:
+            dc = self._result_dc
+            pwr_array[dc] = (pwr_array[dc + 1] + pwr_array[dc - 1]) / 2
+
+        if self._decimation > 1:
+            full_pwr_array = pwr_array
+            pwr_array = self._result_pool.acquire()
+            self.decimate(full_pwr_array, pwr_array)
+            self._full_result_pool.release(full_pwr_array)
 
-        if psd_state['repeats'] > 1:
-            pwr_array = pwr_array / psd_state['repeats']
+        if self._detector:
+            key = psd_state['detector_key']
+            try:
+                detector = self._detectors[key]
+            except KeyError:
+                detector = self._detectors[key] = Detector(self._detector, len(pwr_array), alpha=self._detector_alpha)
+            detector.update(pwr_array)
+            if psd_state['emit']:
+                detector.output(pwr_array)
 
         if self._log_scale:
-            pwr_array = 10 * numpy.log10(pwr_array)
+            numpy.log10(pwr_array, out=pwr_array)
+            pwr_array *= 10
+
+        return (psd_state['plan'].freq_array, pwr_array)
+
+    def detector_result(self, key, previous=None):
+        """Return freqs and current output of detector of hop (after previous result of hop is finished)"""
+        if previous:
+            concurrent.futures.wait([previous])
+
+        pwr_array = self._result_pool.acquire()
+        detector = self._detectors.get(key)
+        if detector is None or not detector.count:
+            pwr_array.fill(numpy.nan)
+            return (self.hop_plan(key[0]).freq_array, pwr_array)
+
+        detector.output(pwr_array)
+        if self._log_scale:
+            numpy.log10(pwr_array, out=pwr_array)
+            pwr_array *= 10
+        return (self.hop_plan(key[0]).freq_array, pwr_array)
+
+    def detector_results_async(self, center_freq):
+        """Return list of (channel, future) with output of all detectors of hop (asynchronously in another thread)
+
+        Used for writing detectors which haven't been output since their last update (e.g. at the end of sweep).
+        """
+        results = []
+        for key in [key for key in self._last_results if key[0] == center_freq]:
+            previous = self._last_results[key]
+            future = self._last_results[key] = self._executor.submit(self.detector_result, key, previous)
+            results.append((key[1], future))
+        return results
 
-        return (freq_array, pwr_array)
+    def decimate(self, pwr_array, out):
+        """Pool every N neighbouring bins of PSD (in linear scale) to one bin of out array"""
+        pooled = pwr_array[:self._output_bins * self._decimation].reshape(self._output_bins, self._decimation)
+        if self._decimation_mode == 'mean':
+            numpy.mean(pooled, axis=1, out=out)
+        elif self._decimation_mode == 'max':
+            numpy.max(pooled, axis=1, out=out)
+        else:
+            numpy.percentile(pooled, self._decimation_percentile, axis=1, out=out)
+
+    def release_result(self, pwr_array):
+        """Return buffer with PSD result back to pool"""
+        self._result_pool.release(pwr_array)
+
+    def release_result_when_done(self, future, psd_future):
+        """Return buffer with PSD result of psd_future back to pool after future (e.g. writing of PSD) is done"""
+        def release(f):
+            if not psd_future.cancelled() and psd_future.exception() is None:
+                self.release_result(psd_future.result()[1])
+        future.add_done_callback(release)
 
     def wait_for_result(self, psd_state):
         """Wait for all PSD threads to finish and return result"""
+        # Detectors must be updated by results of hop in same order as they were acquired
+        if psd_state['previous']:
+            concurrent.futures.wait([psd_state['previous']])
+            psd_state['previous'] = None
+
         if len(psd_state['futures']) > 1:
             concurrent.futures.wait(psd_state['futures'])
         elif psd_state['futures']:
@@ -71,27 +429,51 @@ class PSD:
 
     def result_async(self, psd_state):
         """Return freqs and averaged PSD for given center frequency (asynchronously in another thread)"""
+        if self._detector:
+            key = psd_state['detector_key']
+            psd_state['previous'] = self._last_results.get(key)
+            future = self._last_results[key] = self._executor.submit(self.wait_for_result, psd_state)
+            return future
         return self._executor.submit(self.wait_for_result, psd_state)
 
+    def _queue_wait(self, t):
+        """Record time spent by task in PSD queue"""
+        self._metrics.observe('psd_queue_wait_seconds', t)
+
     def _release_future_memory(self, future):
         """Remove result from future to release memory"""
         future._result = None
 
     def update(self, psd_state, samples_array):
         """Compute PSD from samples and update average for given center frequency"""
-        freq_array, pwr_array = simplespectral.welch(samples_array, self._sample_rate, nperseg=self._bins,
-                                                     window=self._fft_window, noverlap=self._fft_overlap_bins,
-                                                     detrend=self._detrend)
+        # Every PSD thread accumulates into its own partial sum, so no locking is needed
+        # (partial sums are added together by reduce() when all updates are finished)
+        thread_id = threading.get_ident()
+        try:
+            partial = psd_state['partials'][thread_id]
+        except KeyError:
+            partial = psd_state['partials'][thread_id] = {
+                'repeats': 0,
+                'segments': 0,
+                'pwr_sum': numpy.zeros(2 * self._bins, numpy.float64),
+            }
 
-        if self._remove_dc:
-            pwr_array[0] = (pwr_array[1] + pwr_array[-1]) / 2
+        t = time.time()
+        shm_name = getattr(samples_array, 'shm_name', None)
+        if self._process_executor and shm_name:
+            pwr_array, segments = self._process_executor.submit(
+                _process_compute, self._welch_args, shm_name, samples_array.shm_offset, len(samples_array)
+            ).result()
+            partial['pwr_sum'][0::2] += pwr_array
+        else:
+            segments = self._welch.welch(samples_array, partial['pwr_sum'])
+        t_fft = time.time() - t
+        logger.debug('FFT time: {:.3f} s'.format(t_fft))
+        if self._metrics:
+            self._metrics.observe('fft_seconds', t_fft)
 
-        with psd_state['update_lock']:
-            psd_state['repeats'] += 1
-            if psd_state['pwr_array'] is None:
-                psd_state['pwr_array'] = pwr_array
-            else:
-                psd_state['pwr_array'] += pwr_array
+        partial['repeats'] += 1
+        partial['segments'] += segments
 
     def update_async(self, psd_state, samples_array):
         """Compute PSD from samples and update average for given center frequency (asynchronously in another thread)"""
@@ -99,3 +481,14 @@ class PSD:
         future.add_done_callback(self._release_future_memory)
         psd_state['futures'].append(future)
         return future
+
+    def reset(self):
+        """Clear state of detectors (when PSD calculator is reused for new sweep)"""
+        self._detectors.clear()
+        self._last_results.clear()
+
+    def shutdown(self):
+        """Shutdown PSD threads (and worker processes)"""
+        self._executor.shutdown()
+        if self._process_executor:
+            self._process_executor.shutdown()
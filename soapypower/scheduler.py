@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import math, time, logging, threading
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+class Hop:
+    """Activity state of one frequency hop"""
+    def __init__(self, freq):
+        self.freq = freq
+        self.score = math.inf
+        self.noise_floor = None
+        self.last_pwr = None
+        self.last_visit = -math.inf
+        self.visits = 0
+
+
+class AdaptiveScheduler:
+    """Frequency hopping scheduler revisiting active hops more often than quiet hops
+
+    Activity score of hop is excess of its maximal power over its noise floor (EMA of median power)
+    or maximal change of power between two last visits (both in dB). Hops with score above threshold
+    are active and they are visited in every cycle, quiet hops are visited only when needed to
+    not exceed maximal revisit interval (at least one quiet hop is visited in every cycle).
+    Hops which haven't been visited yet are always active.
+    """
+    def __init__(self, freq_list, max_revisit=60, threshold=10, log_scale=True, noise_floor_alpha=0.1):
+        self.hops = [Hop(freq) for freq in freq_list]
+        self.max_revisit = max_revisit
+        self.threshold = threshold
+        self.log_scale = log_scale
+        self.noise_floor_alpha = noise_floor_alpha
+
+        self._hops_by_freq = {hop.freq: hop for hop in self.hops}
+        self._lock = threading.Lock()
+        self._hop_time = 0
+        self._t_cycle = None
+        self._cycle_size = 0
+
+    def is_active(self, hop):
+        """Is hop active? (hops which haven't been evaluated yet are active too)"""
+        return hop.score >= self.threshold
+
+    def next_cycle(self):
+        """Return list of frequencies which should be visited in next cycle (sorted by frequency)"""
+        t = time.time()
+        if self._t_cycle is not None and self._cycle_size:
+            self._hop_time = (t - self._t_cycle) / self._cycle_size
+        self._t_cycle = t
+
+        with self._lock:
+            active = [hop for hop in self.hops if self.is_active(hop)]
+            quiet = sorted((hop for hop in self.hops if not self.is_active(hop)), key=lambda hop: hop.last_visit)
+
+        # Always visit the most overdue quiet hop, other quiet hops only if they would exceed
+        # max. revisit interval before end of next cycle
+        cycle = list(active) + quiet[:1]
+        for hop in quiet[1:]:
+            if hop.last_visit + self.max_revisit <= t + self._hop_time * (len(cycle) + 1):
+                cycle.append(hop)
+            else:
+                break
+
+        logger.debug('Adaptive schedule: {} active hops, {} of {} quiet hops'.format(
+            len(active), len(cycle) - len(active), len(quiet)
+        ))
+
+        self._cycle_size = len(cycle)
+        return sorted(hop.freq for hop in cycle)
+
+    def watch(self, freq, psd_future, write_future):
+        """Update activity score of hop after its PSD is written (PSD result is valid until then)"""
+        hop = self._hops_by_freq[freq]
+        hop.last_visit = time.time()
+        write_future.add_done_callback(lambda f: self.update(hop, psd_future.result()[1]))
+
+    def update(self, hop, pwr_array):
+        """Update activity score of hop from its new PSD"""
+        pwr_array = numpy.asarray(pwr_array, dtype=numpy.float32)
+        if not self.log_scale:
+            with numpy.errstate(divide='ignore'):
+                pwr_array = 10 * numpy.log10(pwr_array)
+
+        # Ignore non-finite values (e.g. log10 of zero power)
+        finite = numpy.isfinite(pwr_array)
+        if not finite.any():
+            return
+        median = float(numpy.median(pwr_array[finite]))
+        if not finite.all():
+            pwr_array = numpy.where(finite, pwr_array, median)
+
+        with self._lock:
+            if hop.noise_floor is None:
+                hop.noise_floor = median
+            else:
+                hop.noise_floor += self.noise_floor_alpha * (median - hop.noise_floor)
+
+            score = float(numpy.max(pwr_array)) - hop.noise_floor
+            if hop.last_pwr is not None and len(hop.last_pwr) == len(pwr_array):
+                score = max(score, float(numpy.max(numpy.abs(pwr_array - hop.last_pwr))))
+
+            hop.score = score
+            hop.last_pwr = pwr_array.copy()
+            hop.visits += 1
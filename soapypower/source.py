@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+
+import os, math, time, logging, threading, collections
+
+import numpy
+
+try:
+    import simplesoapy, SoapySDR
+except ImportError:
+    simplesoapy = None
+
+logger = logging.getLogger(__name__)
+
+# Same return value as SoapySDR.Device.readStream()
+StreamResult = collections.namedtuple('StreamResult', 'ret flags timeNs')
+
+# SoapySDR error code returned by readStream() on buffer overflow
+SOAPY_SDR_OVERFLOW = -4
+
+
+class BaseSource:
+    """Sample source base class (implements streaming API of simplesoapy.SoapyDevice)"""
+    default_buffer_size = 8192
+    hardware = 'BaseSource'
+
+    def __init__(self, sample_rate=2.00e6, buffer_size=0, realtime=False):
+        # SoapyPower calls deactivateStream() / activateStream() on device.device
+        self.device = self
+        self.buffer = None
+        self.buffer_size = buffer_size
+        self.buffer_overflow_count = 0
+        self.stream = None
+        self.sample_rate = sample_rate
+        self.realtime = realtime
+
+        self._freq = None
+        self._t_next_read = None
+
+    @property
+    def is_streaming(self):
+        """Has been start_stream() already called? (read-only)"""
+        return bool(self.stream)
+
+    @property
+    def freq(self):
+        """Center frequency [Hz]"""
+        return self._freq
+
+    @freq.setter
+    def freq(self, freq):
+        """Set center frequency [Hz]"""
+        self._freq = freq
+
+    def start_stream(self, buffer_size=0, stream_args=None, stream_timeout=0):
+        """Start streaming samples"""
+        if self.is_streaming:
+            raise RuntimeError('Streaming has been already initialized!')
+
+        buffer_size = buffer_size or self.buffer_size or self.default_buffer_size
+        self.stream = True
+        self.buffer = numpy.empty(buffer_size, numpy.complex64)
+        self.buffer_overflow_count = 0
+        self._t_next_read = time.time()
+        logger.debug('{} stream - buffer size: {}'.format(self.hardware, buffer_size))
+
+        return self.buffer
+
+    def stop_stream(self):
+        """Stop streaming samples"""
+        if not self.is_streaming:
+            raise RuntimeError('Streaming is not initialized, you must run start_stream() first!')
+
+        self.stream = None
+        self.buffer = None
+
+    def activateStream(self, stream):
+        """Reactivate streaming (restarts real-time pacing of samples)"""
+        self._t_next_read = time.time()
+
+    def deactivateStream(self, stream):
+        """Deactivate streaming"""
+        pass
+
+    def read_samples(self, buffer):
+        """Fill buffer with samples, return number of samples read or negative SoapySDR error code"""
+        raise NotImplementedError
+
+    def read_stream(self, stream_timeout=0):
+        """Read samples into buffer"""
+        if not self.is_streaming:
+            raise RuntimeError('Streaming is not initialized, you must run start_stream() first!')
+
+        # Emulate sample rate of real device
+        if self.realtime:
+            self._t_next_read += len(self.buffer) / self.sample_rate
+            t_sleep = self._t_next_read - time.time()
+            if t_sleep > 0:
+                time.sleep(t_sleep)
+
+        return StreamResult(self.read_samples(self.buffer), 0, 0)
+
+    def read_stream_into_buffer(self, output_buffer):
+        """Read samples into supplied output_buffer (blocks until output_buffer is full)"""
+        output_buffer_size = len(output_buffer)
+        ptr = 0
+        while True:
+            res = self.read_stream()
+            if res.ret > 0:
+                output_buffer[ptr:ptr + res.ret] = self.buffer[:min(res.ret, output_buffer_size - ptr)]
+                ptr += res.ret
+            elif res.ret == SOAPY_SDR_OVERFLOW:
+                self.buffer_overflow_count += 1
+                logger.debug('Buffer overflow error in readStream ({:d})!'.format(self.buffer_overflow_count))
+                logger.debug('Value of ptr when overflow happened: {}'.format(ptr))
+            else:
+                raise RuntimeError('Unhandled readStream() error: {}'.format(res.ret))
+
+            if ptr >= len(output_buffer):
+                return
+
+
+class SimulatedSource(BaseSource):
+    """Synthetic sample source (sine tones in complex white noise)"""
+    hardware = 'Simulated'
+
+    def __init__(self, sample_rate=2.00e6, buffer_size=0, realtime=False, tones=None, noise=-90,
+                 overflow=0, tuning_latency=0, seed=None):
+        """Create synthetic sample source
+
+        tones ... list of (frequency [Hz], power [dBFS]) tuples
+        noise ... noise power [dBFS] (None = no noise)
+        overflow ... probability of buffer overflow error per readStream() call
+        tuning_latency ... time spent by changing center frequency [s]
+        """
+        super().__init__(sample_rate=sample_rate, buffer_size=buffer_size, realtime=realtime)
+        self.tones = list(tones or [])
+        self.noise = noise
+        self.overflow = overflow
+        self.tuning_latency = tuning_latency
+
+        self._random = numpy.random.RandomState(seed)
+        self._noise_block = None
+        self._sample_counter = 0
+
+    @property
+    def freq(self):
+        """Center frequency [Hz]"""
+        return self._freq
+
+    @freq.setter
+    def freq(self, freq):
+        """Set center frequency [Hz]"""
+        if self.tuning_latency:
+            time.sleep(self.tuning_latency)
+        self._freq = freq
+
+    def start_stream(self, buffer_size=0, stream_args=None, stream_timeout=0):
+        """Start streaming samples"""
+        buffer = super().start_stream(buffer_size=buffer_size, stream_args=stream_args,
+                                      stream_timeout=stream_timeout)
+
+        # Generating gaussian noise is expensive, so pregenerate a few buffers of noise
+        # and use random part of them in every readStream() call
+        if self.noise is not None:
+            noise_size = 8 * len(buffer)
+            noise_amplitude = math.sqrt(10**(self.noise / 10) / 2)
+            self._noise_block = (
+                self._random.standard_normal(noise_size) + 1j * self._random.standard_normal(noise_size)
+            ).astype(numpy.complex64)
+            self._noise_block *= noise_amplitude
+        self._sample_counter = 0
+
+        return buffer
+
+    def read_samples(self, buffer):
+        """Fill buffer with samples, return number of samples read or negative SoapySDR error code"""
+        if self.overflow and self._random.random_sample() < self.overflow:
+            self._sample_counter += len(buffer)
+            return SOAPY_SDR_OVERFLOW
+
+        if self._noise_block is not None:
+            offset = self._random.randint(len(self._noise_block) - len(buffer) + 1)
+            buffer[:] = self._noise_block[offset:offset + len(buffer)]
+        else:
+            buffer[:] = 0
+
+        if self.tones:
+            t = numpy.arange(self._sample_counter, self._sample_counter + len(buffer)) / self.sample_rate
+            for tone_freq, tone_power in self.tones:
+                tone_offset = tone_freq - (self._freq or 0)
+                if abs(tone_offset) < self.sample_rate / 2:
+                    buffer += (math.sqrt(10**(tone_power / 10)) *
+                               numpy.exp(2j * numpy.pi * tone_offset * t)).astype(numpy.complex64)
+
+        self._sample_counter += len(buffer)
+        return len(buffer)
+
+
+class FileSource(BaseSource):
+    """Sample source replaying raw IQ samples (complex64) from file or memory (ignores tuning)"""
+    hardware = 'File'
+
+    def __init__(self, samples, sample_rate=2.00e6, buffer_size=0, realtime=False, loop=True):
+        """Create replay sample source
+
+        samples ... path to raw IQ file (interleaved float32 I and Q, memory-mapped) or numpy array
+        loop ... start again from beginning when all samples have been read
+        """
+        super().__init__(sample_rate=sample_rate, buffer_size=buffer_size, realtime=realtime)
+        if isinstance(samples, (str, bytes, os.PathLike)):
+            samples = numpy.memmap(samples, dtype=numpy.complex64, mode='r')
+        self.samples = samples
+        self.loop = loop
+
+        if not len(self.samples):
+            raise ValueError('No samples to replay!')
+
+        self._ptr = 0
+
+    def read_samples(self, buffer):
+        """Fill buffer with samples, return number of samples read or negative SoapySDR error code"""
+        ptr = 0
+        while ptr < len(buffer):
+            if self._ptr >= len(self.samples):
+                if not self.loop:
+                    raise RuntimeError('End of replayed samples reached!')
+                self._ptr = 0
+
+            size = min(len(buffer) - ptr, len(self.samples) - self._ptr)
+            buffer[ptr:ptr + size] = self.samples[self._ptr:self._ptr + size]
+            ptr += size
+            self._ptr += size
+
+        return ptr
+
+
+class MimoChannel(BaseSource):
+    """One channel of multi-channel sample source (used as device of SoapyPower)"""
+    def __init__(self, mimo, index):
+        super().__init__(sample_rate=mimo.sample_rate, buffer_size=mimo.buffer_size)
+        self.mimo = mimo
+        self.index = index
+        self.channel = mimo.channel_numbers[index]
+        self.hardware = '{} (channel {})'.format(mimo.hardware, self.channel)
+
+    @property
+    def freq(self):
+        """Center frequency [Hz]"""
+        return self._freq
+
+    @freq.setter
+    def freq(self, freq):
+        """Set center frequency [Hz]"""
+        self.mimo.tune(self.index, freq)
+        self._freq = freq
+
+    def start_stream(self, buffer_size=0, stream_args=None, stream_timeout=0):
+        """Start streaming samples (stream of MIMO source is started together with first channel)"""
+        buffer = super().start_stream(buffer_size=buffer_size, stream_args=stream_args,
+                                      stream_timeout=stream_timeout)
+        self.mimo.start_channel(self.index, len(buffer))
+        return buffer
+
+    def stop_stream(self):
+        """Stop streaming samples (stream of MIMO source is stopped together with last channel)"""
+        super().stop_stream()
+        self.mimo.stop_channel(self.index)
+
+    def read_samples(self, buffer):
+        """Fill buffer with samples, return number of samples read or negative SoapySDR error code"""
+        return self.mimo.read_channel(self.index, buffer)
+
+
+class MimoSource:
+    """Multi-channel sample source base class (all channels are received simultaneously by one stream)
+
+    Every channel is exposed as separate device (see channels attribute), so channels can be
+    tuned and read independently by multiple SoapyPower instances. Samples of all channels are
+    read together into per-channel queues, samples of other channels are kept until their
+    channel reads them. Queue of channel is cleared after tuning, when it is full oldest block
+    of samples is dropped and reported as buffer overflow of channel.
+    """
+    default_buffer_size = 8192
+    hardware = 'MIMO'
+
+    def __init__(self, channel_numbers, sample_rate=2.00e6, buffer_size=0, realtime=False, queue_size=16):
+        """Create multi-channel sample source
+
+        channel_numbers ... list of RX channel numbers
+        queue_size ... max. number of blocks of samples queued per channel
+        """
+        self.channel_numbers = list(channel_numbers)
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.realtime = realtime
+        self.queue_size = queue_size
+        self.block_size = None
+
+        self._lock = threading.Lock()
+        self._active = set()
+        self._queues = [collections.deque() for c in self.channel_numbers]
+        self._offsets = [0] * len(self.channel_numbers)
+        self._overflows = [0] * len(self.channel_numbers)
+        self._free = []
+        self._t_next_read = None
+        self._channels = None
+
+    @property
+    def channels(self):
+        """List of channels (sample sources of individual channels)"""
+        if self._channels is None:
+            self._channels = [MimoChannel(self, i) for i in range(len(self.channel_numbers))]
+        return self._channels
+
+    def start(self, buffer_size):
+        """Start streaming samples of all channels, return size of block of samples read by read_all()"""
+        return buffer_size
+
+    def stop(self):
+        """Stop streaming samples of all channels"""
+        pass
+
+    def set_frequency(self, index, freq):
+        """Set center frequency of channel [Hz]"""
+        pass
+
+    def read_all(self, buffers):
+        """Fill buffers of all channels with samples, return number of samples read or negative SoapySDR error code"""
+        raise NotImplementedError
+
+    def start_channel(self, index, buffer_size):
+        """Start streaming samples of channel (starts stream of all channels if it isn't running yet)"""
+        with self._lock:
+            if not self._active:
+                self.block_size = self.start(buffer_size or self.buffer_size or self.default_buffer_size)
+                self._free = []
+                self._t_next_read = time.time()
+                logger.debug('{} stream - channels: {}, block size: {}'.format(
+                    self.hardware, self.channel_numbers, self.block_size
+                ))
+            self._active.add(index)
+            self._clear(index)
+
+    def stop_channel(self, index):
+        """Stop streaming samples of channel (stops stream of all channels if it was the last one)"""
+        with self._lock:
+            self._active.discard(index)
+            self._clear(index)
+            if not self._active:
+                self.stop()
+
+    def tune(self, index, freq):
+        """Tune channel to new center frequency and drop samples queued before tuning"""
+        with self._lock:
+            self.set_frequency(index, freq)
+            self._clear(index)
+
+    def _clear(self, index):
+        """Drop all queued samples of channel"""
+        self._free.extend(block.base for block in self._queues[index])
+        self._queues[index].clear()
+        self._offsets[index] = 0
+        self._overflows[index] = 0
+
+    def _read_all(self):
+        """Read next block of samples of all channels into their queues"""
+        # Emulate sample rate of real device
+        if self.realtime:
+            self._t_next_read += self.block_size / self.sample_rate
+            t_sleep = self._t_next_read - time.time()
+            if t_sleep > 0:
+                time.sleep(t_sleep)
+
+        buffers = [self._free.pop() if self._free else numpy.empty(self.block_size, numpy.complex64)
+                   for c in self.channel_numbers]
+        ret = self.read_all(buffers)
+        if ret <= 0:
+            self._free.extend(buffers)
+            if ret == SOAPY_SDR_OVERFLOW:
+                for i in self._active:
+                    self._overflows[i] += 1
+                return
+            raise RuntimeError('Unhandled readStream() error: {}'.format(ret))
+
+        for i, (queue, buffer) in enumerate(zip(self._queues, buffers)):
+            if i not in self._active:
+                self._free.append(buffer)
+                continue
+            if len(queue) >= self.queue_size:
+                # Channel doesn't keep up with other channels, drop its oldest samples
+                self._free.append(queue.popleft().base)
+                self._offsets[i] = 0
+                self._overflows[i] += 1
+            queue.append(buffer[:ret])
+
+    def read_channel(self, index, buffer):
+        """Fill buffer with samples of channel, return number of samples read or negative SoapySDR error code"""
+        with self._lock:
+            if self._overflows[index]:
+                self._overflows[index] -= 1
+                return SOAPY_SDR_OVERFLOW
+
+            queue = self._queues[index]
+            ptr = 0
+            while ptr < len(buffer):
+                if not queue:
+                    self._read_all()
+                    if self._overflows[index]:
+                        if not ptr:
+                            self._overflows[index] -= 1
+                            return SOAPY_SDR_OVERFLOW
+                        break
+                    continue
+
+                block = queue[0]
+                offset = self._offsets[index]
+                size = min(len(buffer) - ptr, len(block) - offset)
+                buffer[ptr:ptr + size] = block[offset:offset + size]
+                ptr += size
+                if offset + size < len(block):
+                    self._offsets[index] = offset + size
+                else:
+                    self._free.append(queue.popleft().base)
+                    self._offsets[index] = 0
+
+            return ptr
+
+
+class SimulatedMimoSource(MimoSource):
+    """Synthetic multi-channel sample source (same tones in independent noise in every channel)"""
+    hardware = 'Simulated MIMO'
+
+    def __init__(self, channels=2, sample_rate=2.00e6, buffer_size=0, realtime=False, queue_size=16,
+                 seed=None, **kwargs):
+        """Create synthetic multi-channel sample source
+
+        channels ... number of channels
+        kwargs ... arguments of SimulatedSource of every channel (e.g. tones, noise or overflow)
+        """
+        super().__init__(range(channels), sample_rate=sample_rate, buffer_size=buffer_size,
+                         realtime=realtime, queue_size=queue_size)
+        self.sources = [
+            SimulatedSource(sample_rate=sample_rate, seed=None if seed is None else seed + i, **kwargs)
+            for i in range(channels)
+        ]
+
+    def start(self, buffer_size):
+        """Start streaming samples of all channels, return size of block of samples read by read_all()"""
+        for source in self.sources:
+            source.start_stream(buffer_size=buffer_size)
+        return buffer_size
+
+    def stop(self):
+        """Stop streaming samples of all channels"""
+        for source in self.sources:
+            source.stop_stream()
+
+    def set_frequency(self, index, freq):
+        """Set center frequency of channel [Hz]"""
+        self.sources[index].freq = freq
+
+    def read_all(self, buffers):
+        """Fill buffers of all channels with samples, return number of samples read or negative SoapySDR error code"""
+        results = [source.read_samples(buffer) for source, buffer in zip(self.sources, buffers)]
+        return min(results)
+
+
+class SoapyMimoSource(MimoSource):
+    """Multi-channel SoapySDR device (all channels are received by one stream)"""
+    def __init__(self, soapy_args='', channel_numbers=(0, 1), sample_rate=2.00e6, bandwidth=0, corr=0,
+                 gain=20.7, auto_gain=False, antenna='', settings=None, force_sample_rate=False,
+                 force_bandwidth=False, buffer_size=0, queue_size=16):
+        """Create multi-channel SoapySDR device (gain, corr, antenna and bandwidth are same for all channels)"""
+        if simplesoapy is None:
+            raise RuntimeError('simplesoapy module (or SoapySDR Python bindings) not found!')
+
+        channel_numbers = list(channel_numbers)
+        self.sdr = simplesoapy.SoapyDevice(
+            soapy_args=soapy_args, sample_rate=sample_rate, bandwidth=bandwidth, corr=corr,
+            gain=gain, auto_gain=auto_gain, channel=channel_numbers[0], antenna=antenna, settings=settings,
+            force_sample_rate=force_sample_rate, force_bandwidth=force_bandwidth
+        )
+        for channel in channel_numbers[1:]:
+            self.sdr.channel = channel
+            if channel != self.sdr.channel:
+                raise ValueError('Incorrect RX channel number: {}'.format(channel))
+            self.sdr.sample_rate = sample_rate
+            if bandwidth:
+                self.sdr.bandwidth = bandwidth
+            if corr:
+                self.sdr.corr = corr
+            if gain is not None:
+                self.sdr.gain = gain
+            if auto_gain:
+                self.sdr.auto_gain = auto_gain
+            if antenna:
+                self.sdr.antenna = antenna
+        self.sdr.channel = channel_numbers[0]
+
+        super().__init__(channel_numbers, sample_rate=self.sdr.sample_rate, buffer_size=buffer_size,
+                         queue_size=queue_size)
+        self.hardware = self.sdr.hardware
+        self.stream = None
+        self.stream_timeout = 0
+
+    def start(self, buffer_size):
+        """Start streaming samples of all channels, return size of block of samples read by read_all()"""
+        device = self.sdr.device
+        self.stream = device.setupStream(SoapySDR.SOAPY_SDR_RX, SoapySDR.SOAPY_SDR_CF32, self.channel_numbers, {})
+        device.activateStream(self.stream)
+        self.stream_timeout = 0.1 + (buffer_size / self.sample_rate)
+        return buffer_size
+
+    def stop(self):
+        """Stop streaming samples of all channels"""
+        self.sdr.device.deactivateStream(self.stream)
+        self.sdr.device.closeStream(self.stream)
+        self.stream = None
+
+    def set_frequency(self, index, freq):
+        """Set center frequency of channel [Hz]"""
+        self.sdr.device.setFrequency(SoapySDR.SOAPY_SDR_RX, self.channel_numbers[index], freq)
+
+    def read_all(self, buffers):
+        """Fill buffers of all channels with samples, return number of samples read or negative SoapySDR error code"""
+        res = self.sdr.device.readStream(self.stream, buffers, len(buffers[0]),
+                                         timeoutUs=math.ceil(self.stream_timeout * 1e6))
+        return res.ret
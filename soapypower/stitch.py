@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import math, logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+modes = ('average', 'center', 'max')
+
+
+class Stitcher:
+    """Assemble PSD of all frequency hops of one run into one contiguous full-band spectrum
+
+    Overlapping bins of neighbouring hops are averaged (in linear scale), taken from hop with
+    nearest center frequency or maximum of them is used. Bins not covered by any hop received
+    in current run are NaN.
+    """
+    def __init__(self, freq_arrays, mode='average', log_scale=True):
+        if mode not in modes:
+            raise ValueError('Unknown stitching mode: {}'.format(mode))
+        self.mode = mode
+        self.log_scale = log_scale
+
+        # All hops have same bin size and their bins lie on common frequency grid
+        freq_arrays = sorted(freq_arrays, key=lambda f: f[0])
+        bin_size = freq_arrays[0][1] - freq_arrays[0][0]
+        min_freq = freq_arrays[0][0]
+        starts = [int(round((f[0] - min_freq) / bin_size)) for f in freq_arrays]
+        misalignment = max(abs(f[0] - min_freq - start * bin_size) for start, f in zip(starts, freq_arrays))
+        if misalignment > bin_size / 100:
+            logger.warning('Frequency hops are not aligned to common grid of bins (max. offset {:.2f} Hz), '
+                           'try different overlap or decimation'.format(misalignment))
+        stops = [start + len(f) for start, f in zip(starts, freq_arrays)]
+        self.bins = max(stops)
+
+        self.freq_array = min_freq + numpy.arange(self.bins) * bin_size
+        for start, stop, f in zip(starts, stops, freq_arrays):
+            self.freq_array[start:stop] = f
+        self.freq_array.flags.writeable = False
+
+        # Bins owned by every hop in center mode (split in the middle between centers of neighbouring hops)
+        centers = [(start + stop) / 2 for start, stop in zip(starts, stops)]
+        bounds = [0] + [math.ceil((c1 + c2) / 2) for c1, c2 in zip(centers[:-1], centers[1:])] + [self.bins]
+
+        self._hops = {}
+        for i, f in enumerate(freq_arrays):
+            own_start = max(starts[i], bounds[i])
+            own_stop = max(own_start, min(stops[i], bounds[i + 1]))
+            self._hops[f[0]] = (
+                slice(starts[i], stops[i]),
+                slice(own_start - starts[i], own_stop - starts[i]),
+                slice(own_start, own_stop),
+            )
+
+        self.pwr_array = numpy.empty(self.bins, numpy.float32)
+        if self.mode == 'average':
+            self._sum = numpy.zeros(self.bins, numpy.float64)
+            self._count = numpy.zeros(self.bins, numpy.int32)
+        self.reset()
+
+    def reset(self):
+        """Clear stitched spectrum (prepare for next run)"""
+        self.hops = 0
+        self.time_start = None
+        self.time_stop = None
+        self.samples = 0
+        self.pwr_array.fill(numpy.nan)
+        if self.mode == 'average':
+            self._sum.fill(0)
+            self._count.fill(0)
+
+    def add(self, f_array, pwr_array, time_start, time_stop, samples):
+        """Add PSD of one frequency hop to stitched spectrum"""
+        try:
+            hop_slice, own_src, own_dst = self._hops[f_array[0]]
+        except KeyError:
+            logger.warning('Frequency hop {} Hz is not part of stitched spectrum, ignoring it'.format(f_array[0]))
+            return
+
+        if self.mode == 'center':
+            self.pwr_array[own_dst] = pwr_array[own_src]
+        elif self.mode == 'max':
+            numpy.fmax(self.pwr_array[hop_slice], pwr_array, out=self.pwr_array[hop_slice])
+        else:
+            self._sum[hop_slice] += 10**(pwr_array.astype(numpy.float64) / 10) if self.log_scale else pwr_array
+            self._count[hop_slice] += 1
+
+        if self.time_start is None:
+            self.time_start = time_start
+        self.time_stop = time_stop
+        self.samples = samples
+        self.hops += 1
+
+    def result(self):
+        """Return frequencies and stitched PSD of current run (call only once per run, before reset())"""
+        if self.mode == 'average':
+            # Compute in place in float64 sum (it is cleared by reset() before next run anyway)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                numpy.divide(self._sum, self._count, out=self._sum)
+                if self.log_scale:
+                    numpy.log10(self._sum, out=self._sum)
+                    self._sum *= 10
+            self.pwr_array[:] = self._sum
+        return (self.freq_array, self.pwr_array)
@@ -1,23 +1,33 @@
-import os, queue, concurrent.futures
+import os, time, queue, concurrent.futures
 
 
 class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
     """ThreadPoolExecutor which allows setting max. work queue size"""
-    def __init__(self, max_workers=0, thread_name_prefix='', max_queue_size=0):
-        #super().__init__(max_workers or os.cpu_count() or 1, thread_name_prefix)
-        super().__init__(max_workers or os.cpu_count() or 1)
+    def __init__(self, max_workers=0, thread_name_prefix='', max_queue_size=0, queue_wait_callback=None):
+        super().__init__(max_workers or os.cpu_count() or 1, thread_name_prefix=thread_name_prefix)
         self.max_queue_size = max_queue_size or self._max_workers * 10
         if self.max_queue_size > 0:
             self._work_queue = queue.Queue(self.max_queue_size)
         self.max_queue_size_reached = 0
+        self.queue_wait_callback = queue_wait_callback
 
     def submit(self, fn, *args, **kwargs):
         """Submits a callable to be executed with the given arguments.
 
-        Count maximum reached work queue size in ThreadPoolExecutor.max_queue_size_reached.
+        Count maximum reached work queue size in ThreadPoolExecutor.max_queue_size_reached
+        and pass time spent by task in work queue to queue_wait_callback (if it is set).
         """
+        if self.queue_wait_callback:
+            fn = self._measure_queue_wait(fn, time.time())
         future = super().submit(fn, *args, **kwargs)
         work_queue_size = self._work_queue.qsize()
         if work_queue_size > self.max_queue_size_reached:
             self.max_queue_size_reached = work_queue_size
         return future
+
+    def _measure_queue_wait(self, fn, t_submit):
+        """Return wrapper of fn which reports time elapsed since submission before calling fn"""
+        def wrapper(*args, **kwargs):
+            self.queue_wait_callback(time.time() - t_submit)
+            return fn(*args, **kwargs)
+        return wrapper
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
-import sys, logging, struct, collections, io
+import os, sys, time, json, logging, struct, operator, collections, collections.abc, mmap, zlib, lzma
 
 import numpy
+from numpy.lib.format import open_memmap
 
-from soapypower import threadpool
+from soapypower import threadpool, broadcast
 
 if sys.platform == 'win32':
     import msvcrt
@@ -14,58 +15,255 @@ logger = logging.getLogger(__name__)
 
 class BaseWriter:
     """Power Spectral Density writer base class"""
-    def __init__(self, output=sys.stdout):
+    def __init__(self, output=sys.stdout, precision=None, flush_hops=1, flush_interval=0,
+                 rotate_size=0, rotate_interval=0, client_queue_size=100, client_overflow='drop-oldest',
+                 metrics=None):
+        """Create writer
+
+        precision ... number of decimal places of power values (only text formats)
+        flush_hops ... flush output after every N hops (0 = only at end of run)
+        flush_interval ... flush output if more than T seconds elapsed since last flush (0 = disabled)
+        rotate_size ... start new output file when size of current file reaches N bytes (0 = disabled)
+        rotate_interval ... start new output file every T seconds (0 = disabled)
+        client_queue_size ... max. number of messages queued for every client (only network output)
+        client_overflow ... drop-oldest or disconnect slow client when its queue is full (only network output)
+        metrics ... metrics.Metrics instance for recording of writer queue wait and write time
+        """
+        self.precision = precision
+        self.flush_hops = flush_hops
+        self.flush_interval = flush_interval
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.client_queue_size = client_queue_size
+        self.client_overflow = client_overflow
+        self.metrics = metrics
+
+        # If stitcher is set, hops of every run are assembled and written as one full-band record
+        self.stitcher = None
+
         self._close_output = False
+        self._path = None
+        self._rotated_path = None
+        self._hops_since_flush = 0
+        self._t_flush = time.time()
+        self._t_rotate = time.time()
+        self._rotate_pending = False
+        self.output = self.open_output(output)
+
+        # Use only one writer thread to preserve sequence of written frequencies
+        self._executor = threadpool.ThreadPoolExecutor(
+            max_workers=1,
+            max_queue_size=100,
+            thread_name_prefix='Writer_thread',
+            queue_wait_callback=self._queue_wait if metrics else None
+        )
+
+    def _queue_wait(self, t):
+        """Record time spent by task in writer queue"""
+        self.metrics.observe('writer_queue_wait_seconds', t)
+
+    @property
+    def rotating(self):
+        """Is output rotation enabled? (read-only)"""
+        return bool(self.rotate_size or self.rotate_interval)
+
+    def open_output(self, output):
+        """Open output (file descriptor, path, network address or file-like object),
+           return binary file-like object"""
+        # If output is tcp://HOST:PORT or unix://PATH address, send output to all connected clients
+        if broadcast.is_address(output):
+            if self.rotating:
+                raise ValueError('Output rotation can\'t be used with network output!')
+            self._close_output = True
+            return broadcast.BroadcastServer(output, max_queue_size=self.client_queue_size,
+                                             overflow=self.client_overflow)
+
+        if self.rotating:
+            if not isinstance(output, (str, os.PathLike)):
+                raise ValueError('Output rotation requires path to output file!')
+            self._path = os.fspath(output)
+            return self._open_rotated()
 
         # If output is integer, assume it is file descriptor and open it
         if isinstance(output, int):
             self._close_output = True
             if sys.platform == 'win32':
                 output = msvcrt.open_osfhandle(output, 0)
-            output = open(output, 'wb')
+            return open(output, 'wb')
+
+        # If output is string, assume it is path to file and open it
+        if isinstance(output, (str, os.PathLike)):
+            self._close_output = True
+            return open(output, 'wb')
 
         # Get underlying buffered file object
         try:
-            self.output = output.buffer
+            return output.buffer
         except AttributeError:
-            self.output = output
-
-        # Use only one writer thread to preserve sequence of written frequencies
-        self._executor = threadpool.ThreadPoolExecutor(
-            max_workers=1,
-            max_queue_size=100,
-            thread_name_prefix='Writer_thread'
-        )
-
-    def write(self, psd_data_or_future, time_start, time_stop, samples):
+            return output
+
+    def _open_rotated(self):
+        """Open new rotated output file (file is written with .part suffix and renamed when closed)"""
+        root, ext = os.path.splitext(self._path)
+        path = '{}_{}{}'.format(root, time.strftime('%Y%m%d-%H%M%S'), ext)
+        i = 1
+        while os.path.exists(path) or os.path.exists(path + '.part'):
+            path = '{}_{}-{}{}'.format(root, time.strftime('%Y%m%d-%H%M%S'), i, ext)
+            i += 1
+
+        self._rotated_path = path
+        self._t_rotate = time.time()
+        self._close_output = True
+        logger.debug('Writing output to file: {}'.format(path))
+        return open(path + '.part', 'wb')
+
+    def _close_rotated(self):
+        """Close rotated output file and atomically rename it to its final name"""
+        self.output.close()
+        os.replace(self._rotated_path + '.part', self._rotated_path)
+
+    def rotate(self):
+        """Close current output file and start new one"""
+        self._close_rotated()
+        self.output = self._open_rotated()
+        self._rotate_pending = False
+        self._hops_since_flush = 0
+        self._t_flush = time.time()
+
+    def flush(self):
+        """Flush output"""
+        self.output.flush()
+        self._hops_since_flush = 0
+        self._t_flush = time.time()
+
+    def hop_written(self):
+        """Flush or rotate output according to flush and rotation policy (called after every hop)
+
+        New output file is opened only before next hop is written, so that no empty file
+        is left behind when last hop of measurement reaches rotation threshold.
+        """
+        self._hops_since_flush += 1
+        t = time.time()
+        if ((self.rotate_size and self.output.tell() >= self.rotate_size) or
+                (self.rotate_interval and t - self._t_rotate >= self.rotate_interval)):
+            self._rotate_pending = True
+            self.flush()
+        elif ((self.flush_hops and self._hops_since_flush >= self.flush_hops) or
+                (self.flush_interval and t - self._t_flush >= self.flush_interval)):
+            self.flush()
+
+    def write(self, psd_data_or_future, time_start, time_stop, samples, channel=None):
         """Write PSD of one frequency hop"""
         raise NotImplementedError
 
-    def write_async(self, psd_data_or_future, time_start, time_stop, samples):
-        """Write PSD of one frequncy hop (asynchronously in another thread)"""
-        return self._executor.submit(self.write, psd_data_or_future, time_start, time_stop, samples)
+    def _write(self, psd_data_or_future, time_start, time_stop, samples, channel=None):
+        """Write PSD of one frequency hop (or add it to stitched spectrum) and apply flush policy"""
+        if self.stitcher:
+            try:
+                # Wait for result of future
+                f_array, pwr_array = psd_data_or_future.result()
+            except AttributeError:
+                f_array, pwr_array = psd_data_or_future
+            self.stitcher.add(f_array, pwr_array, time_start, time_stop, samples)
+            return
+
+        if self._rotate_pending:
+            self.rotate()
+
+        if not self.metrics:
+            self.write(psd_data_or_future, time_start, time_stop, samples, channel)
+            self.hop_written()
+            return
+
+        # Wait for PSD result first, so that only writing itself is measured
+        try:
+            psd_data_or_future = psd_data_or_future.result()
+        except AttributeError:
+            pass
+        t = time.time()
+        self.write(psd_data_or_future, time_start, time_stop, samples, channel)
+        self.hop_written()
+        self.metrics.observe('write_seconds', time.time() - t)
+
+    def write_async(self, psd_data_or_future, time_start, time_stop, samples, channel=None):
+        """Write PSD of one frequncy hop (asynchronously in another thread)
+
+        If channel is not None, record is tagged by number of channel (in formats which support it).
+        """
+        return self._executor.submit(self._write, psd_data_or_future, time_start, time_stop, samples, channel)
 
     def write_next(self):
         """Write marker for next run of measurement"""
         raise NotImplementedError
 
+    def _write_next(self):
+        """Write marker for next run of measurement (after stitched spectrum of run) and flush output"""
+        if self.stitcher and self.stitcher.hops:
+            if self._rotate_pending:
+                self.rotate()
+            self.write(self.stitcher.result(), self.stitcher.time_start, self.stitcher.time_stop,
+                       self.stitcher.samples)
+            self.stitcher.reset()
+            self.hop_written()
+
+        self.write_next()
+        self.flush()
+
     def write_next_async(self):
         """Write marker for next run of measurement (asynchronously in another thread)"""
-        return self._executor.submit(self.write_next)
+        return self._executor.submit(self._write_next)
 
     def close(self):
-        """Close output (only if it has been opened by writer)"""
-        if self._close_output:
+        """Close output (only if it has been opened by writer, otherwise only flush it)"""
+        if self.rotating:
+            self._close_rotated()
+        elif self._close_output:
             self.output.close()
+        else:
+            self.flush()
 
 
 class SoapyPowerBinFormat:
-    """Power Spectral Density binary file format"""
+    """Power Spectral Density binary file format
+
+    Version 2 frames contain raw float32 power values. Version 3 frames can contain power values
+    encoded as float16, as int16 quantized with given step (in dB) and per-frame offset, or as
+    delta-encoded int16 (differences of neighbouring quantized values), optionally compressed
+    by zlib or lzma. Quantized values 32767, 32766 and -32768 are reserved for NaN, +inf and -inf.
+    Frames with raw float32 values and no compression are written as version 2, unless they are
+    tagged by RX channel of MIMO device (channel field is only in version 3 header).
+    """
     header_struct = struct.Struct('<BdddddQQ2x')
     header = collections.namedtuple('Header', 'version time_start time_stop start stop step samples size')
+    header_struct_v3 = struct.Struct('<BdddddQQBBBxIff')
+    header_v3 = collections.namedtuple('HeaderV3', 'version time_start time_stop start stop step samples size '
+                                                   'encoding compression channel bins scale offset')
     magic = b'SDRFF'
     version = 2
 
+    encodings = ('float32', 'float16', 'int16', 'delta')
+    compressions = ('none', 'zlib', 'lzma')
+
+    # Reserved int16 values of quantized power (for non-finite values)
+    quant_nan = 32767
+    quant_posinf = 32766
+    quant_neginf = -32768
+    quant_min = -32767
+    quant_max = 32765
+
+    def __init__(self, encoding='float32', compression='none', quantization=0.01):
+        if encoding not in self.encodings:
+            raise ValueError('Unknown payload encoding: {}'.format(encoding))
+        if compression not in self.compressions:
+            raise ValueError('Unknown payload compression: {}'.format(compression))
+        if quantization <= 0:
+            raise ValueError('Quantization step must be positive!')
+
+        self.encoding = encoding
+        self.compression = compression
+        self.quantization = quantization
+        self.version = 2 if encoding == 'float32' and compression == 'none' else 3
+
     def read(self, f):
         """Read data from file-like object"""
         magic = f.read(len(self.magic))
@@ -74,34 +272,286 @@ class SoapyPowerBinFormat:
         if magic != self.magic:
             raise ValueError('Magic bytes not found! Read data: {}'.format(magic))
 
-        header = self.header._make(
-            self.header_struct.unpack(f.read(self.header_struct.size))
+        version = f.read(1)
+        header_struct, header_tuple = self.header_format(version[0])
+        header = header_tuple._make(
+            header_struct.unpack(version + f.read(header_struct.size - 1))
         )
-        pwr_array = numpy.fromstring(f.read(header.size), dtype='float32')
+        pwr_array = self.decode(header, f.read(header.size))
         return (header, pwr_array)
 
-    def write(self, f, time_start, time_stop, start, stop, step, samples, pwr_array):
-        """Write data to file-like object"""
-        f.write(self.magic)
-        f.write(self.header_struct.pack(
-            self.version, time_start, time_stop, start, stop, step, samples, pwr_array.nbytes
+    def header_format(self, version):
+        """Return header struct and namedtuple of given version of format"""
+        if version == 2:
+            return (self.header_struct, self.header)
+        if version == 3:
+            return (self.header_struct_v3, self.header_v3)
+        raise ValueError('Unsupported version of soapy_power_bin format: {}'.format(version))
+
+    def encode(self, pwr_array):
+        """Encode (and compress) power array, return (payload, scale, offset)"""
+        scale = offset = 0
+        if self.encoding == 'float32':
+            payload = numpy.asarray(pwr_array, dtype='<f4')
+        elif self.encoding == 'float16':
+            payload = numpy.asarray(pwr_array, dtype='<f2')
+        else:
+            payload, scale, offset = self.quantize(pwr_array)
+            if self.encoding == 'delta':
+                # Differences of neighbouring values (overflow wraps around and is undone by cumsum)
+                payload[1:] = numpy.diff(payload)
+
+        payload = payload.tobytes()
+        if self.compression == 'zlib':
+            payload = zlib.compress(payload)
+        elif self.compression == 'lzma':
+            payload = lzma.compress(payload)
+        return (payload, scale, offset)
+
+    def quantize(self, pwr_array):
+        """Quantize power array to int16, return (quantized array, scale, offset)"""
+        pwr_array = numpy.asarray(pwr_array, dtype=numpy.float64)
+        finite = numpy.isfinite(pwr_array)
+        scale = self.quantization
+        offset = 0
+        if finite.any():
+            finite_array = pwr_array[finite]
+            low, high = finite_array.min(), finite_array.max()
+            if high - low > scale * (self.quant_max - self.quant_min):
+                # Range of values is too large for requested step, use coarser step in this frame
+                scale = (high - low) / (self.quant_max - self.quant_min)
+                logger.debug('Power range {:.2f} is too large, using quantization step {:.4f}'.format(
+                    high - low, scale
+                ))
+            scale = float(numpy.float32(scale))
+            # Map middle of power range to middle of usable codes (which are not symmetric around zero)
+            offset = (low + high) / 2 - (self.quant_max + self.quant_min) / 2 * scale
+
+        # Scale and offset are stored as float32, quantize with exactly these values
+        scale, offset = float(numpy.float32(scale)), float(numpy.float32(offset))
+        with numpy.errstate(invalid='ignore'):
+            quantized = numpy.rint((pwr_array - offset) / scale)
+        numpy.clip(quantized, self.quant_min, self.quant_max, out=quantized)
+        quantized[numpy.isnan(pwr_array)] = self.quant_nan
+        quantized[pwr_array == numpy.inf] = self.quant_posinf
+        quantized[pwr_array == -numpy.inf] = self.quant_neginf
+        return (quantized.astype('<i2'), scale, offset)
+
+    def decode(self, header, payload):
+        """Decompress and decode payload of frame, return power array"""
+        if header.version == 2:
+            return numpy.frombuffer(payload, dtype='float32')
+
+        if header.compression == 1:
+            payload = zlib.decompress(payload)
+        elif header.compression == 2:
+            payload = lzma.decompress(payload)
+        elif header.compression != 0:
+            raise ValueError('Unknown payload compression: {}'.format(header.compression))
+
+        encoding = header.encoding
+        if encoding == 0:
+            return numpy.frombuffer(payload, dtype='<f4', count=header.bins)
+        if encoding == 1:
+            return numpy.frombuffer(payload, dtype='<f2', count=header.bins).astype(numpy.float32)
+        if encoding not in (2, 3):
+            raise ValueError('Unknown payload encoding: {}'.format(encoding))
+
+        quantized = numpy.frombuffer(payload, dtype='<i2', count=header.bins)
+        if encoding == 3:
+            quantized = numpy.cumsum(quantized, dtype=numpy.int16)
+        pwr_array = (quantized * numpy.float32(header.scale) + numpy.float32(header.offset)).astype(numpy.float32)
+        pwr_array[quantized == self.quant_nan] = numpy.nan
+        pwr_array[quantized == self.quant_posinf] = numpy.inf
+        pwr_array[quantized == self.quant_neginf] = -numpy.inf
+        return pwr_array
+
+    def pack(self, time_start, time_stop, start, stop, step, samples, pwr_array, channel=None):
+        """Return whole frame (magic, header and data) as bytes (frames tagged by channel are always version 3)"""
+        if self.version == 2 and channel is None:
+            return b''.join((
+                self.magic,
+                self.header_struct.pack(
+                    self.version, time_start, time_stop, start, stop, step, samples, pwr_array.nbytes
+                ),
+                pwr_array.tobytes()
+            ))
+
+        payload, scale, offset = self.encode(pwr_array)
+        return b''.join((
+            self.magic,
+            self.header_struct_v3.pack(
+                3, time_start, time_stop, start, stop, step, samples, len(payload),
+                self.encodings.index(self.encoding), self.compressions.index(self.compression),
+                channel or 0, len(pwr_array), scale, offset
+            ),
+            payload
         ))
-        #pwr_array.tofile(f)
-        f.write(pwr_array.tobytes())
-        f.flush()
 
-    def header_size(self):
+    def write(self, f, time_start, time_stop, start, stop, step, samples, pwr_array, channel=None):
+        """Write data to file-like object (whole frame is written by one write() call)"""
+        f.write(self.pack(time_start, time_stop, start, stop, step, samples, pwr_array, channel))
+
+    def header_size(self, version=2):
         """Return total size of header"""
-        return len(self.magic) + self.header_struct.size
+        return len(self.magic) + self.header_format(version)[0].size
+
+
+class SoapyPowerBinReader(collections.abc.Sequence):
+    """Random-access reader of files in soapy_power binary format
+
+    File is memory-mapped and headers of all frames are scanned only once, raw float32 power arrays
+    of frames are returned as read-only numpy views into mapped file (without copying), encoded
+    or compressed power arrays (version 3 frames) are decoded on every access.
+    """
+    header_dtype = numpy.dtype([
+        ('version', 'u1'), ('time_start', 'f8'), ('time_stop', 'f8'), ('start', 'f8'), ('stop', 'f8'),
+        ('step', 'f8'), ('samples', 'u8'), ('size', 'u8'), ('encoding', 'u1'), ('compression', 'u1'),
+        ('channel', 'u1'), ('bins', 'u4'), ('scale', 'f4'), ('offset', 'f4')
+    ])
+
+    def __init__(self, filename):
+        self.formatter = SoapyPowerBinFormat()
+        self._file = open(filename, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file can't be memory-mapped
+            self._mmap = b''
+        self.headers, self.offsets = self._scan()
+
+    def _scan(self):
+        """Read headers of all frames, return structured array of headers and array of data offsets"""
+        magic_size = len(self.formatter.magic)
+        headers = []
+        offsets = []
+
+        offset = 0
+        file_size = len(self._mmap)
+        while offset < file_size:
+            if file_size - offset <= magic_size:
+                logger.warning('Incomplete header at the end of file (offset {}), ignoring it'.format(offset))
+                break
+
+            magic = self._mmap[offset:offset + magic_size]
+            if magic != self.formatter.magic:
+                raise ValueError('Magic bytes not found at offset {}! Read data: {}'.format(offset, magic))
+
+            version = self._mmap[offset + magic_size]
+            header_struct = self.formatter.header_format(version)[0]
+            header_size = magic_size + header_struct.size
+            if file_size - offset < header_size:
+                logger.warning('Incomplete header at the end of file (offset {}), ignoring it'.format(offset))
+                break
+
+            header = header_struct.unpack_from(self._mmap, offset + magic_size)
+            data_offset = offset + header_size
+            size = header[7]
+            if data_offset + size > file_size:
+                logger.warning('Incomplete frame at the end of file (offset {}), ignoring it'.format(offset))
+                break
+
+            if version == 2:
+                # Version 2 frames always contain raw float32 values
+                header += (0, 0, 0, size // 4, 0, 0)
+            headers.append(header)
+            offsets.append(data_offset)
+            offset = data_offset + size
+
+        return (numpy.array(headers, dtype=self.header_dtype), numpy.array(offsets, dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, key):
+        """Return (header, pwr_array) of given frame (or list of frames if key is slice)"""
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+
+        header = self.headers[key].tolist()
+        if header[0] == 2:
+            header = self.formatter.header._make(header[:8])
+        else:
+            header = self.formatter.header_v3._make(header)
+        return (header, self.pwr_array(key))
+
+    def is_raw(self, index):
+        """Is power array of given frame stored as raw float32 values (without encoding and compression)?"""
+        return not self.headers['encoding'][index] and not self.headers['compression'][index]
+
+    def pwr_array(self, index):
+        """Return power array of given frame (read-only view into mapped file if it isn't encoded)"""
+        bins = int(self.headers['bins'][index])
+        offset = int(self.offsets[index])
+        if self.is_raw(index):
+            return numpy.frombuffer(self._mmap, dtype='float32', count=bins, offset=offset)
+
+        header = self.formatter.header_v3._make(self.headers[index].tolist())
+        return self.formatter.decode(header, self._mmap[offset:offset + header.size])
+
+    @property
+    def hops(self):
+        """Sorted list of start frequencies of all frequency hops (read-only)"""
+        return numpy.unique(self.headers['start']).tolist()
+
+    def stack(self, hop=None):
+        """Return headers and 2-D array (time x bins) of power arrays of all frames of given hop
+           (or of all frames if hop is not specified)
+
+        If all frames contain same number of raw float32 values and are evenly spaced in file
+        (same number of hops in every run), returned array is read-only view into mapped file
+        (without copying).
+        """
+        if hop is None:
+            indices = numpy.arange(len(self))
+        else:
+            indices = numpy.flatnonzero(self.headers['start'] == hop)
+        if not len(indices):
+            raise ValueError('No frames found!')
+
+        headers = self.headers[indices]
+        bins = headers['bins']
+        if (bins != bins[0]).any():
+            raise ValueError('Frames have different sizes, they can\'t be stacked!')
+
+        offsets = self.offsets[indices]
+        strides = numpy.diff(offsets)
+        bins = int(bins[0])
+        raw = not headers['encoding'].any() and not headers['compression'].any()
+        if raw and (not len(strides) or (strides == strides[0]).all()):
+            return (headers, numpy.ndarray(
+                (len(indices), bins), dtype='float32', buffer=self._mmap, offset=int(offsets[0]),
+                strides=(int(strides[0]) if len(strides) else bins * 4, 4)
+            ))
+
+        if raw:
+            logger.debug('Frames are not evenly spaced in file, stacked array will be copied')
+        return (headers, numpy.stack([self.pwr_array(i) for i in indices]))
+
+    def close(self):
+        """Close memory-mapped file"""
+        try:
+            if self._mmap:
+                self._mmap.close()
+        except BufferError:
+            # Numpy views into mapped file still exist, file will be unmapped by garbage collector
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 class SoapyPowerBinWriter(BaseWriter):
     """Write Power Spectral Density to stdout or file (in soapy_power binary format)"""
-    def __init__(self, output=sys.stdout):
-        super().__init__(output=output)
-        self.formatter = SoapyPowerBinFormat()
+    def __init__(self, output=sys.stdout, encoding='float32', compression='none', quantization=0.01, **kwargs):
+        super().__init__(output=output, **kwargs)
+        self.formatter = SoapyPowerBinFormat(encoding=encoding, compression=compression, quantization=quantization)
 
-    def write(self, psd_data_or_future, time_start, time_stop, samples):
+    def write(self, psd_data_or_future, time_start, time_stop, samples, channel=None):
         """Write PSD of one frequency hop"""
         try:
             # Wait for result of future
@@ -119,7 +569,8 @@ class SoapyPowerBinWriter(BaseWriter):
                 f_array[-1] + step,
                 step,
                 samples,
-                pwr_array
+                pwr_array,
+                channel
             )
         except Exception as e:
             logging.exception('Error writing to output file: {}'.format(e))
@@ -129,13 +580,44 @@ class SoapyPowerBinWriter(BaseWriter):
         pass
 
 
-class RtlPowerFftwWriter(BaseWriter):
-    """Write Power Spectral Density to stdout or file (in rtl_power_fftw format)"""
-    def __init__(self, output=sys.stdout):
-        super().__init__(output=output)
-        self.output = io.TextIOWrapper(self.output)
+class TextWriter(BaseWriter):
+    """Text output writer base class (whole frequency hop is formatted and written at once)"""
+    def __init__(self, output=sys.stdout, **kwargs):
+        super().__init__(output=output, **kwargs)
+        self._freq_cache = {}
+
+    def format_floats(self, array, float32=False):
+        """Format array of floats, return list of strings
+
+        If precision is not set, values are formatted same as by str(), float32 values are
+        formatted by numpy (shortest representation) or as float64 values (exact representation).
+        """
+        if self.precision is not None:
+            return list(map('{{:.{}f}}'.format(self.precision).format, array.tolist()))
+        if float32:
+            return array.astype(str).tolist()
+        return list(map(repr, array.astype(numpy.float64).tolist()))
+
+    def format_freqs(self, f_array, suffix=''):
+        """Format array of frequencies (formatted arrays are cached, they are same in every run)"""
+        key = (f_array[0], f_array[-1], len(f_array), suffix)
+        try:
+            return self._freq_cache[key]
+        except KeyError:
+            freqs = [f + suffix for f in map(repr, f_array.astype(numpy.float64).tolist())]
+            self._freq_cache[key] = freqs
+            return freqs
+
+    def write_text(self, text):
+        """Encode text and write it to output"""
+        if os.linesep != '\n':
+            text = text.replace('\n', os.linesep)
+        self.output.write(text.encode())
 
-    def write(self, psd_data_or_future, time_start, time_stop, samples):
+
+class RtlPowerFftwWriter(TextWriter):
+    """Write Power Spectral Density to stdout or file (in rtl_power_fftw format)"""
+    def write(self, psd_data_or_future, time_start, time_stop, samples, channel=None):
         """Write PSD of one frequency hop"""
         try:
             # Wait for result of future
@@ -143,31 +625,28 @@ class RtlPowerFftwWriter(BaseWriter):
         except AttributeError:
             f_array, pwr_array = psd_data_or_future
 
-        self.output.write('# soapy_power output\n')
-        self.output.write('# Acquisition start: {}\n'.format(time_start))
-        self.output.write('# Acquisition end: {}\n'.format(time_stop))
-        self.output.write('#\n')
-        self.output.write('# frequency [Hz] power spectral density [dB/Hz]\n')
+        lines = [
+            '# soapy_power output',
+            '# Acquisition start: {}'.format(time_start),
+            '# Acquisition end: {}'.format(time_stop),
+            '#',
+            '# frequency [Hz] power spectral density [dB/Hz]',
+        ]
+        if channel is not None:
+            lines.insert(3, '# Channel: {}'.format(channel))
+        lines.extend(map(operator.add, self.format_freqs(f_array, ' '), self.format_floats(pwr_array)))
+        lines.append('\n')
 
-        for f, pwr in zip(f_array, pwr_array):
-            self.output.write('{} {}\n'.format(f, pwr))
-
-        self.output.write('\n')
-        self.output.flush()
+        self.write_text('\n'.join(lines))
 
     def write_next(self):
         """Write marker for next run of measurement"""
-        self.output.write('\n')
-        self.output.flush()
+        self.write_text('\n')
 
 
-class RtlPowerWriter(BaseWriter):
+class RtlPowerWriter(TextWriter):
     """Write Power Spectral Density to stdout or file (in rtl_power format)"""
-    def __init__(self, output=sys.stdout):
-        super().__init__(output=output)
-        self.output = io.TextIOWrapper(self.output)
-
-    def write(self, psd_data_or_future, time_start, time_stop, samples):
+    def write(self, psd_data_or_future, time_start, time_stop, samples, channel=None):
         """Write PSD of one frequency hop"""
         try:
             # Wait for result of future
@@ -181,9 +660,9 @@ class RtlPowerWriter(BaseWriter):
                 time_stop.strftime('%Y-%m-%d'), time_stop.strftime('%H:%M:%S'),
                 f_array[0], f_array[-1] + step, step, samples
             ]
-            row += list(pwr_array)
-            self.output.write('{}\n'.format(', '.join(str(x) for x in row)))
-            self.output.flush()
+            row = [str(x) for x in row]
+            row += self.format_floats(pwr_array, float32=True)
+            self.write_text('{}\n'.format(', '.join(row)))
         except Exception as e:
             logging.exception('Error writing to output file:')
 
@@ -192,8 +671,215 @@ class RtlPowerWriter(BaseWriter):
         pass
 
 
+class WaterfallWriter(BaseWriter):
+    """Write Power Spectral Density to directory (in chunked waterfall store format)
+
+    Every run of measurement is stored as one row of power matrix (runs x bins of all hops),
+    which is split to preallocated .npy files (chunks) with fixed number of rows. Frequency axis
+    is saved only once, timestamps (start and stop) of every run are stored in separate chunks.
+    List of chunks and number of already written runs are stored in small JSON manifest.
+    """
+    format_name = 'soapy_power_waterfall'
+    version = 1
+    manifest_name = 'manifest.json'
+    chunk_bytes = 64 * 1024**2
+    max_chunk_runs = 1024
+
+    def __init__(self, output, **kwargs):
+        super().__init__(output=output, **kwargs)
+        self.bins = None
+        self.chunk_runs = None
+        self.runs = 0
+        self.samples = None
+
+        self._layout = None
+        self._pending = []
+        self._chunk = None
+        self._chunk_times = None
+        self._chunks = []
+        self._run_time = None
+
+    def open_output(self, output):
+        """Create output directory, return its path"""
+        if not isinstance(output, (str, os.PathLike)) or broadcast.is_address(output):
+            raise ValueError('Waterfall store output must be path to directory!')
+        if self.rotating:
+            raise ValueError('Waterfall store doesn\'t support output rotation!')
+
+        os.makedirs(output, exist_ok=True)
+        if os.path.exists(os.path.join(output, self.manifest_name)):
+            raise ValueError('Directory {} already contains waterfall store!'.format(output))
+        return output
+
+    def _create_layout(self, hops):
+        """Assign columns of power matrix to frequency hops and save frequency axis"""
+        self._layout = {}
+        offset = 0
+        for f_array, pwr_array in hops:
+            self._layout[f_array[0]] = (offset, len(pwr_array))
+            offset += len(pwr_array)
+
+        self.bins = offset
+        self.chunk_runs = max(1, min(self.max_chunk_runs,
+                                     self.chunk_bytes // (self.bins * numpy.dtype('float32').itemsize)))
+        numpy.save(os.path.join(self.output, 'freqs.npy'), numpy.concatenate([f for f, p in hops]))
+
+    def _get_chunk(self):
+        """Return chunk of power matrix for current run (new chunk is created when previous is full)"""
+        index = self.runs // self.chunk_runs
+        if index == len(self._chunks):
+            self._close_chunk()
+            chunk = {
+                'power': 'power_{:05d}.npy'.format(index),
+                'times': 'times_{:05d}.npy'.format(index),
+            }
+            self._chunk = open_memmap(os.path.join(self.output, chunk['power']), mode='w+',
+                                      dtype='float32', shape=(self.chunk_runs, self.bins))
+            self._chunk.fill(numpy.nan)
+            self._chunk_times = open_memmap(os.path.join(self.output, chunk['times']), mode='w+',
+                                            dtype='float64', shape=(self.chunk_runs, 2))
+            self._chunk_times.fill(numpy.nan)
+            self._chunks.append(chunk)
+            self._write_manifest()
+        return self._chunk
+
+    def _close_chunk(self):
+        """Flush current chunk to disk"""
+        if self._chunk is not None:
+            self._chunk.flush()
+            self._chunk_times.flush()
+            self._chunk = None
+            self._chunk_times = None
+
+    def _store(self, f_array, pwr_array):
+        """Store PSD of one frequency hop to current row of power matrix"""
+        try:
+            offset, size = self._layout[f_array[0]]
+        except KeyError:
+            logger.warning('Frequency hop {} Hz is not part of waterfall store, ignoring it'.format(f_array[0]))
+            return
+
+        size = min(size, len(pwr_array))
+        self._get_chunk()[self.runs % self.chunk_runs, offset:offset + size] = pwr_array[:size]
+
+    def _write_manifest(self):
+        """Write manifest atomically (readers never see partially written file)"""
+        manifest = {
+            'format': self.format_name,
+            'version': self.version,
+            'bins': self.bins,
+            'chunk_runs': self.chunk_runs,
+            'runs': self.runs,
+            'samples': self.samples,
+            'freqs': 'freqs.npy',
+            'hops': [[float(f), offset, size] for f, (offset, size) in sorted(self._layout.items())],
+            'chunks': self._chunks,
+        }
+        path = os.path.join(self.output, self.manifest_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.tmp', path)
+
+    def write(self, psd_data_or_future, time_start, time_stop, samples, channel=None):
+        """Write PSD of one frequency hop"""
+        try:
+            # Wait for result of future
+            f_array, pwr_array = psd_data_or_future.result()
+        except AttributeError:
+            f_array, pwr_array = psd_data_or_future
+
+        try:
+            if self._run_time is None:
+                self._run_time = [time_start.timestamp(), time_stop.timestamp()]
+            self._run_time[1] = time_stop.timestamp()
+
+            # Columns of power matrix are known after first run
+            if self._layout is None:
+                self.samples = samples
+                self._pending.append((numpy.array(f_array), numpy.array(pwr_array)))
+            else:
+                self._store(f_array, pwr_array)
+        except Exception as e:
+            logging.exception('Error writing to output file: {}'.format(e))
+
+    def write_next(self):
+        """Write marker for next run of measurement"""
+        if self._run_time is None:
+            return
+
+        if self._layout is None:
+            self._create_layout(self._pending)
+            for f_array, pwr_array in self._pending:
+                self._store(f_array, pwr_array)
+            self._pending = []
+
+        self._get_chunk()
+        self._chunk_times[self.runs % self.chunk_runs] = self._run_time
+        self._run_time = None
+        self.runs += 1
+        self._write_manifest()
+
+    def flush(self):
+        """Nothing to flush (chunks are memory-mapped and manifest is written at end of every run)"""
+        pass
+
+    def hop_written(self):
+        """Waterfall store is never flushed or rotated after hop"""
+        pass
+
+    def close(self):
+        """Finish last run and flush data to disk"""
+        self.write_next()
+        self._close_chunk()
+
+
+class WaterfallReader:
+    """Reader of waterfall store directory (power matrix chunks are memory-mapped)"""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, WaterfallWriter.manifest_name)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format'] != WaterfallWriter.format_name:
+            raise ValueError('Unknown format of waterfall store: {}'.format(self.manifest['format']))
+
+        self.runs = self.manifest['runs']
+        self.chunk_runs = self.manifest['chunk_runs']
+        self.freqs = numpy.load(os.path.join(path, self.manifest['freqs']), mmap_mode='r')
+
+        # Use only rows of already written runs
+        self.chunks = []
+        times = []
+        for i, chunk in enumerate(self.manifest['chunks']):
+            rows = min(self.chunk_runs, self.runs - i * self.chunk_runs)
+            if rows <= 0:
+                break
+            self.chunks.append(numpy.load(os.path.join(path, chunk['power']), mmap_mode='r')[:rows])
+            times.append(numpy.load(os.path.join(path, chunk['times']), mmap_mode='r')[:rows])
+        self.times = numpy.concatenate(times) if times else numpy.empty((0, 2))
+
+    def __len__(self):
+        return self.runs
+
+    def power(self, runs=slice(None), bins=slice(None)):
+        """Return power matrix of selected runs and bins (only touched chunks are read)"""
+        start, stop, step = runs.indices(self.runs)
+        rows = []
+        for i, chunk in enumerate(self.chunks):
+            chunk_start = i * self.chunk_runs
+            first = max(start, chunk_start)
+            if step > 1:
+                first += (start - first) % step
+            last = min(stop, chunk_start + len(chunk))
+            if first < last:
+                rows.append(chunk[first - chunk_start:last - chunk_start:step, bins])
+        if not rows:
+            return numpy.empty((0, len(self.freqs[bins])), dtype='float32')
+        return numpy.concatenate(rows)
+
+
 formats = {
     'soapy_power_bin': SoapyPowerBinWriter,
     'rtl_power_fftw': RtlPowerFftwWriter,
     'rtl_power': RtlPowerWriter,
+    'waterfall': WaterfallWriter,
 }
@@ -0,0 +1,103 @@
+import time, socket, concurrent.futures
+
+import pytest
+
+from soapypower import broadcast
+
+message_size = 2**20
+
+
+def message(i):
+    """Return message which can be identified by its content"""
+    return bytes([i % 256]) * message_size
+
+
+def connect(server):
+    """Connect loopback client to server and wait until server accepts it"""
+    family, address = broadcast.parse_address(server.name)
+    sock = socket.create_connection(address)
+    deadline = time.time() + 5
+    while not server.clients:
+        assert time.time() < deadline, 'Client has not been accepted'
+        time.sleep(0.01)
+    return sock
+
+
+def receive_messages(sock):
+    """Read until server closes connection, return list of message indices"""
+    data = bytearray()
+    with sock:
+        sock.settimeout(10)
+        while True:
+            chunk = sock.recv(2**16)
+            if not chunk:
+                break
+            data += chunk
+
+    indices = []
+    for start in range(0, len(data) - len(data) % message_size, message_size):
+        chunk = bytes(data[start:start + message_size])
+        # Messages are always sent whole
+        assert chunk == message(chunk[0])
+        indices.append(chunk[0])
+    return indices, len(data) % message_size
+
+
+def test_all_messages_are_delivered_to_all_clients():
+    server = broadcast.BroadcastServer('tcp://127.0.0.1:0', max_queue_size=100)
+    clients = [connect(server) for i in range(2)]
+    deadline = time.time() + 5
+    while len(server.clients) < 2:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    with concurrent.futures.ThreadPoolExecutor(len(clients)) as executor:
+        received = [executor.submit(receive_messages, sock) for sock in clients]
+        for i in range(5):
+            assert server.write(message(i)) == message_size
+        server.close()
+
+    for future in received:
+        assert future.result() == ([0, 1, 2, 3, 4], 0)
+
+
+def test_drop_oldest_keeps_newest_messages():
+    server = broadcast.BroadcastServer('tcp://127.0.0.1:0', max_queue_size=2, overflow='drop-oldest')
+    sock = connect(server)
+    client = server.clients[0]
+
+    # Client doesn't read, so socket buffers fill up and messages are queued and dropped
+    messages = 64
+    for i in range(messages):
+        server.write(message(i))
+    assert client.dropped > 0
+    server.close()
+
+    indices, rest = receive_messages(sock)
+    assert rest == 0
+    assert indices == sorted(indices)
+    assert indices[-2:] == [messages - 2, messages - 1]
+    assert len(indices) + client.dropped == messages
+
+
+def test_disconnect_slow_client():
+    server = broadcast.BroadcastServer('tcp://127.0.0.1:0', max_queue_size=2, overflow='disconnect')
+    sock = connect(server)
+    client = server.clients[0]
+
+    for i in range(64):
+        server.write(message(i))
+    assert client.closed
+
+    # Only messages sent before disconnection are received, then connection is closed
+    indices, rest = receive_messages(sock)
+    assert indices == list(range(len(indices)))
+    assert len(indices) < 64
+    client.join(5)
+    assert not server.clients
+    server.close()
+
+
+def test_invalid_overflow_policy():
+    with pytest.raises(ValueError):
+        broadcast.BroadcastServer('tcp://127.0.0.1:0', overflow='block')
@@ -0,0 +1,87 @@
+import os, json, time, socket, threading
+
+import pytest
+
+from soapypower import power, source, daemon
+
+
+def request(f, message):
+    """Send request to daemon and return its first reply"""
+    f.write((json.dumps(message) + '\n').encode())
+    f.flush()
+    return json.loads(f.readline().decode())
+
+
+@pytest.fixture
+def sweep_daemon(tmp_path):
+    """Start daemon with simulated device in background thread, yield (daemon, client file)"""
+    device = source.SimulatedSource(sample_rate=2e6, seed=0)
+    sdr = power.SoapyPower(device=device, output_format='rtl_power')
+    sweep_args = dict(min_freq=100e6, max_freq=100e6, bins=256, repeats=16, runs=1)
+    d = daemon.SweepDaemon(sdr, str(tmp_path / 'daemon.sock'), sweep_args, pow2=True)
+    thread = threading.Thread(target=d.serve, daemon=True)
+    thread.start()
+
+    deadline = time.time() + 5
+    while not os.path.exists(d.path):
+        assert time.time() < deadline, 'Daemon is not listening'
+        time.sleep(0.01)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(d.path)
+        with s.makefile('rwb') as f:
+            yield d, f
+            request(f, {'command': 'shutdown'})
+    thread.join(5)
+    assert not thread.is_alive()
+    assert not os.path.exists(d.path)
+
+
+def test_job_lifecycle(sweep_daemon, tmp_path):
+    d, f = sweep_daemon
+    output = str(tmp_path / 'output.csv')
+    queued = request(f, {'min_freq': 100e6, 'max_freq': 100e6, 'bins': 500, 'runs': 2, 'output': output})
+    assert queued['status'] == 'queued'
+
+    replies = [json.loads(f.readline().decode()) for i in range(2)]
+    assert [r['status'] for r in replies] == ['running', 'done']
+    assert all(r['id'] == queued['id'] for r in replies)
+
+    # Finished job is never reported as running after its final reply
+    status = request(f, {'command': 'status'})
+    assert status == {'status': 'ok', 'running': None, 'queued': 0}
+
+    # Number of bins is rounded to power of two same as on command line
+    with open(output) as out:
+        rows = [line.split(', ') for line in out]
+    assert len(rows) == 2
+    assert all(len(row) - 6 == 512 for row in rows)
+
+
+def test_device_is_reused_between_jobs(sweep_daemon, tmp_path):
+    d, f = sweep_daemon
+    for i in range(2):
+        job_id = request(f, {'output': str(tmp_path / 'output{}.csv'.format(i))})['id']
+        assert json.loads(f.readline().decode()) == {'id': job_id, 'status': 'running'}
+        assert json.loads(f.readline().decode())['status'] == 'done'
+        assert os.path.getsize(str(tmp_path / 'output{}.csv'.format(i))) > 0
+
+
+@pytest.mark.parametrize('job, error', [
+    ({}, 'Output'),
+    ({'output': 'x', 'format': 'unknown'}, 'Unknown output format'),
+    ({'output': 'x', 'gain': 10}, 'Unknown parameters: gain'),
+    ({'output': 'x', 'bins': 0}, 'Invalid value of bins'),
+    ({'output': 'x', 'runs': 0}, 'Endless jobs'),
+])
+def test_invalid_job_is_rejected(sweep_daemon, job, error):
+    d, f = sweep_daemon
+    reply = request(f, job)
+    assert reply['status'] == 'error'
+    assert error in reply['error']
+    assert request(f, {'command': 'status'})['queued'] == 0
+
+
+def test_unknown_command(sweep_daemon):
+    d, f = sweep_daemon
+    assert request(f, {'command': 'restart'}) == {'status': 'error', 'error': 'Unknown command: restart'}
@@ -0,0 +1,80 @@
+import pytest
+
+from soapypower import power, source
+
+
+def multi_sdr(count, **kwargs):
+    """Return MultiSoapyPower with simulated devices (with different tuning latency)"""
+    devices = [{'device': source.SimulatedSource(sample_rate=2e6, tuning_latency=0.002 * (count - i), seed=i)}
+               for i in range(count)]
+    return power.MultiSoapyPower(devices, **kwargs)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3])
+def test_multi_device_hops_in_order(count):
+    sdr = multi_sdr(count)
+    freq_list = sdr.freq_plan(100e6, 120e6, 256, quiet=True)
+    centers = [freq_array[len(freq_array) // 2]
+               for freq_array, pwr_array, time_start, time_stop, samples
+               in sdr.sweep_iter(100e6, 120e6, 256, 16, runs=2)]
+    assert len(centers) == 2 * len(freq_list)
+    assert centers[:len(freq_list)] == sorted(centers[:len(freq_list)])
+    assert centers[:len(freq_list)] == centers[len(freq_list):]
+
+
+def test_paired_devices_measure_every_hop():
+    sdr = multi_sdr(2, paired=True)
+    freq_list = sdr.freq_plan(100e6, 110e6, 256, quiet=True)
+    centers = [freq_array[len(freq_array) // 2]
+               for freq_array, pwr_array, time_start, time_stop, samples
+               in sdr.sweep_iter(100e6, 110e6, 256, 16, runs=1)]
+    # Every hop is measured by both devices (hops are in order of frequency and device)
+    assert len(centers) == 2 * len(freq_list)
+    assert centers[0::2] == centers[1::2]
+    assert centers[0::2] == sorted(centers[0::2])
+
+
+def simulated_sdr():
+    """Return SoapyPower with simulated device"""
+    return power.SoapyPower(device=source.SimulatedSource(sample_rate=2e6, seed=0))
+
+
+@pytest.mark.parametrize('memory_budget', [2**20, 3 * 2**20 + 12345, 10 * 2**20, 256 * 2**20])
+@pytest.mark.parametrize('bins, repeats', [(1024, 100), (4096, 1000), (512, 10000)])
+def test_memory_budget_is_never_exceeded(memory_budget, bins, repeats):
+    base_buffer_size = 16384
+    buffer_repeats, buffer_pool = simulated_sdr().create_buffer(bins, repeats, base_buffer_size,
+                                                                memory_budget=memory_budget)
+    try:
+        assert buffer_pool.nbytes <= memory_budget
+        assert buffer_pool.buffer_count >= 2
+        assert buffer_pool.buffer_size % base_buffer_size == 0
+        # All samples of hop are still read (in more buffers if needed)
+        assert buffer_pool.buffer_size * buffer_repeats >= bins * repeats
+    finally:
+        buffer_pool.close()
+
+
+@pytest.mark.parametrize('memory_budget', [2**20, 10 * 2**20])
+def test_memory_budget_of_chunk_buffers(memory_budget):
+    buffer_pool = simulated_sdr().create_chunk_buffer(1024, 1000, 16384, 2, memory_budget=memory_budget)
+    try:
+        assert buffer_pool.nbytes <= memory_budget
+        assert buffer_pool.buffer_count == memory_budget // (buffer_pool.buffer_size * 8)
+    finally:
+        buffer_pool.close()
+
+
+def test_memory_budget_too_small():
+    with pytest.raises(ValueError):
+        simulated_sdr().create_buffer(1024, 100, 16384, memory_budget=2 * 16384 * 8 - 1)
+    with pytest.raises(ValueError):
+        simulated_sdr().create_chunk_buffer(1024, 100, 16384, 2, memory_budget=2**18)
+
+
+def test_max_buffers_without_memory_budget():
+    buffer_repeats, buffer_pool = simulated_sdr().create_buffer(1024, 100, 16384, max_buffers=5)
+    try:
+        assert buffer_pool.buffer_count == 5
+    finally:
+        buffer_pool.close()
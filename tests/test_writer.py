@@ -0,0 +1,119 @@
+import io, datetime
+
+import numpy
+import pytest
+
+from soapypower import writer
+
+
+def roundtrip(fmt, pwr_array):
+    """Write one frame to memory and read it back, return (header, power array)"""
+    f = io.BytesIO()
+    fmt.write(f, 0, 1, 100e6, 101e6, 1e3, 1000, pwr_array)
+    f.seek(0)
+    return fmt.read(f)
+
+
+@pytest.mark.parametrize('encoding', ['int16', 'delta'])
+@pytest.mark.parametrize('compression', ['none', 'zlib'])
+def test_quantization_roundtrip_narrow_range(encoding, compression):
+    fmt = writer.SoapyPowerBinFormat(encoding, compression, quantization=0.01)
+    pwr_array = numpy.linspace(-120, -20, 4096, dtype=numpy.float32)
+    header, decoded = roundtrip(fmt, pwr_array)
+    assert header.version == 3
+    assert header.scale == pytest.approx(0.01)
+    assert numpy.abs(decoded - pwr_array).max() <= header.scale / 2 + 1e-5
+
+
+@pytest.mark.parametrize('encoding', ['int16', 'delta'])
+@pytest.mark.parametrize('pwr_array', [
+    numpy.array([-500, 0, 500], dtype=numpy.float32),
+    numpy.linspace(-800, 300, 10000, dtype=numpy.float32),
+])
+def test_quantization_roundtrip_wide_range(encoding, pwr_array):
+    fmt = writer.SoapyPowerBinFormat(encoding, quantization=0.01)
+    header, decoded = roundtrip(fmt, pwr_array)
+    assert header.scale > 0.01
+    # Error is at most half of quantization step (plus float32 rounding of decoded values)
+    tolerance = numpy.spacing(numpy.abs(pwr_array).max()) * 2
+    assert numpy.abs(decoded - pwr_array).max() <= header.scale / 2 + tolerance
+
+
+@pytest.mark.parametrize('encoding', ['int16', 'delta'])
+def test_quantization_non_finite_values(encoding):
+    fmt = writer.SoapyPowerBinFormat(encoding, quantization=0.01)
+    pwr_array = numpy.array([-50, numpy.nan, numpy.inf, -numpy.inf, -20], dtype=numpy.float32)
+    header, decoded = roundtrip(fmt, pwr_array)
+    assert numpy.isnan(decoded[1])
+    assert decoded[2] == numpy.inf
+    assert decoded[3] == -numpy.inf
+    assert decoded[[0, 4]] == pytest.approx([-50, -20], abs=0.005)
+
+
+def test_float32_frame_stays_version_2():
+    fmt = writer.SoapyPowerBinFormat()
+    pwr_array = numpy.array([-50, -40, -30], dtype=numpy.float32)
+    header, decoded = roundtrip(fmt, pwr_array)
+    assert header.version == 2
+    assert numpy.array_equal(decoded, pwr_array)
+
+
+class FlushCounter(io.BytesIO):
+    """In-memory output counting flushes"""
+    flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+        super().flush()
+
+
+def psd_data(freq, bins=64):
+    """Return (f_array, pwr_array) of one hop"""
+    return (numpy.arange(bins, dtype=numpy.float64) * 1e3 + freq,
+            numpy.full(bins, -50, dtype=numpy.float32))
+
+
+def write_hops(w, runs, hops):
+    """Write given number of runs and hops synchronously (in current thread)"""
+    t = datetime.datetime.now()
+    for run in range(runs):
+        for hop in range(hops):
+            w._write(psd_data(100e6 + hop * 1e6), t, t, 1000)
+        w._write_next()
+
+
+def read_frames(path):
+    """Return list of all frames in soapy_power_bin file"""
+    fmt = writer.SoapyPowerBinFormat()
+    frames = []
+    with open(path, 'rb') as f:
+        while True:
+            frame = fmt.read(f)
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+
+@pytest.mark.parametrize('flush_hops, expected', [(1, 8 + 2), (3, 2 + 2), (0, 2)])
+def test_flush_hops(flush_hops, expected):
+    output = FlushCounter()
+    w = writer.SoapyPowerBinWriter(output, flush_hops=flush_hops)
+    write_hops(w, runs=2, hops=4)
+    # Output is always flushed at end of run
+    assert output.flushes == expected
+
+
+@pytest.mark.parametrize('runs, hops', [(1, 4), (3, 4), (2, 5)])
+def test_rotate_size(tmp_path, runs, hops):
+    frame_size = len(writer.SoapyPowerBinFormat().pack(0, 0, 0, 0, 0, 0, psd_data(0)[1]))
+    w = writer.SoapyPowerBinWriter(str(tmp_path / 'output.bin'), flush_hops=0, rotate_size=2 * frame_size)
+    write_hops(w, runs=runs, hops=hops)
+    w.close()
+
+    paths = sorted(tmp_path.iterdir())
+    assert not [p for p in paths if p.suffix == '.part']
+    sizes = [p.stat().st_size for p in paths]
+    # Every file is rotated after two hops and no empty file is left behind
+    assert all(size > 0 for size in sizes)
+    assert len(paths) == -(-runs * hops // 2)
+    assert sum(len(read_frames(p)) for p in paths) == runs * hops